@@ -0,0 +1,308 @@
+'''
+An asyncio implementation of the TCP API, for running the lockin without the
+GUI. It accepts the same commands as server.Server and listens on TCP, on a
+Unix domain socket, or both.
+
+Every client is served by its own coroutine, so a slow client never holds up
+another one. Commands reach the lockin through the engine's command queue,
+and replies are built from the engine's latest snapshot, exactly as with the
+GUI. This module does not import Qt.
+'''
+import asyncio
+import time
+
+import numpy as np
+
+from feedbacklockin import derived
+from feedbacklockin import protocol
+from feedbacklockin import settle
+from feedbacklockin import sysid
+
+
+# Frames waiting for one subscriber, beyond which the oldest are dropped.
+_SUBSCRIBER_QUEUE = 64
+
+
+class AsyncServer(object):
+    def __init__(self, setup):
+        # setup is a config.Setup, whose engine runs the lockin.
+        self._setup = setup
+        self._engine = setup.engine
+        self._fbl = setup.lockin
+        self._channels = setup.channels
+        self._servers = []
+
+    async def start(self, host='localhost', port=None, unix_path=None):
+        """Starts listening on host:port and/or unix_path."""
+        if port is not None:
+            srv = await asyncio.start_server(self._client, host, port)
+            self._servers.append(srv)
+            for sock in srv.sockets:
+                print(f'Listening on {sock.getsockname()}')
+        if unix_path is not None:
+            srv = await asyncio.start_unix_server(self._client, unix_path)
+            self._servers.append(srv)
+            print(f'Listening on {unix_path}')
+
+    async def serve_forever(self):
+        await asyncio.gather(*(s.serve_forever() for s in self._servers))
+
+    def close(self):
+        for srv in self._servers:
+            srv.close()
+
+    async def _client(self, reader, writer):
+        client = _Client(self, writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').strip()
+                size = protocol.payload_size(line)
+                payload = None
+                if size is not None:
+                    payload = await reader.readexactly(size)
+                await client.handle(line, payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            client.close()
+            writer.close()
+
+
+class _Client(object):
+    """The state of one connection: its batch and its subscription."""
+    def __init__(self, server, writer):
+        self._server = server
+        self._engine = server._engine
+        self._fbl = server._fbl
+        self._writer = writer
+        self._batch = None
+        self._sub = None
+        self._pusher = None
+
+    async def handle(self, line, payload):
+        if self._batch is not None:
+            if line == 'end':
+                await self._run_batch(self._batch)
+                self._batch = None
+            elif line:
+                self._batch.append((line, payload))
+        elif line == 'batch':
+            self._batch = []
+        elif line.startswith('wait_settled'):
+            # Later commands wait too, so replies stay in order.
+            await self._wait_settled(line)
+        elif line:
+            self._command(line, payload)
+            await self._writer.drain()
+
+    def close(self):
+        self._unsubscribe()
+
+    async def _run_batch(self, commands):
+        # As in server.Server, every change in the batch reaches the lockin
+        # between the same two frames, and the batch gets one reply.
+        self._engine.begin_batch()
+        try:
+            ok = sum(self._command(line, payload)
+                     for line, payload in commands)
+        finally:
+            self._engine.end_batch()
+        self._writer.write(f'batch {ok} {len(commands) - ok}\n'.encode('utf-8'))
+        await self._writer.drain()
+
+    def _command(self, line, payload=None):
+        """Runs one command line, returning whether it was valid."""
+        l = line.split(' ')
+        submit = self._engine.submit
+        fbl = self._fbl
+        try:
+            if l[0] == 'sendData' or l[0] == 'send_data':
+                self._writer.write(protocol.pack_legacy(
+                        self._engine.snapshot()))
+            elif l[0] == 'get_frame':
+                self._writer.write(protocol.pack_frame(
+                        self._engine.snapshot(),
+                        protocol.parse_mask(l[1] if len(l) == 2 else '')))
+            elif l[0] == 'subscribe':
+                self._subscribe(
+                        protocol.parse_mask(l[1] if len(l) > 1 else ''),
+                        int(l[2]) if len(l) > 2 else 1)
+            elif l[0] == 'unsubscribe':
+                self._unsubscribe()
+            elif l[0] == 'protocol':
+                self._writer.write(f'{protocol.VERSION}\n'.encode('utf-8'))
+            elif l[0] == 'send_matrix':
+                self._writer.write(protocol.pack_matrix(
+                        self._engine.snapshot()))
+            elif l[0] == 'setV' or l[0] == 'set_setpoint':
+                submit(fbl.update_setpoint, float(l[2]), self._channel(l))
+            elif l[0] == 'setI' or l[0] == 'set_amplitude':
+                # Like the GUI, leave channels with feedback alone.
+                amps = np.full(self._server._channels, np.nan)
+                amps[self._channel(l)] = float(l[2])
+                submit(fbl.update_all_amps, amps)
+            elif l[0] == 'setKi' or l[0] == 'set_ki':
+                submit(fbl.update_ki,
+                       protocol.parse_gain(l[1:], self._server._channels))
+            elif l[0] == 'set_kp':
+                submit(fbl.update_kp,
+                       protocol.parse_gain(l[1:], self._server._channels))
+            elif l[0] == 'set_kis':
+                submit(fbl.update_ki, self._vector(l, payload))
+            elif l[0] == 'set_kps':
+                submit(fbl.update_kp, self._vector(l, payload))
+            elif l[0] == 'set_slew':
+                submit(fbl.update_slew, float(l[1]))
+            elif l[0] == 'setFeed' or l[0] == 'set_feedback':
+                submit(fbl.set_feedback_enabled, self._channel(l),
+                       bool(int(l[2])))
+            elif l[0] == 'set_setpoints':
+                submit(fbl.update_setpoints,
+                       self._vector(l, payload))
+            elif l[0] == 'set_amplitudes':
+                submit(fbl.update_all_amps,
+                       self._vector(l, payload))
+            elif l[0] == 'set_feedback_mask':
+                submit(fbl.set_feedback_mask,
+                       self._vector(l, payload) != 0)
+            elif l[0] == 'set_gains':
+                submit(fbl.update_k, *protocol.parse_gains(
+                        l[1:], payload, self._server._channels))
+            elif l[0] == 'set_response':
+                submit(fbl.set_response, protocol.parse_vector(
+                        l[1:], payload, self._server._channels**2))
+            elif l[0] == 'clear_response':
+                submit(fbl.set_response, None)
+            elif l[0] == 'identify':
+                submit(fbl.identify, *sysid.parse_identify(l[1:]))
+            elif l[0] == 'autoTune' or l[0] == 'autotune':
+                # Its old scale factor argument is ignored.
+                submit(fbl.identify)
+            elif l[0] == 'identify_cancel':
+                submit(fbl.cancel_identify)
+            elif l[0] == 'identify_status':
+                state, done, total = self._engine.snapshot().identify
+                self._writer.write(f'{state} {done} {total}\n'
+                                   .encode('utf-8'))
+            elif l[0] == 'reset_avg':
+                submit(fbl.reset_avg)
+            elif l[0] == 'start_recording':
+                self._server._setup.recorder.start(l[1] if len(l) == 2 else '')
+            elif l[0] == 'stop_recording':
+                self._server._setup.recorder.stop()
+            elif l[0] == 'dump_capture':
+                self._dump_capture(float(l[1]), l[2] if len(l) == 3 else '')
+            elif l[0] == 'define':
+                submit(fbl.define_derived, l[1], derived.parse(
+                        ' '.join(l[2:]), self._server._channels))
+            elif l[0] == 'undefine':
+                submit(fbl.remove_derived, l[1])
+            elif l[0] == 'wait_settled':
+                raise ValueError("can't wait inside a batch")
+            elif l[0] == 'derived':
+                names = self._engine.snapshot().derived_names
+                self._writer.write((','.join(names) + '\n').encode('utf-8'))
+            else:
+                raise ValueError('command not found')
+        except ValueError as e:
+            self._reject(l, e)
+            return False
+        except IndexError as e:
+            self._reject(l, 'wrong number of arguments')
+            return False
+        return True
+
+    def _reject(self, l, reason):
+        print(f'Bad command {l}: {reason}')
+        # A client waiting for a reply gets an error line rather than none.
+        if l[0] in protocol.REPLYING:
+            self._writer.write(protocol.pack_error(reason))
+
+    def _channel(self, l):
+        return protocol.parse_channel(l[1], self._server._channels)
+
+    def _vector(self, l, payload):
+        # Checked against the channel count here, rather than only where it
+        # is used, so that a batch counts only what will be applied.
+        return protocol.parse_vector(l[1:], payload, self._server._channels)
+
+    def _dump_capture(self, seconds, path):
+        capture = self._server._setup.capture
+        if capture is None:
+            raise ValueError('raw capture is not enabled')
+        if not path:
+            path = time.strftime('dump-%Y%m%d-%H%M%S.ring')
+        # Copying out can take a while, so keep it off the event loop.
+        def dump():
+            n = capture.dump(path, seconds)
+            print(f'Dumped {n} frames to {path}')
+        asyncio.get_running_loop().run_in_executor(None, dump)
+
+    async def _wait_settled(self, line):
+        try:
+            chans, tol, timeout = settle.parse_wait(line.split(' ')[1:],
+                                                    self._server._channels)
+        except ValueError as e:
+            self._reject(line.split(' '), e)
+            await self._writer.drain()
+            return
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        sub = self._engine.subscribe(
+                0, 1, 1, lambda: loop.call_soon_threadsafe(ready.set))
+        snap = self._engine.snapshot()
+        # The frame after next is the first one any change sent before this
+        # command is sure to have reached.
+        first = snap.seq + 2
+        result = 'timeout'
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                ready.clear()
+                snap = sub.pop() or snap
+                if snap.seq >= first and settle.settled(snap, chans, tol):
+                    result = 'settled'
+                    break
+        finally:
+            self._engine.unsubscribe(sub)
+        self._writer.write(f'{result} {snap.seq}\n'.encode('utf-8'))
+        await self._writer.drain()
+
+    def _subscribe(self, mask, decimation):
+        self._unsubscribe()
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._sub = self._engine.subscribe(
+                mask, decimation, _SUBSCRIBER_QUEUE,
+                lambda: loop.call_soon_threadsafe(ready.set))
+        self._pusher = loop.create_task(self._push(self._sub, ready))
+
+    def _unsubscribe(self):
+        if self._sub is not None:
+            self._engine.unsubscribe(self._sub)
+            self._pusher.cancel()
+            self._sub = None
+            self._pusher = None
+
+    async def _push(self, sub, ready):
+        # drain() waits while the client is slow, and meanwhile the
+        # subscription's bounded queue drops the oldest frames.
+        while True:
+            await ready.wait()
+            ready.clear()
+            snap = sub.pop()
+            while snap is not None:
+                self._writer.write(protocol.pack_frame(snap, sub.mask,
+                                                       sub.dropped))
+                await self._writer.drain()
+                snap = sub.pop()
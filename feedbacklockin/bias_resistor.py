@@ -3,6 +3,15 @@ A BiasResistor object maps "amps" to "outs" in a manner that approximately
 conserves current assuming similar valued bias resistors for each input. This
 is tied into the  smooth operation of "FeedbackLockin" objects so that feedback
 signals do not drastically alter the DC potential of a device.
+
+The transfer matrix is never stored. It is always the identity plus a masked
+rank-one term,
+
+    M = I + phi * (diag(e) - e e^T)
+
+where e is 1 for enabled channels and 0 otherwise, so both it and its
+inverse (by Sherman-Morrison) are applied in O(N) from a few coefficients
+that only change along with the mask.
 '''
 
 import numpy as np
@@ -13,6 +22,12 @@ class BiasResistor(object):
         self._channels = channels
         self._amps = np.zeros(channels)
         self._outs = np.zeros(channels)
+        self._tmp = np.zeros(channels)
+        self._enabled = np.ones(channels)
+        self._diag = np.ones(channels)
+        self._diag_inv = np.ones(channels)
+        self._phi = 0.0
+        self._inv_coeff = 0.0
         self.setZeroSum(0.5)
 
     def setZeroSum(self, correctionFactor):
@@ -21,34 +36,56 @@ class BiasResistor(object):
         # (1,-phi...-phi) where phi is approximately 1/(N-1). The input
         # correctionFactor goes from 0.0 where phi is ideal, to 1.0 where phi=0
         # the correctionFactor allows for a choice to correct for DC errors.
-        self._xfer_mat = (-np.ones((self._channels, self._channels))
-                / (self._channels - 1) * (1.0 - correctionFactor))
-        for i in range(self._channels):
-            self._xfer_mat[i, i] = 1.0
+        self.setZeroSumDisabledAxes(correctionFactor,
+                                    np.zeros(self._channels))
 
     def setZeroSumDisabledAxes(self, correctionFactor, disabledVector):
         # As above, but removes the inflence of particular elements.
-        N = self._channels - np.sum(disabledVector)
+        np.subtract(1.0, np.asarray(disabledVector, dtype=bool),
+                    out=self._enabled)
+        N = np.sum(self._enabled)
         if N > 1:
-            self._xfer_mat = (-np.ones((self._channels,self._channels))
-                    / (N - 1) * (1.0 - correctionFactor))
-            for i in range(self._channels):
-                if disabledVector[i]:
-                    self._xfer_mat[i,:] = 0
-                    self._xfer_mat[:,i] = 0
-                self._xfer_mat[i,i] = 1.0
+            phi = (1.0 - correctionFactor) / (N - 1)
         else:
-            self._xfer_mat = np.eye(self._channels)
+            phi = 0.0
+        # M = diag(d) - phi e e^T, with d = 1 + phi e.
+        self._phi = phi
+        np.multiply(self._enabled, phi, out=self._diag)
+        self._diag += 1.0
+        np.divide(1.0, self._diag, out=self._diag_inv)
+        # Sherman-Morrison: M^-1 = diag(1 / d) + g e e^T, since e / d is
+        # e / (1 + phi). The denominator is correctionFactor whenever N > 1,
+        # and the matrix is singular when it is 0.
+        denom = 1.0 - phi * N / (1.0 + phi)
+        if denom == 0.0:
+            self._inv_coeff = np.inf
+        else:
+            self._inv_coeff = phi / ((1.0 + phi)**2 * denom)
+
+    def matrix(self):
+        """Returns the transfer matrix as a dense array."""
+        return (np.diag(self._diag)
+                - self._phi * np.outer(self._enabled, self._enabled))
 
     def step(self, amps):
-        # Performs the transfer matrix operation.
-        self._amps = amps
-        self._outs = np.dot(self._xfer_mat, amps)
+        # Performs the transfer matrix operation. The result is written into
+        # the same array every call.
+        np.copyto(self._amps, amps)
+        np.multiply(self._diag, amps, out=self._outs)
+        np.multiply(self._enabled, self._phi * np.dot(self._enabled, amps),
+                    out=self._tmp)
+        self._outs -= self._tmp
         return self._outs
 
     def reverse(self):
         # Reverses the tranfer matrix operation. This is called particularly
         # after the transfer matrix has changed in order to prevent
         # discontinuities in the input code.
-        self._amps = np.dot(np.linalg.inv(self._xfer_mat), self._outs)
+        if np.isinf(self._inv_coeff):
+            raise np.linalg.LinAlgError('Singular matrix')
+        np.multiply(self._diag_inv, self._outs, out=self._amps)
+        np.multiply(self._enabled,
+                    self._inv_coeff * np.dot(self._enabled, self._outs),
+                    out=self._tmp)
+        self._amps += self._tmp
         return self._amps
@@ -0,0 +1,138 @@
+'''
+Converts thermometer resistances to temperatures with calibration curves.
+
+Each curve is loaded, sorted and checked once. It is interpolated in log-log
+space, where resistance thermometers (RuOx, Cernox) are close to straight
+lines, either piecewise linearly or with a monotone cubic (Fritsch-Butland),
+which follows the curve more smoothly and never overshoots between points.
+Every segment's polynomial coefficients are worked out up front, so
+converting a value is a binary search and a few multiply-adds.
+
+A CalibrationSet holds the curves of several sensors side by side in one
+array, so a whole set of sensors is converted with a single vectorised call.
+Both only need numpy, so they can be used in clients as well as the lockin.
+'''
+import numpy as np
+
+
+class Calibration(object):
+    """One sensor's curve of temperature against resistance.
+
+    method is 'linear' or 'cubic'. Resistances outside the curve give the
+    temperature at its nearest end, as np.interp does, and resistances that
+    aren't positive give nan.
+    """
+    def __init__(self, resistance, temperature, method='linear'):
+        r = np.asarray(resistance, dtype=np.float64)
+        t = np.asarray(temperature, dtype=np.float64)
+        if r.ndim != 1 or r.shape != t.shape or len(r) < 2:
+            raise ValueError('need two matching columns of at least 2 points')
+        if not (np.all(np.isfinite(r)) and np.all(np.isfinite(t))
+                and np.all(r > 0) and np.all(t > 0)):
+            raise ValueError('resistances and temperatures must be positive')
+        order = np.argsort(r)
+        self.x = np.log(r[order])
+        y = np.log(t[order])
+        h = np.diff(self.x)
+        if np.any(h == 0):
+            raise ValueError('repeated resistance in calibration')
+        delta = np.diff(y) / h
+        if not (np.all(delta < 0) or np.all(delta > 0)):
+            raise ValueError('temperature is not monotonic in resistance')
+
+        # Segment i covers x[i] to x[i + 1], where
+        # y = c0 + c1 u + c2 u^2 + c3 u^3 with u = x - x[i].
+        self.coeffs = np.zeros((4, len(h)))
+        self.coeffs[0] = y[:-1]
+        if method == 'linear':
+            self.coeffs[1] = delta
+        elif method == 'cubic':
+            m = _monotone_slopes(h, delta)
+            self.coeffs[1] = m[:-1]
+            self.coeffs[2] = (3 * delta - 2 * m[:-1] - m[1:]) / h
+            self.coeffs[3] = (m[:-1] + m[1:] - 2 * delta) / h**2
+        else:
+            raise ValueError(f'unknown interpolation {method!r}')
+
+    @classmethod
+    def load(cls, path, method='linear', skiprows=2, t_col=0, r_col=1):
+        """Reads a calibration table, by default as in a Lakeshore .dat."""
+        table = np.loadtxt(path, skiprows=skiprows, ndmin=2)
+        return cls(table[:, r_col], table[:, t_col], method)
+
+    def __call__(self, resistance):
+        return CalibrationSet([self])(np.asarray(resistance)[..., None])[..., 0]
+
+
+def _monotone_slopes(h, delta):
+    # Fritsch-Butland slopes at the points: a weighted harmonic mean of the
+    # neighbouring secants, and flat where the secants change sign.
+    m = np.empty(len(h) + 1)
+    m[0] = delta[0]
+    m[-1] = delta[-1]
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+    m[1:-1] = np.where(same, mean, 0.0)
+    return m
+
+
+class CalibrationSet(object):
+    """Converts the resistances of several sensors at once.
+
+    Sensor k uses calibrations[k]. The curves are laid end to end in one
+    array, each shifted past the end of the one before, so a single
+    searchsorted finds every sensor's segment.
+    """
+    def __init__(self, calibrations):
+        self._count = len(calibrations)
+        shifts, knots, coeffs = [], [], []
+        shift = 0.0
+        for cal in calibrations:
+            shift -= cal.x[0]
+            shifts.append(shift)
+            knots.append(cal.x + shift)
+            coeffs.append(cal.coeffs)
+            shift += cal.x[-1] + 1.0
+        self._shift = np.array(shifts)
+        self._knots = np.concatenate(knots)
+        self._coeffs = np.concatenate(coeffs, axis=1)
+        sizes = np.array([len(cal.x) for cal in calibrations])
+        # The first knot of each curve in _knots, and of its segments in
+        # _coeffs, which has one less column per curve.
+        self._first = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        self._lo = self._knots[self._first]
+        self._hi = self._knots[self._first + sizes - 1]
+        self._last_segment = self._first + sizes - 2
+        self._segment_offset = np.arange(self._count)
+        self._seq = None
+        self._cached = None
+
+    def __len__(self):
+        return self._count
+
+    def __call__(self, resistances):
+        """Returns temperatures for resistances, whose last axis is sensors."""
+        r = np.asarray(resistances, dtype=np.float64)
+        if r.shape[-1:] != (self._count,):
+            raise ValueError(f'expected {self._count} resistances')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.log(r) + self._shift
+        x = np.clip(x, self._lo, self._hi)
+        knot = np.searchsorted(self._knots, x, side='right') - 1
+        knot = np.clip(knot, self._first, self._last_segment)
+        u = x - self._knots[knot]
+        c0, c1, c2, c3 = self._coeffs[:, knot - self._segment_offset]
+        t = np.exp(c0 + u * (c1 + u * (c2 + u * c3)))
+        # clip turns nan into the curve's end, so put it back.
+        t[~(r > 0)] = np.nan
+        return t
+
+    def temperatures(self, resistances, seq):
+        """As calling the set, but reuses the result for the same frame seq."""
+        if seq != self._seq:
+            self._cached = self(resistances)
+            self._seq = seq
+        return self._cached
@@ -0,0 +1,194 @@
+'''
+A RawCapture keeps the raw blocks of the most recent frames in a fixed-size,
+memory-mapped ring file, so that odd events can be looked at after the fact.
+
+The file starts with a one-page header holding the layout of the ring and
+its write head, followed by the sequence number and timestamp of every slot,
+followed by the slots themselves. Each slot holds one (rows) x (channels)
+input block and, optionally, the (points) x (channels) output block that was
+being written out at the same time. Blocks are copied straight into the
+mapped pages, so capturing a frame takes no buffers of its own, and the OS
+writes the pages back to disk in the background.
+
+A slot's sequence number is set to -1 while it is being written, so readers
+in other threads or processes can tell a torn slot from a complete one.
+dump() freezes the last few seconds into a capture file of their own, in the
+same format, which open() maps read-only for offline analysis.
+'''
+import time
+
+import numpy as np
+
+
+_MAGIC = b'FBLRAW01'
+_VERSION = 1
+_PAGE = 4096
+
+_HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', np.int64),
+    ('channels', np.int64),
+    ('rows', np.int64),
+    ('out_rows', np.int64),
+    ('capacity', np.int64),
+    ('frequency', np.float64),
+    # Slot that the next frame goes to, and how many frames were written.
+    ('head', np.int64),
+    ('total', np.int64),
+])
+
+
+def _pages(nbytes):
+    return -(-nbytes // _PAGE) * _PAGE
+
+
+class RawCapture(object):
+    def __init__(self, mm):
+        # Use create or open rather than calling this directly.
+        self._mm = mm
+        self._header = np.ndarray((), dtype=_HEADER, buffer=mm)
+        h = self._header
+        capacity = int(h['capacity'])
+        channels = int(h['channels'])
+        rows = int(h['rows'])
+        out_rows = int(h['out_rows'])
+        offset = _PAGE
+        self._seqs = np.ndarray(capacity, dtype=np.int64, buffer=mm,
+                                offset=offset)
+        self._times = np.ndarray(capacity, dtype=np.float64, buffer=mm,
+                                 offset=offset + 8 * capacity)
+        offset += _pages(16 * capacity)
+        # Blocks are stored the way the DAQ cards hand them over, one
+        # channel after another, so that copying one in is a straight copy.
+        self.inputs = np.ndarray((capacity, rows, channels), dtype=np.float64,
+                                 buffer=mm, offset=offset,
+                                 strides=(8 * rows * channels, 8, 8 * rows))
+        offset += 8 * capacity * rows * channels
+        if out_rows:
+            self.outputs = np.ndarray(
+                    (capacity, out_rows, channels), dtype=np.float64,
+                    buffer=mm, offset=offset,
+                    strides=(8 * out_rows * channels, 8, 8 * out_rows))
+        else:
+            self.outputs = None
+
+    @classmethod
+    def create(cls, path, channels, rows, capacity, out_rows=0,
+               frequency=0.0):
+        """Creates (or overwrites) a ring file of capacity frames.
+
+        rows is the length of each input block and out_rows the length of
+        each output block, or 0 to not capture outputs. frequency is the
+        rate at which blocks arrive, and is only used to turn seconds into
+        frames.
+        """
+        size = (_PAGE + _pages(16 * capacity)
+                + 8 * capacity * (rows + out_rows) * channels)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        mm = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        h = np.ndarray((), dtype=_HEADER, buffer=mm)
+        h['magic'] = _MAGIC
+        h['version'] = _VERSION
+        h['channels'] = channels
+        h['rows'] = rows
+        h['out_rows'] = out_rows
+        h['capacity'] = capacity
+        h['frequency'] = frequency
+        capture = cls(mm)
+        capture._seqs.fill(-1)
+        return capture
+
+    @classmethod
+    def open(cls, path, writable=False):
+        """Maps an existing capture file."""
+        mm = np.memmap(path, dtype=np.uint8, mode='r+' if writable else 'r')
+        h = np.ndarray((), dtype=_HEADER, buffer=mm)
+        if h['magic'] != _MAGIC or h['version'] != _VERSION:
+            raise ValueError(f'{path} is not a version {_VERSION} capture')
+        return cls(mm)
+
+    @property
+    def capacity(self):
+        return len(self._seqs)
+
+    @property
+    def frequency(self):
+        return float(self._header['frequency'])
+
+    @property
+    def seqs(self):
+        """Sequence number of the frame in each slot, -1 if none."""
+        return self._seqs
+
+    @property
+    def timestamps(self):
+        return self._times
+
+    @property
+    def total(self):
+        """Number of frames written since the ring was created."""
+        return int(self._header['total'])
+
+    def write(self, seq, inputs, outputs=None, timestamp=None):
+        """Copies one frame's blocks into the next slot of the ring."""
+        h = self._header
+        slot = int(h['head'])
+        self._seqs[slot] = -1
+        np.copyto(self.inputs[slot], inputs)
+        if self.outputs is not None and outputs is not None:
+            np.copyto(self.outputs[slot], outputs)
+        self._times[slot] = (time.monotonic() if timestamp is None
+                             else timestamp)
+        self._seqs[slot] = seq
+        h['head'] = (slot + 1) % self.capacity
+        h['total'] += 1
+
+    def slots(self, frames=None):
+        """Indices of the last frames slots, oldest first.
+
+        Only slots that have been written are included.
+        """
+        n = min(self.total, self.capacity)
+        if frames is not None:
+            n = min(n, frames)
+        head = int(self._header['head'])
+        return (np.arange(head - n, head) % self.capacity)
+
+    def frames(self, frames=None):
+        """(seqs, timestamps, inputs, outputs) of the last frames, in order.
+
+        The arrays are read from the ring, so a frame being written at the
+        same time may show up with a sequence number of -1.
+        """
+        idx = self.slots(frames)
+        outputs = self.outputs[idx] if self.outputs is not None else None
+        return self._seqs[idx], self._times[idx], self.inputs[idx], outputs
+
+    def dump(self, path, seconds):
+        """Freezes the last seconds of the ring into a new capture file.
+
+        Frames that were overwritten while being copied are left out.
+        Returns the number of frames saved.
+        """
+        frames = int(round(seconds * self.frequency)) or None
+        idx = self.slots(frames)
+        seqs = self._seqs[idx]
+        inputs = self.inputs[idx]
+        outputs = self.outputs[idx] if self.outputs is not None else None
+        times = self._times[idx]
+        # Anything rewritten during the copy has a different sequence number
+        # by now, or is still being written.
+        keep = (seqs == self._seqs[idx]) & (seqs >= 0)
+        h = self._header
+        out = RawCapture.create(path, int(h['channels']), int(h['rows']),
+                                max(int(np.sum(keep)), 1), int(h['out_rows']),
+                                self.frequency)
+        for i in np.flatnonzero(keep):
+            out.write(seqs[i], inputs[i],
+                      outputs[i] if outputs is not None else None, times[i])
+        out.flush()
+        return int(np.sum(keep))
+
+    def flush(self):
+        self._mm.flush()
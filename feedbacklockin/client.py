@@ -0,0 +1,524 @@
+'''
+Python clients for the TCP API, with blocking and asyncio flavours.
+
+Both keep one connection open, reconnect by themselves if it drops, and read
+replies through a buffer with exact-length reads, so a reply split over
+several TCP segments is never cut short. Frames are decoded straight into numpy arrays over the
+received bytes (see protocol.py).
+
+    with Client(port=10000) as fbl:
+        frame = fbl.get_frame('X,P')
+        print(frame.seq, frame.fields['X'])
+
+The lockin answers commands in the order they arrive, so several requests
+can be in flight at once. Client.get_frames sends all of its requests before
+reading any reply. AsyncClient matches replies to requests in order, so
+concurrent calls on one AsyncClient are pipelined automatically. ClientPool
+and AsyncClientPool fetch from several lockins in parallel.
+'''
+import asyncio
+import collections
+import concurrent.futures
+import socket
+
+import numpy as np
+
+from feedbacklockin import protocol
+
+
+# The most Client reads from the socket at once into its buffer.
+_CHUNK = 65536
+
+# A decoded frame. fields maps field names to arrays.
+Frame = collections.namedtuple('Frame', ['seq', 'timestamp', 'dropped',
+                                         'fields'])
+
+
+def _frame(header, payload):
+    return Frame(header['seq'], header['timestamp'], header['dropped'],
+                 protocol.unpack_payload(header, payload))
+
+
+def _error(line):
+    # An error line, sent in place of the reply to a command that failed.
+    return ValueError(f'lockin rejected the command: {line[len(protocol.ERROR):]}')
+
+
+def _line(line):
+    if line.startswith(protocol.ERROR.decode('utf-8')):
+        raise _error(line)
+    return line
+
+
+def _fields(fields):
+    if fields is None:
+        return ''
+    if isinstance(fields, int):
+        return str(fields)
+    if isinstance(fields, str):
+        return fields
+    return ','.join(fields)
+
+
+def _vector_command(name, values):
+    values = np.ascontiguousarray(values, dtype='<f8')
+    return (f'{name} binary {len(values)}\n'.encode('utf-8')
+            + values.tobytes())
+
+
+def _gains_command(ki, kp):
+    # Either one ki and kp for every channel, or one of each per channel.
+    if not np.ndim(ki) and not np.ndim(kp):
+        return f'set_gains {ki} {kp}\n'.encode('utf-8')
+    ki, kp = np.broadcast_arrays(np.asarray(ki, dtype=np.float64),
+                                 np.asarray(kp, dtype=np.float64))
+    return _vector_command('set_gains', np.concatenate((ki, kp)))
+
+
+def _identify_command(amplitude, frames, decouple):
+    # '-' keeps the lockin's default.
+    args = ['identify', '-' if amplitude is None else str(amplitude),
+            '-' if frames is None else str(frames)]
+    if decouple:
+        args.append('decouple')
+    return ' '.join(args)
+
+
+def _identify_status(line):
+    state, done, total = line.split()
+    return state, int(done), int(total)
+
+
+class Client(object):
+    """A blocking client for one lockin.
+
+    Give either host and port, or the unix_path of a headless lockin. Each
+    request is retried once on a fresh connection if the old one failed.
+    """
+    def __init__(self, host='localhost', port=None, unix_path=None,
+                 timeout=5.0):
+        self._host = host
+        self._port = port
+        self._unix_path = unix_path
+        self._timeout = timeout
+        self._sock = None
+        # Bytes received but not yet read, and the chunk recv fills.
+        self._buf = bytearray()
+        self._chunk = bytearray(_CHUNK)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        if self._sock is not None:
+            return
+        if self._unix_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self._unix_path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = (self._host, self._port)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._buf = bytearray()
+
+    def send(self, command):
+        """Sends a command that has no reply, e.g. 'set_setpoint 0 0.1'."""
+        self._request(command.encode('utf-8') + b'\n', 0)
+
+    def get_frame(self, fields=None):
+        """Fetches one frame with the given fields (names, a list or mask)."""
+        return self.get_frames([fields])[0]
+
+    def get_frames(self, field_sets):
+        """Fetches one frame per entry of field_sets, all in flight at once."""
+        request = b''.join(f'get_frame {_fields(f)}\n'.encode('utf-8')
+                           for f in field_sets)
+        return self._request(request, len(field_sets))
+
+    def set_setpoints(self, values):
+        self._request(_vector_command('set_setpoints', values), 0)
+
+    def set_amplitudes(self, values):
+        self._request(_vector_command('set_amplitudes', values), 0)
+
+    def set_kis(self, values):
+        """Sets each channel's integral gain (NaN for no change)."""
+        self._request(_vector_command('set_kis', values), 0)
+
+    def set_kps(self, values):
+        self._request(_vector_command('set_kps', values), 0)
+
+    def set_gains(self, ki, kp):
+        """Sets both gains in one frame, each a float or one per channel."""
+        self._request(_gains_command(ki, kp), 0)
+
+    def set_feedback_mask(self, mask):
+        self._request(_vector_command('set_feedback_mask',
+                                      np.asarray(mask, dtype=bool)), 0)
+
+    def batch(self, commands):
+        """Applies the commands in one frame. Returns (applied, failed)."""
+        request = ('batch\n' + ''.join(c + '\n' for c in commands)
+                   + 'end\n').encode('utf-8')
+        line, = self._request(request, 1, 'line')
+        return tuple(int(v) for v in line.split()[1:])
+
+    def protocol_version(self):
+        line, = self._request(b'protocol\n', 1, 'line')
+        return int(line)
+
+    def wait_settled(self, channels='all', tol=1e-3, timeout=10.0):
+        """Waits until the channels settle to within tol, or for timeout s.
+
+        channels is 'all' or a list of channels. Returns whether they settled
+        and the seq of the last frame checked.
+        """
+        if not isinstance(channels, str):
+            channels = ','.join(map(str, channels))
+        line, = self._request(f'wait_settled {channels} {tol} {timeout}\n'
+                              .encode('utf-8'), 1, 'line',
+                              timeout + self._timeout)
+        result, seq = line.split()
+        return result == 'settled', int(seq)
+
+    def derived_names(self):
+        """Names of the derived quantities, in the order of the D field."""
+        line, = self._request(b'derived\n', 1, 'line')
+        return [n for n in line.split(',') if n]
+
+    def identify(self, amplitude=None, frames=None, decouple=False):
+        """Starts measuring the response and setting the gains from it."""
+        self.send(_identify_command(amplitude, frames, decouple))
+
+    def identify_status(self):
+        """Returns (state, frames done, frames needed) of the latest run."""
+        line, = self._request(b'identify_status\n', 1, 'line')
+        return _identify_status(line)
+
+    def subscribe(self, fields=None, decimation=1):
+        """Yields pushed frames forever.
+
+        Use a Client for nothing else once subscribed.
+        """
+        self._send_all(f'subscribe {_fields(fields) or protocol.DEFAULT_MASK}'
+                       f' {decimation}\n'.encode('utf-8'))
+        while True:
+            yield self._read_frame()
+
+    def _request(self, request, replies, kind='frame', timeout=None):
+        # Retry once on a new connection, since the lockin may have been
+        # restarted since the last request. kind is 'frame' or 'line'.
+        read = self._read_frame if kind == 'frame' else self._read_line
+        for attempt in range(2):
+            try:
+                self._send_all(request)
+                if timeout is not None:
+                    self._sock.settimeout(timeout)
+                return [read() for _ in range(replies)]
+            except (ConnectionError, socket.timeout):
+                self.close()
+                if attempt:
+                    raise
+            finally:
+                if self._sock is not None:
+                    self._sock.settimeout(self._timeout)
+
+    def _send_all(self, data):
+        self.connect()
+        self._sock.sendall(data)
+
+    def _fill(self):
+        read = self._sock.recv_into(self._chunk)
+        if read == 0:
+            raise ConnectionError('the lockin closed the connection')
+        self._buf += memoryview(self._chunk)[:read]
+
+    def _read_exact(self, n):
+        if n > len(self._buf) + _CHUNK:
+            # A large payload is received straight into its own buffer.
+            buf = bytearray(n)
+            view = memoryview(buf)
+            got = len(self._buf)
+            view[:got] = self._buf
+            self._buf = bytearray()
+            while got < n:
+                read = self._sock.recv_into(view[got:], n - got)
+                if read == 0:
+                    raise ConnectionError('the lockin closed the connection')
+                got += read
+            return buf
+        while len(self._buf) < n:
+            self._fill()
+        data = self._buf[:n]
+        del self._buf[:n]
+        return data
+
+    def _read_line(self, start=b''):
+        searched = 0
+        while True:
+            end = self._buf.find(b'\n', searched)
+            if end >= 0:
+                break
+            searched = len(self._buf)
+            self._fill()
+        line = bytes(start) + self._buf[:end + 1]
+        del self._buf[:end + 1]
+        return _line(line.decode('utf-8').strip())
+
+    def _read_frame(self):
+        magic = bytes(self._read_exact(len(protocol.MAGIC)))
+        if protocol.ERROR.startswith(magic):
+            # An error line rather than a frame, which raises.
+            self._read_line(magic)
+        header = protocol.unpack_header(
+                magic + self._read_exact(protocol.HEADER.size - len(magic)))
+        return _frame(header, self._read_exact(header['length']))
+
+
+class AsyncClient(object):
+    """An asyncio client for one lockin.
+
+    Calls may be made concurrently. Requests are written straight away and
+    their replies are handed back in order by a single reader task. If the
+    connection drops, each request still waiting is retried once on a new
+    connection, and raises ConnectionError if that fails too.
+    """
+    def __init__(self, host='localhost', port=None, unix_path=None):
+        self._host = host
+        self._port = port
+        self._unix_path = unix_path
+        self._reader = None
+        self._writer = None
+        self._pending = collections.deque()
+        self._reader_task = None
+        self._connecting = None
+        self._wakeup = asyncio.Event()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        # Concurrent callers share one connection attempt.
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            self._connecting = None
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(ConnectionError('connection closed'))
+
+    async def send(self, command):
+        await self._write(command.encode('utf-8') + b'\n')
+
+    async def get_frame(self, fields=None):
+        return await self._ask(f'get_frame {_fields(fields)}\n'
+                               .encode('utf-8'), 'frame')
+
+    async def get_frames(self, field_sets):
+        return await asyncio.gather(*(self.get_frame(f) for f in field_sets))
+
+    async def set_setpoints(self, values):
+        await self._write(_vector_command('set_setpoints', values))
+
+    async def set_amplitudes(self, values):
+        await self._write(_vector_command('set_amplitudes', values))
+
+    async def set_kis(self, values):
+        await self._write(_vector_command('set_kis', values))
+
+    async def set_kps(self, values):
+        await self._write(_vector_command('set_kps', values))
+
+    async def set_gains(self, ki, kp):
+        await self._write(_gains_command(ki, kp))
+
+    async def set_feedback_mask(self, mask):
+        await self._write(_vector_command('set_feedback_mask',
+                                          np.asarray(mask, dtype=bool)))
+
+    async def batch(self, commands):
+        request = ('batch\n' + ''.join(c + '\n' for c in commands)
+                   + 'end\n').encode('utf-8')
+        line = await self._ask(request, 'line')
+        return tuple(int(v) for v in line.split()[1:])
+
+    async def protocol_version(self):
+        return int(await self._ask(b'protocol\n', 'line'))
+
+    async def wait_settled(self, channels='all', tol=1e-3, timeout=10.0):
+        if not isinstance(channels, str):
+            channels = ','.join(map(str, channels))
+        line = await self._ask(f'wait_settled {channels} {tol} {timeout}\n'
+                               .encode('utf-8'), 'line')
+        result, seq = line.split()
+        return result == 'settled', int(seq)
+
+    async def derived_names(self):
+        line = await self._ask(b'derived\n', 'line')
+        return [n for n in line.split(',') if n]
+
+    async def identify(self, amplitude=None, frames=None, decouple=False):
+        await self.send(_identify_command(amplitude, frames, decouple))
+
+    async def identify_status(self):
+        return _identify_status(await self._ask(b'identify_status\n', 'line'))
+
+    async def _open(self):
+        if self._unix_path is not None:
+            reader, writer = await asyncio.open_unix_connection(
+                    self._unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(self._host,
+                                                           self._port)
+        self._reader, self._writer = reader, writer
+        self._reader_task = asyncio.ensure_future(self._read_replies(reader))
+
+    async def _write(self, data):
+        for attempt in range(2):
+            try:
+                await self.connect()
+                self._writer.write(data)
+                await self._writer.drain()
+                return
+            except ConnectionError:
+                await self.close()
+                if attempt:
+                    raise
+
+    async def _ask(self, request, kind):
+        # Retry once on a new connection, as Client does.
+        for attempt in range(2):
+            future = asyncio.get_running_loop().create_future()
+            await self.connect()
+            writer = self._writer
+            # Queue the reply before writing, so the reader can't miss it.
+            self._pending.append((kind, future))
+            self._wakeup.set()
+            try:
+                writer.write(request)
+                await writer.drain()
+                return await future
+            except ConnectionError:
+                # Other requests may have reconnected already.
+                if self._writer is writer:
+                    await self.close()
+                if attempt:
+                    raise
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                if not self._pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                kind, future = self._pending[0]
+                start = b''
+                if kind == 'frame':
+                    start = await reader.readexactly(len(protocol.MAGIC))
+                if protocol.ERROR.startswith(start):
+                    line = start + await reader.readline()
+                    if not line.endswith(b'\n'):
+                        raise ConnectionError(
+                                'the lockin closed the connection')
+                    reply = line.decode('utf-8').strip()
+                else:
+                    rest = await reader.readexactly(protocol.HEADER.size
+                                                    - len(start))
+                    header = protocol.unpack_header(start + rest)
+                    reply = _frame(header,
+                                   await reader.readexactly(header['length']))
+                self._pending.popleft()
+                if future.done():
+                    continue
+                try:
+                    future.set_result(_line(reply) if isinstance(reply, str)
+                                      else reply)
+                except ValueError as e:
+                    future.set_exception(e)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self._writer = None
+            self._reader_task = None
+            self._fail_pending(ConnectionError(str(e)))
+
+    def _fail_pending(self, exc):
+        while self._pending:
+            _, future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+
+class ClientPool(object):
+    """Blocking clients for several lockins, fetched from in parallel.
+
+    addresses is a dict of name to Client keyword arguments, e.g.
+    {'fridge': dict(port=10000), 'vti': dict(host='rack2', port=10000)}.
+    """
+    def __init__(self, addresses):
+        self._clients = {name: Client(**kw) for name, kw in addresses.items()}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max(len(self._clients), 1))
+
+    def __getitem__(self, name):
+        return self._clients[name]
+
+    def get_frames(self, fields=None):
+        """Returns a dict of name to the latest frame of each lockin."""
+        futures = {name: self._executor.submit(c.get_frame, fields)
+                   for name, c in self._clients.items()}
+        return {name: f.result() for name, f in futures.items()}
+
+    def close(self):
+        for c in self._clients.values():
+            c.close()
+        self._executor.shutdown()
+
+
+class AsyncClientPool(object):
+    """AsyncClients for several lockins, as for ClientPool."""
+    def __init__(self, addresses):
+        self._clients = {name: AsyncClient(**kw)
+                         for name, kw in addresses.items()}
+
+    def __getitem__(self, name):
+        return self._clients[name]
+
+    async def get_frames(self, fields=None):
+        names = list(self._clients)
+        frames = await asyncio.gather(*(self._clients[n].get_frame(fields)
+                                        for n in names))
+        return dict(zip(names, frames))
+
+    async def close(self):
+        for c in self._clients.values():
+            await c.close()
@@ -0,0 +1,153 @@
+'''
+Builds the lockin, its DAQ and its engine from the settings in a config ini.
+
+This is shared by the GUI and the headless server, so it must not import Qt.
+settings can be a QSettings, or an IniSettings where Qt isn't available.
+Both are read with value('SECTION/key', default).
+'''
+import configparser
+
+import numpy as np
+
+from feedbacklockin import capture
+from feedbacklockin import derived
+from feedbacklockin import engine
+from feedbacklockin import fbl
+from feedbacklockin import recorder
+from feedbacklockin import shm
+
+
+class IniSettings(object):
+    """Reads a config ini through the same value() call as QSettings."""
+    def __init__(self, filename):
+        self._parser = configparser.ConfigParser()
+        self._parser.optionxform = str
+        self._parser.read(filename)
+
+    def value(self, key, default=None):
+        section, _, name = key.partition('/')
+        return self._parser.get(section, name, fallback=default)
+
+
+def _flag(settings, key, default):
+    return str(settings.value(key, default)).lower() == 'true'
+
+
+def _list(value):
+    # QSettings already splits comma-separated values, configparser doesn't.
+    if isinstance(value, list):
+        return value
+    return [v for v in str(value).split(',') if v]
+
+
+class Setup(object):
+    """Everything built from one config: the lockin, DAQ and engine.
+
+    The engine is not started. Until it is, the lockin can be changed
+    directly, and afterwards only through engine.submit.
+    """
+    def __init__(self, settings):
+        self.channels = int(settings.value('DAQ/channels', 8))
+        self.frequency = float(settings.value('FBL/frequency', 17.76))
+        points = int(settings.value('FBL/points', 0))
+        max_rate = int(settings.value('FBL/max_rate', 10000))
+        # Number of X/Y updates per period. Each one demodulates over the
+        # last period, sliding along by points / hops.
+        hops = int(settings.value('FBL/hops', 1))
+        if points == 0:
+            self.points = int(max_rate / self.frequency * 0.099) * 10
+            self.points -= self.points % hops
+        else:
+            self.points = points
+        harmonics = _list(settings.value('FBL/harmonics', '1'))
+        # Per-channel frequencies in whole cycles per period. 'auto' gives
+        # channel i i + 1 cycles.
+        cycles = settings.value('FBL/cycles', '')
+        if cycles == 'auto':
+            cycles = list(range(1, self.channels + 1))
+        elif cycles:
+            cycles = [int(c) for c in _list(cycles)]
+        else:
+            cycles = None
+        self.lockin = fbl.FeedbackLockin(self.channels, self.points,
+                [int(h) for h in harmonics], cycles, self.points // hops)
+        self.lockin.update_k(float(settings.value('FBL/ki', 0.01)),
+                             float(settings.value('FBL/kp', 0.0)))
+        self.lockin.update_averaging(int(settings.value('FBL/averaging', 1)))
+        # The most feedback may move an output per frame (0 for no limit),
+        # and the anti-windup gain.
+        self.lockin.update_slew(float(settings.value('FBL/slew', 0.0)),
+                                float(settings.value('FBL/tracking', 1.0)))
+        # A channel counts as locked once its error and drift over the last
+        # settle_window frames are both below settle_tol.
+        self.lockin.update_settle(int(settings.value('FBL/settle_window', 10)),
+                                  float(settings.value('FBL/settle_tol', 1e-3)))
+        # Defaults of the identify command: the perturbation in volts, and
+        # the frames feedback should then settle a step in.
+        self.lockin.identify_amplitude = float(
+                settings.value('FBL/identify_amplitude', 0.01))
+        self.lockin.identify_frames = int(
+                settings.value('FBL/identify_frames', 10))
+        # Decouple feedback with a measured (inputs) x (outputs) response,
+        # saved with np.savetxt or np.save.
+        response = settings.value('FBL/response_file', '')
+        if response:
+            load = np.load if response.endswith('.npy') else np.loadtxt
+            self.lockin.set_response(load(response), float(
+                    settings.value('FBL/max_condition', 1e3)))
+        # Derived quantities, listed by name in DERIVED/quantities and each
+        # given as a spec under its own name, e.g. Rxx = R 0 1e4 2 1e5 470.
+        for name in _list(settings.value('DERIVED/quantities', '')):
+            name = name.strip()
+            self.lockin.define_derived(name, derived.parse(
+                    settings.value(f'DERIVED/{name}', ''), self.channels))
+
+        if _flag(settings, 'DAQ/dummy', 'true'):
+            from feedbacklockin.dummy_daq import Daq
+        else:
+            from feedbacklockin.daq import Daq
+        self.daq = Daq(self.channels, self.points)
+        self.daq.set_hop(self.lockin.hop)
+
+        ics = ','.join(_list(settings.value('DAQ/input_channels', '')))
+        ocs = ','.join(_list(settings.value('DAQ/output_channels', '')))
+        self.daq.set_channels(ics, ocs)
+
+        oc = settings.value('DAQ/output_clock', '')
+        occhan = settings.value('DAQ/output_clock_channel', '')
+        icchan = settings.value('DAQ/input_clock_channel', '')
+        self.daq.set_clocks(oc, occhan, icchan)
+
+        self.daq.set_frequency(self.frequency)
+        self.daq.init_daq()
+
+        self.recorder = recorder.Recorder(
+                settings.value('REC/directory', 'recordings'), self.channels,
+                rotate_bytes=int(float(settings.value('REC/rotate_mb', 1024))
+                                 * 2**20),
+                rotate_seconds=float(settings.value('REC/rotate_minutes', 60))
+                               * 60)
+        # Optionally keep the last few seconds of raw blocks in a ring file.
+        self.capture = None
+        self.dump_seconds = float(settings.value('CAP/dump_seconds', 10))
+        if _flag(settings, 'CAP/enabled', 'false'):
+            rate = self.frequency * self.points / self.lockin.hop
+            frames = int(float(settings.value('CAP/seconds', 60)) * rate)
+            outputs = _flag(settings, 'CAP/outputs', 'false')
+            self.capture = capture.RawCapture.create(
+                    settings.value('CAP/path', 'capture.ring'),
+                    self.channels, self.lockin.hop, max(frames, 1),
+                    self.points if outputs else 0, rate)
+
+        # Optionally publish frames to shared memory for local readers.
+        self.shared = None
+        if _flag(settings, 'SHM/enabled', 'false'):
+            raw = _flag(settings, 'SHM/raw', 'false')
+            self.shared = shm.SharedFrames(
+                    settings.value('SHM/name', 'feedbacklockin'),
+                    self.channels, int(settings.value('SHM/frames', 64)),
+                    self.lockin.hop if raw else 0,
+                    _flag(settings, 'SHM/replace', 'false'))
+
+        self.engine = engine.Engine(self.daq, self.lockin, self.recorder,
+                                    self.capture, self.shared)
@@ -15,19 +15,33 @@ import time
 
 import numpy as np
 import PyDAQmx as mx
-from PySide2.QtCore import *
 
 
-class Daq(QObject):
-
-    data_ready = Signal()
+class Daq(object):
 
     def __init__(self, channels, points):
-        QObject.__init__(self)
         self._channels = channels
         self._points = points
+        self._hop = points
         self.data = np.zeros((self._points, self._channels))
         self.dataOut = np.zeros((self._points, self._channels))
+        # Cues are counted rather than flagged, so that wait_for_data can
+        # tell how far behind it is. Every block read is numbered, and the
+        # engine gets the latest one with its number, so a gap shows which
+        # blocks it missed.
+        self._ready = threading.Condition()
+        self._cues = 0
+        self._taken = 0
+        self._cued = lambda: self._cues > self._taken
+        self._blocks = 0
+        self._block = -1
+        self._input = self.dataOut
+        self._input_block = -1
+
+    def set_hop(self, hop):
+        # Inputs are handed over in chunks of hop points instead of whole
+        # periods. Outputs are still written a whole period at a time.
+        self._hop = hop
 
     def set_clocks(self, oc, occhan, icchan):
         self.outputClock = oc
@@ -49,10 +63,22 @@ class Daq(QObject):
         self.written = c_int32()
 
         self.data = np.zeros((self._points, self._channels), dtype=np.float64)
-
-        self.dataOut = np.zeros((self._points, self._channels), dtype=np.float64)
-        self.tempData = np.zeros(self._points * (self._channels + 1),
+        # set_output fills the spare buffer and swaps it in, and the write
+        # thread transposes into its own buffer, so neither allocates.
+        self._spare_data = np.zeros_like(self.data)
+        self._write_buf = np.zeros((self._channels, self._points),
                 dtype=np.float64)
+
+        # The read thread fills these in turn, so a block handed to the engine
+        # is left alone for a whole period after the next one arrives, not
+        # just for one hop.
+        self._read_bufs = [np.zeros(self._hop * (self._channels + 1),
+                dtype=np.float64) for _ in range(self._points // self._hop + 1)]
+        self._read_blocks = [np.reshape(b[self._hop:],
+                (self._hop, self._channels), order='F')
+                for b in self._read_bufs]
+        self.dataOut = self._read_blocks[-1]
+        self._input = self.dataOut
         try:
             # DAQmx Configure Code, Output
             mx.DAQmxConnectTerms(self.outputClock,
@@ -94,21 +120,41 @@ class Daq(QObject):
         ReadThread.daemon = True
         ReadThread.start()
 
+    def wait_for_data(self, timeout=None):
+        # Blocks until the write thread has handed a full period to the card,
+        # or with hops until the next chunk is read, which is the cue to
+        # update the outputs and read the inputs. Returns False if nothing
+        # happened within timeout seconds.
+        with self._ready:
+            if not self._ready.wait_for(self._cued, timeout):
+                return False
+            self._taken = self._cues
+            self._input = self.dataOut
+            self._input_block = self._block
+        return True
     def set_output(self,data):
-        self.data = data.astype(np.float64)
+        spare = self._spare_data
+        np.copyto(spare, data)
+        self._spare_data = self.data
+        self.data = spare
 
     def get_input(self):
-        return self.dataOut
+        return self._input
+
+    def get_input_seq(self):
+        # The number of the block get_input returns, counting from 0.
+        return self._input_block
 
     def runWriteThread(self):
         # infinite loop writing sinewave to buffer everytime the buffer is emptied
         while True:
             try:
-                d1 = np.reshape(self.data.T, (self._channels * self._points, 1))
+                np.copyto(self._write_buf, self.data.T)
                 mx.DAQmxWriteAnalogF64(self.outputTaskHandle, self._points,
                         True, 10.0, mx.DAQmx_Val_GroupByChannel,
-                        d1,byref(self.written), None)
-                self.data_ready.emit()
+                        self._write_buf, byref(self.written), None)
+                if self._hop == self._points:
+                    self._cue()
             except:
                 print("failed to write to DAQ")
 
@@ -116,11 +162,22 @@ class Daq(QObject):
         # infinite loop reading sinewave and updating the dataOut variable
         while True:
             try:
-                mx.DAQmxReadAnalogF64(self.inputTaskHandle, self._points, 10.0,
-                        mx.DAQmx_Val_GroupByChannel, self.tempData,
-                        self._points * (self._channels + 1), byref(self.read),
+                slot = self._blocks % len(self._read_bufs)
+                mx.DAQmxReadAnalogF64(self.inputTaskHandle, self._hop, 10.0,
+                        mx.DAQmx_Val_GroupByChannel, self._read_bufs[slot],
+                        self._hop * (self._channels + 1), byref(self.read),
                         None)
-                self.dataOut = np.reshape(self.tempData[self._points:],
-                        (self._points, self._channels), order='F')
+                with self._ready:
+                    self.dataOut = self._read_blocks[slot]
+                    self._block = self._blocks
+                self._blocks += 1
+                # With sub-period chunks, every chunk read is a frame.
+                if self._hop != self._points:
+                    self._cue()
             except:
                 print("failed to read from DAQ")
+
+    def _cue(self):
+        with self._ready:
+            self._cues += 1
+            self._ready.notify()
@@ -0,0 +1,175 @@
+'''
+Quantities derived from the demodulated inputs every frame: voltages,
+currents, resistances, phases and temperatures.
+
+Each quantity is declared with a short spec, in the config ini or over TCP.
+Channels are input channels, and gains are the preamplifier gains in front
+of them. R2GND is the resistor to ground that a current is measured across.
+
+    V A GAIN_A [B GAIN_B]                     voltage, A - B if B is given
+    I CH GAIN R2GND                           current
+    R A GAIN_A [B GAIN_B] I GAIN_I R2GND      resistance, (A - B) / I
+    phase A GAIN_A [B GAIN_B] [I GAIN_I R2GND]
+                                              phase in degrees of A - B,
+                                              relative to I if given
+    T R_NAME CALFILE [linear|cubic]           temperature of the resistance
+                                              R_NAME, see calibration.py
+
+Like the qcodes meta-instruments, V, I and R use the in-phase parts (X) of
+the inputs. Every quantity has the form (A / GAIN_A - B / GAIN_B) / (I /
+GAIN_I / R2GND), with missing terms standing for 0 or 1, so all of them are
+worked out together with a handful of vectorised operations per frame.
+'''
+import collections
+
+import numpy as np
+
+from feedbacklockin.calibration import Calibration, CalibrationSet
+
+
+# A parsed spec. a, b and i are input channels, or None where a term is
+# missing. The scales multiply the inputs, so they are 1 / gain (and 1 /
+# (gain * R2GND) for currents). For temperatures, source names the
+# resistance and calibration is its Calibration.
+Quantity = collections.namedtuple('Quantity', [
+    'kind', 'a', 'scale_a', 'b', 'scale_b', 'i', 'scale_i', 'source',
+    'calibration'])
+
+# Argument counts allowed for each kind, apart from T.
+_ARGS = {'V': (2, 4), 'I': (3,), 'R': (5, 7), 'phase': (2, 4, 5, 7)}
+
+
+def _channel(text, channels):
+    chan = int(text)
+    if not 0 <= chan < channels:
+        raise ValueError(f'no input channel {chan}')
+    return chan
+
+
+def parse(spec, channels):
+    """Parses a quantity spec such as 'R 0 1e4 1 1e5 2 1e5 470'."""
+    words = spec.split()
+    if not words:
+        raise ValueError('empty quantity')
+    kind, args = words[0], words[1:]
+    if kind == 'T':
+        if len(args) not in (2, 3):
+            raise ValueError('T needs a resistance and a calibration file')
+        try:
+            cal = Calibration.load(args[1], *args[2:])
+        except OSError as e:
+            raise ValueError(f"can't load calibration {args[1]}: "
+                             f'{e.strerror or e}')
+        return Quantity('T', None, 0.0, None, 0.0, None, 1.0, args[0], cal)
+    if kind not in _ARGS:
+        raise ValueError(f'unknown quantity {kind}')
+    if len(args) not in _ARGS[kind]:
+        raise ValueError(f'{kind} takes {" or ".join(map(str, _ARGS[kind]))}'
+                         ' arguments')
+    a = _channel(args[0], channels)
+    scale_a = 1 / float(args[1])
+    b, scale_b = None, 0.0
+    i, scale_i = None, 1.0
+    if kind == 'I':
+        scale_a /= float(args[2])
+    elif len(args) in (4, 7):
+        b = _channel(args[2], channels)
+        scale_b = 1 / float(args[3])
+    if len(args) in (5, 7):
+        i = _channel(args[-3], channels)
+        scale_i = 1 / (float(args[-2]) * float(args[-1]))
+    return Quantity(kind, a, scale_a, b, scale_b, i, scale_i, None, None)
+
+
+class DerivedQuantities(object):
+    """The declared quantities of one lockin and their latest values."""
+    def __init__(self, channels):
+        self._channels = channels
+        self._quantities = collections.OrderedDict()
+        # The inputs as complex numbers, then a 0 and a 1 that missing
+        # terms point at.
+        self._z = np.zeros(channels + 2, dtype=np.complex128)
+        self._z[-1] = 1.0
+        self._compile()
+
+    @property
+    def names(self):
+        # Kept as a tuple, since other threads read it.
+        return self._names
+
+    def define(self, name, quantity):
+        """Adds the quantity, or replaces the one of the same name."""
+        if quantity.kind == 'T':
+            source = self._quantities.get(quantity.source)
+            if source is None or source.kind != 'R':
+                raise ValueError(f'{quantity.source} is not a resistance')
+        elif (name in self._quantities and quantity.kind != 'R'
+              and self._dependents(name)):
+            raise ValueError(f'{name} is used by a temperature')
+        self._quantities[name] = quantity
+        self._compile()
+
+    def remove(self, name):
+        if name not in self._quantities:
+            raise ValueError(f'no quantity {name}')
+        if self._dependents(name):
+            raise ValueError(f'{name} is used by a temperature')
+        del self._quantities[name]
+        self._compile()
+
+    def step(self, X, Y):
+        """Works out every quantity from the inputs' X and Y."""
+        z = self._z
+        np.copyto(z.real[:-2], X)
+        np.copyto(z.imag[:-2], Y)
+        num, den, tmp = self._num, self._den, self._tmp
+        np.take(z, self._a, out=num)
+        num *= self._scale_a
+        np.take(z, self._b, out=tmp)
+        tmp *= self._scale_b
+        num -= tmp
+        np.take(z, self._i, out=den)
+        den *= self._scale_i
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(num.real, den.real, out=self.values)
+            np.divide(num, den, out=num)
+        np.arctan2(num.imag, num.real, out=self._phase)
+        np.degrees(self._phase, out=self._phase)
+        np.copyto(self.values, self._phase, where=self._is_phase)
+        if len(self._t):
+            self.values[self._t] = self._calibrations(
+                    self.values[self._t_source])
+        return self.values
+
+    def _dependents(self, name):
+        return [n for n, q in self._quantities.items()
+                if q.kind == 'T' and q.source == name]
+
+    def _compile(self):
+        # Lays the quantities out as index and scale arrays for step.
+        qs = list(self._quantities.values())
+        names = list(self._quantities)
+        zero, one = self._channels, self._channels + 1
+        self._a = np.array([zero if q.a is None else q.a for q in qs],
+                           dtype=np.intp)
+        self._b = np.array([zero if q.b is None else q.b for q in qs],
+                           dtype=np.intp)
+        self._i = np.array([one if q.i is None else q.i for q in qs],
+                           dtype=np.intp)
+        self._scale_a = np.array([q.scale_a for q in qs], dtype=np.float64)
+        self._scale_b = np.array([q.scale_b for q in qs], dtype=np.float64)
+        self._scale_i = np.array([q.scale_i for q in qs], dtype=np.float64)
+        self._is_phase = np.array([q.kind == 'phase' for q in qs], dtype=bool)
+        self._t = np.array([n for n, q in enumerate(qs) if q.kind == 'T'],
+                           dtype=np.intp)
+        self._t_source = np.array([names.index(q.source) for q in qs
+                                   if q.kind == 'T'], dtype=np.intp)
+        if len(self._t):
+            self._calibrations = CalibrationSet([q.calibration for q in qs
+                                                 if q.kind == 'T'])
+        self._num = np.zeros(len(qs), dtype=np.complex128)
+        self._den = np.zeros(len(qs), dtype=np.complex128)
+        self._tmp = np.zeros(len(qs), dtype=np.complex128)
+        self._phase = np.zeros(len(qs))
+        self.values = np.full(len(qs), np.nan)
+        self._names = tuple(names)
@@ -3,6 +3,23 @@ that it takes in an input and produces an output everytime "step" is called;
 there is no explicit timebase. It can operate on an arbitrary number of
 channels in parallel and can disable specific outputs. It also can be set to
 take one of its inputs as an offset reference.
+
+Every channel has its own gains. The outputs are held within limits, and
+optionally to a maximum change per step. Whatever the outputs could not do
+is taken back off the integrator (back-calculation), scaled by the tracking
+gain, so it does not wind up while an output is stuck at a limit and
+recovers as soon as the error changes sign. If what is actually output is a
+transform of the PI outputs, such as a BiasResistor, set it as the output
+transform, and the limits then apply past it, where the outputs really
+saturate.
+
+By default every channel is treated as independent. Given the measured
+response of the inputs to the outputs, it can instead decouple them: the
+errors are multiplied by the pseudo-inverse of the response between the
+enabled channels, so every output moves by what is needed to fix all of the
+errors together, and coupled channels settle in a few steps rather than
+fighting each other. If that part of the response is ill-conditioned, it
+falls back to independent channels.
 '''
 import numpy as np
 
@@ -12,17 +29,83 @@ class DiscretePI(object):
         self._channels = channels
 
         self._errs = np.zeros(channels)
+        self._err = np.zeros(channels)
+        self._out = np.zeros(channels)
+        self._sat = np.zeros(channels)
+        self._last = np.zeros(channels)
+        self._tmp = np.zeros(channels)
         self._set_points = np.zeros(channels)
-        self._ki = 0.0
-        self._kp = 0.0
+        self._ki = np.zeros(channels)
+        self._kp = np.zeros(channels)
+        self._low = -np.inf
+        self._high = np.inf
+        self._slew = None
+        self._tracking = 1.0
+        self._transform = None
         self._enabled_outputs = np.zeros(channels, dtype=bool)
         self._input_reference = None
+        self._response = None
+        self._max_condition = 1e3
+        # The decoupling gain matrix, or None while channels are independent.
+        self._decouple = None
+        self._decoupled = np.zeros(channels)
+
+    @property
+    def errors(self):
+        # The errors of the last step, reused by the next one.
+        return self._err
+
+    @property
+    def decoupling(self):
+        """Whether the outputs are being decoupled."""
+        return self._decouple is not None
+
+    def set_response(self, response, max_condition=1e3):
+        """Sets the (inputs) x (outputs) response matrix to decouple with.
+
+        response[i, j] is the change of input i per unit change of output j,
+        as seen by step. None goes back to independent channels.
+        """
+        self._response = response
+        self._max_condition = max_condition
+        self._update_decoupling()
+
+    @property
+    def ki(self):
+        return self._ki
+
+    @property
+    def kp(self):
+        return self._kp
 
     def set_ki(self, ki):
-        self._ki = ki
+        # One gain for every channel, or one per channel. NaN leaves a
+        # channel as is.
+        np.copyto(self._ki, ki, where=~np.isnan(ki))
 
     def set_kp(self, kp):
-        self._kp = kp
+        np.copyto(self._kp, kp, where=~np.isnan(kp))
+
+    def set_limits(self, low, high):
+        # Outputs, and the integrator, are held between low and high.
+        self._low = low
+        self._high = high
+
+    def set_output_transform(self, transform):
+        # An object like BiasResistor, or None. Its step maps the PI outputs
+        # to what is output, into a buffer it owns, and its reverse maps
+        # that buffer back once it has been limited.
+        self._transform = transform
+
+    def set_slew(self, slew):
+        # The most an output may change per step, or None for no limit.
+        self._slew = slew if slew else None
+
+    def set_tracking(self, tracking):
+        # The fraction of what the outputs could not do that is taken off
+        # the integrator every step. 1 puts it right back at the limit, and
+        # 0 turns anti-windup off.
+        self._tracking = tracking
 
     def set_reference(self, channel):
         # Sets the index of the channel being used as a reference.
@@ -32,25 +115,104 @@ class DiscretePI(object):
     def set_setpoint(self, value, channel):
         self._set_points[channel] = value
 
+    def set_setpoints(self, values):
+        # Sets every channel's setpoint at once. NaN leaves a channel as is.
+        np.copyto(self._set_points, values, where=~np.isnan(values))
+
     def step(self, inputs):
-        """Performs one step of the PI loop."""
-        if self._input_reference is not None:
-            inputs = inputs - inputs[self._input_reference]
+        """Performs one step of the PI loop.
 
+        The returned array is reused by the next call to step.
+        """
         # Calculate errors.
-        err = self._set_points - inputs
-        self._errs += err * self._ki
+        err = self._err
+        np.subtract(self._set_points, inputs, out=err)
+        if self._input_reference is not None:
+            err += inputs[self._input_reference]
+
+        out = self._out
+        np.multiply(err, self._ki, out=out)
+        self._errs += self._decoupled_errors(out)
+        if self._transform is None:
+            np.clip(self._errs, self._low, self._high, out=self._errs)
+        else:
+            limited = self._transform.step(self._errs)
+            np.clip(limited, self._low, self._high, out=limited)
+            np.copyto(self._errs, self._transform.reverse())
+
+        np.multiply(err, self._kp, out=out)
+        np.copyto(out, self._decoupled_errors(out))
+        out += self._errs
+
+        # What the outputs can actually do, past any transform.
+        if self._transform is None:
+            limited = self._sat
+            np.copyto(limited, out)
+        else:
+            limited = self._transform.step(out)
+        np.clip(limited, self._low, self._high, out=limited)
+        if self._slew is not None:
+            np.subtract(self._last, self._slew, out=self._tmp)
+            np.maximum(limited, self._tmp, out=limited)
+            np.add(self._last, self._slew, out=self._tmp)
+            np.minimum(limited, self._tmp, out=limited)
+        np.copyto(self._last, limited, where=self._enabled_outputs)
+        sat = self._sat
+        if self._transform is not None:
+            np.copyto(sat, self._transform.reverse())
+
+        # Back-calculation: take what the outputs couldn't do back off the
+        # integrator.
+        np.subtract(sat, out, out=out)
+        out *= self._tracking
+        self._errs += out
 
         # Maintains zeroed out error if channels are disabled.
-        self._errs = np.multiply(self._errs, self._enabled_outputs)
+        np.multiply(self._errs, self._enabled_outputs, out=self._errs)
+        return sat
 
-        return err * self._kp + self._errs
+    def _decoupled_errors(self, errs):
+        # One matrix-vector product that turns the errors into the output
+        # changes that cancel them all together.
+        if self._decouple is None:
+            return errs
+        np.dot(self._decouple, errs, out=self._decoupled)
+        return self._decoupled
+
+    def _update_decoupling(self):
+        # Only the enabled channels are inverted, since the others keep
+        # their outputs whatever the errors.
+        self._decouple = None
+        chans = np.flatnonzero(self._enabled_outputs)
+        if self._response is None or not len(chans):
+            return
+        sub = self._response[np.ix_(chans, chans)]
+        u, sv, vt = np.linalg.svd(sub)
+        if sv[-1] == 0 or sv[0] / sv[-1] > self._max_condition:
+            print('Response is ill-conditioned, not decoupling')
+            return
+        decouple = np.zeros((self._channels, self._channels))
+        decouple[np.ix_(chans, chans)] = (vt.T / sv) @ u.T
+        self._decouple = decouple
 
     def zero_errors(self, errors=None):
         # Resets integral errors to assume the proportional error is zero.
         # This is valuable if you discontinuously change the physical
         # system and want let it smoothly find a new equilibrium.
-        self._errs = errors
+        if errors is None:
+            self._errs.fill(0.0)
+        else:
+            np.copyto(self._errs, errors)
+            # The outputs are there now, so slew from them.
+            if self._transform is None:
+                np.copyto(self._last, errors)
+            else:
+                np.copyto(self._last, self._transform.step(errors))
 
     def set_output_enabled(self, channel, enabled):
         self._enabled_outputs[channel] = enabled
+        self._update_decoupling()
+
+    def set_outputs_enabled(self, enabled):
+        np.copyto(self._enabled_outputs, enabled)
+        self._update_decoupling()
@@ -6,17 +6,13 @@ keep this interface in line with the real DAQ card interface.
 import time
 
 import numpy as np
-from PySide2.QtCore import *
 
 from feedbacklockin.tmm import TransferMatrixModel
 
 
-class Daq(QObject):
-
-    data_ready = Signal()
+class Daq(object):
 
     def __init__(self, channels, points):
-        QObject.__init__(self)
         self._channels = channels
         self._points = points
         self._data = np.zeros(points)
@@ -31,11 +27,18 @@ class Daq(QObject):
         self._rolls = np.random.randint(-points / 100, points / 100,
                                         size=channels)
 
-        self._timer = QTimer()
-        self._timer.setTimerType(Qt.PreciseTimer)
-        # In a real DAQ card we need to do some processing when the timer
-        # fires, but here we do not.
-        self._timer.timeout.connect(self.data_ready)
+        self._hop = points
+        # Chunks read since the start, and the period last simulated.
+        self._seq = -1
+        self._period = -1
+        self._block = np.zeros((points, channels))
+
+        self._running = False
+        self._next_frame = 0.0
+
+    def set_hop(self, hop):
+        # Inputs are handed over in chunks of hop points.
+        self._hop = hop
 
     def set_frequency(self, freq):
         self._frequency = freq
@@ -50,7 +53,27 @@ class Daq(QObject):
         pass
 
     def stop(self):
-        self._timer.stop()
+        self._running = False
+
+    def wait_for_data(self, timeout=None):
+        """Sleep until the next chunk would have been read in."""
+        if not self._running:
+            time.sleep(timeout or 0)
+            return False
+        delay = self._next_frame - time.perf_counter()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        # Like a real card, skip chunks we were too slow to pick up rather
+        # than delivering a burst of them. They are still counted, so the
+        # engine can tell.
+        late = max(int((time.perf_counter() - self._next_frame)
+                       // self._interval), 0)
+        self._seq += 1 + late
+        self._next_frame += (1 + late) * self._interval
+        return True
 
     def set_output(self, data):
         """In a real DAQ, this would output data."""
@@ -58,6 +81,20 @@ class Daq(QObject):
 
     def get_input(self):
         """In a real DAQ, this would read data."""
+        # A whole period is simulated at the start of each one, and handed
+        # out a chunk at a time.
+        period, chunk = divmod(self._seq, self._points // self._hop)
+        if period != self._period:
+            self._block = self._simulate()
+            self._period = period
+        start = chunk * self._hop
+        return self._block[start:start + self._hop]
+
+    def get_input_seq(self):
+        """The number of the chunk get_input returns, counting from 0."""
+        return self._seq
+
+    def _simulate(self):
         xfer = self._tmat.xfer(self._data.T)
         rand = np.random.randn(self._channels, self._points)
         out = (xfer + (rand - 0.5) * 0.2)
@@ -67,4 +104,8 @@ class Daq(QObject):
         return out.T
 
     def start(self):
-        self._timer.start(1000.0 / self._frequency)
+        self._interval = self._hop / (self._frequency * self._points)
+        self._seq = -1
+        self._period = -1
+        self._next_frame = time.perf_counter() + self._interval
+        self._running = True
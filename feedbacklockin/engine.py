@@ -0,0 +1,275 @@
+'''
+An Engine runs the acquisition and feedback loop on its own thread, so that
+the GUI event loop and the TCP server can never stall the feedback. It owns
+the DAQ and the FeedbackLockin: once per period it writes the next output
+sines, reads the inputs and steps the lockin, then publishes an immutable
+Snapshot of the results. Consumers pick up the latest snapshot at whatever
+rate suits them.
+
+Nothing outside the engine thread may touch the FeedbackLockin directly.
+Instead, submit the call to the engine, which queues it and applies it between
+two frames.
+'''
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+# An immutable copy of the lockin state after one frame. seq counts frames
+# since the engine was created, timestamp is from time.monotonic(). Xh, Yh and
+# Ph are (harmonics) x (channels), with the fundamental (X, Y and P) first.
+# Xm and Ym are the (outputs) x (inputs) transfer matrix when every output has
+# its own frequency, and None otherwise. D holds the derived quantities, in
+# the order of the lockin's derived_names. error, drift and locked are the
+# per-channel settle state (see settle.py). data is the averaged raw input
+# block, which is only copied out when asked for. identify is the lockin's
+# identify_status and derived_names the names of D, so that other threads
+# never need to ask the lockin itself.
+class Snapshot(collections.namedtuple('Snapshot', [
+        'seq', 'timestamp', 'vOuts', 'vIns', 'X', 'Y', 'DC', 'Xh', 'Yh', 'Xm',
+        'Ym', 'D', 'error', 'drift', 'locked', 'data', 'identify',
+        'derived_names'])):
+    # The phases are worked out from Xh and Yh by the first reader that
+    # wants them, on its own thread, and kept for any later ones.
+
+    @property
+    def Ph(self):
+        Ph = self.__dict__.get('Ph')
+        if Ph is None:
+            Ph = np.degrees(np.arctan2(self.Yh, self.Xh))
+            Ph.setflags(write=False)
+            self.__dict__['Ph'] = Ph
+        return Ph
+
+    @property
+    def P(self):
+        return self.Ph[0]
+
+
+def _frozen(array):
+    # Copies an array and makes the copy read-only, so that snapshots can be
+    # handed to other threads without worrying about who might mutate them.
+    out = np.array(array, dtype=np.float64)
+    out.setflags(write=False)
+    return out
+
+
+def _apply(fn, args):
+    try:
+        fn(*args)
+    except Exception as e:
+        print(f'Error running {getattr(fn, "__name__", fn)}{args}: {e}')
+
+
+class Subscription(object):
+    """A bounded queue of every decimation-th snapshot for one consumer.
+
+    The engine offers each new snapshot from its own thread. Once maxlen
+    frames are waiting, the oldest one is dropped and counted, so a slow
+    consumer can neither stall the engine nor make the queue grow. notify,
+    if given, is called on the engine thread after every frame it queues,
+    and should only hand off to the consumer's thread. Calling it only when
+    the queue was empty would race with the consumer popping the last frame
+    in between, after which it would never be called again.
+    """
+    def __init__(self, mask, decimation=1, maxlen=64, notify=None):
+        self.mask = mask
+        self.decimation = max(int(decimation), 1)
+        self.dropped = 0
+        self._frames = collections.deque(maxlen=maxlen)
+        self._notify = notify
+
+    def offer(self, snap):
+        if snap.seq % self.decimation:
+            return
+        if len(self._frames) == self._frames.maxlen:
+            self.dropped += 1
+        self._frames.append(snap)
+        if self._notify is not None:
+            self._notify()
+
+    def pop(self):
+        """Returns the oldest waiting snapshot, or None."""
+        try:
+            return self._frames.popleft()
+        except IndexError:
+            return None
+
+
+class Engine(object):
+    def __init__(self, daq, lockin, recorder=None, capture=None,
+                 shared=None):
+        self._daq = daq
+        self._fbl = lockin
+        self._recorder = recorder
+        self._capture = capture
+        self._shared = shared
+        self._commands = queue.SimpleQueue()
+        # Calls held back by begin_batch, per submitting thread.
+        self._batch = threading.local()
+        self._thread = None
+        self._running = False
+        self._publish_series = False
+        lockin.set_series_enabled(False)
+        # Replaced rather than mutated, so the engine thread can iterate
+        # over it without a lock.
+        self._subscriptions = ()
+        self._seq = 0
+        # The DAQ's number of the last block read in, and how many blocks
+        # were read by the card but never by the engine.
+        self._block = -1
+        self.missed = 0
+        self._snapshot = None
+        self._publish()
+
+    @property
+    def lockin(self):
+        return self._fbl
+
+    @property
+    def recorder(self):
+        return self._recorder
+
+    @property
+    def capture(self):
+        return self._capture
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._block = -1
+        self._daq.start()
+        self._thread = threading.Thread(target=self._run, name='fbl-engine')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._daq.stop()
+        if self.missed:
+            print(f'Engine missed {self.missed} blocks')
+        if self._recorder is not None:
+            self._recorder.stop()
+        if self._capture is not None:
+            self._capture.flush()
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) to be called on the engine thread between frames."""
+        calls = getattr(self._batch, 'calls', None)
+        if calls is not None:
+            calls.append((fn, args))
+        else:
+            self._commands.put((fn, args))
+
+    def begin_batch(self):
+        """Hold back calls submitted from this thread until end_batch."""
+        self._batch.calls = []
+
+    def end_batch(self):
+        """Queue the held back calls to all run between the same two frames."""
+        calls = self._batch.calls
+        self._batch.calls = None
+        if calls:
+            self._commands.put((self._run_batch, (calls,)))
+
+    def subscribe(self, mask, decimation=1, maxlen=64, notify=None):
+        """Returns a new Subscription to the snapshots of future frames."""
+        sub = Subscription(mask, decimation, maxlen, notify)
+        self._subscriptions = self._subscriptions + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscriptions = tuple(s for s in self._subscriptions
+                                    if s is not sub)
+
+    def snapshot(self):
+        """Returns the Snapshot of the most recent frame."""
+        return self._snapshot
+
+    def set_publish_series(self, enabled):
+        # The averaged raw data is large, so only average it and copy it into
+        # snapshots while somebody is actually plotting it.
+        self.submit(self._set_publish_series, bool(enabled))
+
+    def _set_publish_series(self, enabled):
+        self._fbl.set_series_enabled(enabled)
+        self._publish_series = enabled
+
+    def _run(self):
+        while self._running:
+            if not self._daq.wait_for_data(0.1):
+                # Still apply commands while the card is idle.
+                self._drain_commands()
+                continue
+            self._drain_commands()
+            out = self._fbl.sine_out()
+            self._daq.set_output(out)
+            data = self._daq.get_input()
+            block = self._daq.get_input_seq()
+            if block > self._block + 1:
+                self.missed += block - self._block - 1
+            self._block = block
+            if self._capture is not None:
+                # Before read_in, which rewrites the output block in place.
+                # Numbered by block, so that missed ones leave a gap.
+                self._capture.write(block + 1, data, out)
+            self._fbl.read_in(data, block)
+            self._seq += 1
+            self._publish()
+            for sub in self._subscriptions:
+                sub.offer(self._snapshot)
+            if self._shared is not None:
+                self._shared.publish(self._snapshot, data)
+            if self._recorder is not None:
+                self._recorder.record(self._snapshot)
+
+    def _drain_commands(self):
+        while True:
+            try:
+                fn, args = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            _apply(fn, args)
+
+    def _run_batch(self, calls):
+        for fn, args in calls:
+            _apply(fn, args)
+
+    def _publish(self):
+        fbl = self._fbl
+        data = _frozen(fbl.data) if self._publish_series else None
+        Xh = _frozen(fbl.Xh)
+        Yh = _frozen(fbl.Yh)
+        Xm = _frozen(fbl.Xm) if fbl.Xm is not None else None
+        Ym = _frozen(fbl.Ym) if fbl.Ym is not None else None
+        # Rebinding the attribute is atomic, so readers always see either the
+        # previous snapshot or this one, never a mix.
+        self._snapshot = Snapshot(
+            seq=self._seq,
+            timestamp=time.monotonic(),
+            vOuts=_frozen(fbl.vOuts),
+            vIns=_frozen(fbl.vIns),
+            X=Xh[0],
+            Y=Yh[0],
+            DC=_frozen(fbl.DC),
+            Xh=Xh,
+            Yh=Yh,
+            Xm=Xm,
+            Ym=Ym,
+            D=_frozen(fbl.D),
+            error=_frozen(fbl.error),
+            drift=_frozen(fbl.drift),
+            locked=_frozen(fbl.locked),
+            data=data,
+            identify=fbl.identify_status,
+            derived_names=fbl.derived_names)
@@ -1,27 +1,73 @@
-from PySide2.QtCore import *
 import numpy as np
 
 from feedbacklockin.sin_outs import SinOutputs
-from feedbacklockin.lockin_calc import LockinCalculator
+from feedbacklockin.lockin_calc import LockinCalculator, SlidingLockin
 from feedbacklockin.moving_averager import (NoneAverager,
         ExponentialAverager, SlidingWindowAverager)
 from feedbacklockin.discrete_pi import DiscretePI
 from feedbacklockin.bias_resistor import BiasResistor
+from feedbacklockin.derived import DerivedQuantities
+from feedbacklockin.settle import SettleDetector
+from feedbacklockin.sysid import Identification, integral_gains
 
 
 _MIN_OUT = -10.0
 _MAX_OUT = 10.0
 
 
-class FeedbackLockin(QObject):
-    def __init__(self, channels, points):
-        QObject.__init__(self)
+class FeedbackLockin(object):
+    """FeedbackLockin tracks the state of the lockin.
+
+    If cycles is given, every output channel runs at its own frequency of
+    cycles[chan] cycles per period instead of all running at the fundamental.
+    Every input is then demodulated at every output frequency, which gives
+    the full (outputs) x (inputs) transfer matrix in Xm and Ym each frame.
+    Feedback then acts on each input at its own output's frequency. Harmonics
+    can't be combined with cycles. The bias resistor correction is left out,
+    since it would take a share of every other channel's amplitude off each
+    channel at that channel's own frequency, where the others don't flow.
+
+    If hop is given, read_in takes chunks of hop points instead of whole
+    periods. X and Y are then computed over a window of the last period that
+    slides along one chunk at a time, and feedback runs once per chunk. The
+    output sines are still a whole period long.
+
+    Quantities declared with define_derived (see derived.py) are worked out
+    from X and Y after every read_in, into D in the order of derived_names.
+
+    error, drift and locked say how well each channel has settled over the
+    last few frames (see settle.py).
+
+    identify measures the response of the inputs to the outputs over the
+    next frames (see sysid.py), and sets the feedback gains from it.
+    """
+    def __init__(self, channels, points, harmonics=(1,), cycles=None,
+                 hop=None):
         self._channels = channels
+        self._points = points
 
         self._control_pi = DiscretePI(channels)
-        self._lockin = LockinCalculator(points)
+        self._control_pi.set_limits(_MIN_OUT, _MAX_OUT)
+        self._lockin = LockinCalculator(points, harmonics)
+        self._fdm = cycles is not None
+        if self._fdm:
+            if len(self._lockin.harmonics) > 1:
+                raise ValueError('harmonics are not supported together with '
+                                 'per-channel frequencies')
+            self._lockin.set_cycles(cycles)
+        nharm = len(self._lockin.harmonics)
+        nref = len(self._lockin.cycles)
+        if hop is not None and hop != points:
+            self._sliding = SlidingLockin(self._lockin, channels, hop)
+        else:
+            self._sliding = None
         self._bias_r = BiasResistor(channels)
-        self._sines = SinOutputs(channels, points)
+        if self._fdm:
+            self._bias_r.setZeroSumDisabledAxes(0.5, np.ones(channels))
+        # The outputs saturate past the bias resistor transform, so that is
+        # where feedback is limited.
+        self._control_pi.set_output_transform(self._bias_r)
+        self._sines = SinOutputs(channels, points, cycles)
 
         # Average both the amplitudes as well as the raw input data.
         self._avg_type = 0
@@ -33,9 +79,122 @@ class FeedbackLockin(QObject):
 
         self.vOuts = np.zeros(channels)
         self.vIns = np.zeros(channels)
-        self.avged = np.zeros(channels)
+        self.avged = np.zeros((2 * nref, channels))
         self.Phaseins = np.zeros(channels)
         self._feedback_on = np.zeros(channels)
+        self._feedback_mask = np.zeros(channels, dtype=bool)
+
+        # Workspaces for read_in. Everything in the per-frame path writes into
+        # these so that steady-state operation does not allocate.
+        # The lockin gives the DC level as one more row after the amplitudes.
+        self._amps_dc = np.zeros((2 * nref + 1, channels))
+        self._amps_raw = self._amps_dc[:-1]
+        self._dc_raw = self._amps_dc[-1]
+        self._amps_out = np.zeros(channels)
+        self._pi_in = np.zeros(channels)
+
+        # Results of the latest read_in, zeroed until the first frame. Xh, Yh,
+        # Rh and Ph are (harmonics) x (channels), and X, Y, R and P are views
+        # of their first row, the fundamental. Rh and Ph are only worked out
+        # when read, once per frame.
+        self.Xh = np.zeros((nharm, channels))
+        self.Yh = np.zeros((nharm, channels))
+        self._Rh = np.zeros((nharm, channels))
+        self._Ph = np.zeros((nharm, channels))
+        self.X = self.Xh[0]
+        self.Y = self.Yh[0]
+        self.DC = np.zeros(channels)
+        self.data = np.zeros((points, channels))
+        self._frame = 0
+        self._polar_frame = 0
+        # The series average costs a pass over every point, so it only runs
+        # while someone wants it.
+        self._series_enabled = True
+        # (outputs) x (inputs) transfer matrix, only with per-channel cycles.
+        self.Xm = np.zeros((nref, channels)) if self._fdm else None
+        self.Ym = np.zeros((nref, channels)) if self._fdm else None
+        self._derived = DerivedQuantities(channels)
+        self.D = self._derived.values
+        self.update_settle(10, 1e-3)
+        self._response = None
+        self._max_condition = 1e3
+        # Defaults of identify, and its latest result.
+        self.identify_amplitude = 0.01
+        self.identify_frames = 10
+        self.identified = None
+        self._identification = None
+        self._identify_result = ('idle', 0, 0)
+
+    @property
+    def harmonics(self):
+        return self._lockin.harmonics
+
+    @property
+    def hop(self):
+        """Points per call to read_in."""
+        return self._sliding.hop if self._sliding else self._points
+
+    @property
+    def cycles(self):
+        """Cycles per period of each output channel, or None."""
+        return self._lockin.cycles if self._fdm else None
+
+    @property
+    def Rh(self):
+        self._update_polar()
+        return self._Rh
+
+    @property
+    def Ph(self):
+        self._update_polar()
+        return self._Ph
+
+    @property
+    def R(self):
+        return self.Rh[0]
+
+    @property
+    def P(self):
+        return self.Ph[0]
+
+    def _update_polar(self):
+        if self._polar_frame != self._frame:
+            np.hypot(self.Xh, self.Yh, out=self._Rh)
+            np.arctan2(self.Yh, self.Xh, out=self._Ph)
+            np.degrees(self._Ph, out=self._Ph)
+            self._polar_frame = self._frame
+
+    def set_series_enabled(self, enabled):
+        """Turns the series average in data on or off.
+
+        While off, data keeps the last average. Turning it back on starts
+        averaging afresh.
+        """
+        enabled = bool(enabled)
+        if enabled and not self._series_enabled:
+            self._series_averager.reset()
+        self._series_enabled = enabled
+
+    @property
+    def derived_names(self):
+        """Names of the derived quantities, in the order of D."""
+        return self._derived.names
+
+    def define_derived(self, name, quantity):
+        """Adds or replaces a derived.Quantity, as parsed by derived.parse."""
+        self._derived.define(name, quantity)
+        self.D = self._derived.values
+
+    def remove_derived(self, name):
+        self._derived.remove(name)
+        self.D = self._derived.values
+
+    def update_settle(self, window, tol):
+        """Sets the frames and the tolerance that locked is judged over."""
+        self._settle = SettleDetector(self._channels, window, tol)
+        self.error = self._settle.error
+        self.drift = self._settle.drift
+        self.locked = self._settle.locked
 
     def reset_avg(self):
         for a1, a2, a3 in self._averagers:
@@ -47,6 +206,17 @@ class FeedbackLockin(QObject):
         self._sines.setSingleAmp(val, chan)
         self.vOuts[chan] = val
 
+    def update_all_amps(self, vals):
+        """Sets the amplitude of every channel without feedback at once.
+
+        NaN leaves a channel as is. Channels with feedback are skipped, since
+        their amplitudes come from the feedback loop.
+        """
+        vals = self._channel_vector(vals)
+        apply = ~(np.isnan(vals) | self._feedback_mask)
+        np.copyto(self.vOuts, vals, where=apply)
+        self._sines.setAmps(np.where(apply, vals, np.nan))
+
     def update_averaging(self, averaging):
         for a1, a2, a3 in self._averagers:
             a1.set_averaging(averaging)
@@ -57,10 +227,42 @@ class FeedbackLockin(QObject):
         self._control_pi.set_setpoint(val, chan)
         self.vIns[chan] = val
 
+    def update_setpoints(self, vals):
+        """Sets every channel's setpoint at once. NaN leaves it as is."""
+        vals = self._channel_vector(vals)
+        np.copyto(self.vIns, vals, where=~np.isnan(vals))
+        self._control_pi.set_setpoints(self.vIns)
+
     def update_k(self, ki, kp):
+        """Sets both gains, each one for every channel or one per channel."""
+        if np.ndim(ki):
+            ki = self._channel_vector(ki)
+        if np.ndim(kp):
+            kp = self._channel_vector(kp)
         self._control_pi.set_ki(ki)
         self._control_pi.set_kp(kp)
 
+    def update_ki(self, ki):
+        """Sets one integral gain, or one per channel (NaN for no change)."""
+        if np.ndim(ki):
+            ki = self._channel_vector(ki)
+        self._control_pi.set_ki(ki)
+
+    def update_kp(self, kp):
+        """Sets one proportional gain, or one per channel."""
+        if np.ndim(kp):
+            kp = self._channel_vector(kp)
+        self._control_pi.set_kp(kp)
+
+    def update_slew(self, slew, tracking=None):
+        """Limits how far feedback moves an output per frame, 0 for no limit.
+
+        tracking is the anti-windup gain (see discrete_pi.py).
+        """
+        self._control_pi.set_slew(slew)
+        if tracking is not None:
+            self._control_pi.set_tracking(tracking)
+
     def set_averaging_type(self, avg_type):
         """Options are 0: None, 1: sliding window, and 2: exponential."""
         if avg_type == self._avg_type or avg_type < 0 or avg_type > 2:
@@ -70,11 +272,63 @@ class FeedbackLockin(QObject):
         self.reset_avg()
 
     def set_feedback_enabled(self, chan, enabled):
-        enabled_int = 1 if enabled else 0
-        self._feedback_on[chan] = enabled_int
-        self._bias_r.setZeroSumDisabledAxes(0.5, 1 - self._feedback_on)
+        mask = self._feedback_mask.copy()
+        mask[chan] = enabled
+        self.set_feedback_mask(mask)
+
+    def set_feedback_mask(self, mask):
+        """Turns feedback on or off for every channel at once."""
+        mask = self._channel_vector(mask).astype(bool)
+        # The response is measured through the bias resistor, which changes.
+        self.cancel_identify()
+        np.copyto(self._feedback_mask, mask)
+        np.copyto(self._feedback_on, mask)
+        if not self._fdm:
+            self._bias_r.setZeroSumDisabledAxes(0.5, 1 - self._feedback_on)
         self._control_pi.zero_errors(self._bias_r.reverse())
-        self._control_pi.set_output_enabled(chan, enabled_int)
+        self._control_pi.set_outputs_enabled(mask)
+        self._update_response()
+
+    def _channel_vector(self, vals):
+        vals = np.asarray(vals, dtype=np.float64)
+        if vals.shape != (self._channels,):
+            raise ValueError(f'need {self._channels} values, got '
+                             f'{vals.size}')
+        return vals
+
+    def set_response(self, response, max_condition=None):
+        """Decouples feedback using a measured response matrix.
+
+        response is (inputs) x (outputs), flattened or not: how much each
+        input moves per volt of each output. None goes back to independent
+        channels, as does a response whose condition number between the
+        feedback channels is above max_condition (by default as before).
+        """
+        if response is not None:
+            response = np.asarray(response, dtype=np.float64)
+            if response.size != self._channels**2:
+                raise ValueError(f'need {self._channels**2} values, got '
+                                 f'{response.size}')
+            response = response.reshape(self._channels, self._channels)
+        self._response = response
+        if max_condition is not None:
+            self._max_condition = max_condition
+        self._update_response()
+
+    def _update_response(self):
+        # Feedback sets amplitudes before the bias resistor, so the
+        # controller sees the response through it.
+        if self._response is None:
+            self._control_pi.set_response(None)
+        else:
+            self._control_pi.set_response(
+                    self._response @ self._bias_r.matrix(),
+                    self._max_condition)
+
+    @property
+    def decoupling(self):
+        """Whether feedback is being decoupled with a response matrix."""
+        return self._control_pi.decoupling
 
     def set_reference(self, chan):
         self._control_pi.set_reference(chan)
@@ -84,29 +338,145 @@ class FeedbackLockin(QObject):
         np.clip(out, _MIN_OUT, _MAX_OUT, out)
         return out
 
-    def autotune_pid(self, scaleFactor):
-        if np.max(np.abs(self.vOuts)) > .001:
-            ampsRatio = (scaleFactor * np.max(np.abs(self.vOuts))
-                / np.max(np.abs(self.avged[0])))
-            self._control_pi.set_ki(ampsRatio)
-        return ampsRatio
-
-    def read_in(self, data):
-        self.DC = self._dc_averager.step(np.mean(data, axis=0))
-        calced_amps = self._lockin.calc_amps(data)
-        self.data = self._series_averager.step(data)
+    def identify(self, amplitude=None, target_frames=None, decouple=False):
+        """Starts measuring the response of the inputs to the outputs.
+
+        The channels with feedback, or every channel if none have it, are
+        perturbed by amplitude volts over the next frames, with feedback held
+        where it was. When done, the measured (inputs) x (outputs) response is
+        kept in identified, and the integral gains are set to settle a step
+        in target_frames frames. If decouple is set, or feedback is already
+        being decoupled, the response is also given to set_response.
+        """
+        self.cancel_identify()
+        if amplitude is None:
+            amplitude = self.identify_amplitude
+        if target_frames is None:
+            target_frames = self.identify_frames
+        chans = np.flatnonzero(self._feedback_mask)
+        if not len(chans):
+            chans = np.arange(self._channels)
+        # Frames before a change of the outputs is fully seen at the inputs.
+        # With hops, the outputs can take up to a period to go out, and the
+        # sliding window another period to take them in.
+        hops = self._points // self.hop
+        self._identify_delay = 2 * hops + 1 if hops > 1 else 2
+        self._identification = Identification(self._amps_out, chans,
+                                              amplitude,
+                                              self._identify_delay)
+        self._identify_target = target_frames
+        self._identify_decouple = decouple
+
+    def cancel_identify(self):
+        """Stops any identification, putting the outputs back."""
+        ident = self._identification
+        if ident is None:
+            return
+        self._identification = None
+        self._identify_result = ('cancelled', ident.done, ident.total)
+        self._sines.setAmps(self._bias_r.step(ident.base))
+
+    @property
+    def identify_status(self):
+        """(state, frames done, frames needed) of the latest identify.
+
+        state is one of idle, running, done, failed or cancelled.
+        """
+        ident = self._identification
+        if ident is not None:
+            return ('running', ident.done, ident.total)
+        return self._identify_result
+
+    def _finish_identify(self, ident):
+        self._identification = None
+        self._identify_result = ('failed', ident.done, ident.total)
+        chans = ident.chans
+        try:
+            gains = ident.solve()
+            # The perturbations went through the bias resistor, which only
+            # mixes the perturbed channels.
+            bias = self._bias_r.matrix()[np.ix_(chans, chans)]
+            response = np.zeros((self._channels, self._channels))
+            response[:, chans] = gains @ np.linalg.inv(bias)
+        except np.linalg.LinAlgError as e:
+            print(f'Identification failed: {e}')
+            return
+        self.identified = response
+        self._identify_result = ('done', ident.done, ident.total)
+
+        if self._identify_decouple or self._response is not None:
+            self.set_response(response)
+            if self.decoupling:
+                # Every mode then shrinks by 1 - ki per frame.
+                self._control_pi.set_ki(integral_gains(
+                        1.0, self._identify_target, self._identify_delay))
+                return
+        # Independent channels only see their own response.
+        own = gains[chans, np.arange(len(chans))]
+        usable = np.abs(own) > 1e-3 * np.max(np.abs(own))
+        if not np.all(usable):
+            print(f'No response on channels {chans[~usable]}, '
+                  f'leaving their gains')
+        ki = np.full(self._channels, np.nan)
+        ki[chans[usable]] = integral_gains(own[usable], self._identify_target,
+                                           self._identify_delay)
+        self._control_pi.set_ki(ki)
+
+    def read_in(self, data, block=None):
+        # block counts the blocks the DAQ has read since it started, if known,
+        # to keep a sliding window in phase when the engine missed some.
+        # All of the results are written into arrays owned by this object (or
+        # by the averagers), so nothing here allocates once running. Only
+        # what feedback needs is worked out eagerly: R and P wait until they
+        # are read, and the series average until it is wanted.
+        self._frame += 1
+        if self._sliding is not None:
+            calced_amps = self._sliding.step(data, out=self._amps_raw,
+                                              chunk=block)
+            np.copyto(self._dc_raw, self._sliding.dc)
+            # The raw data is only averaged once per full period.
+            if self._series_enabled and self._sliding.period_done:
+                self.data = self._series_averager.step(self._sliding.window)
+        else:
+            self._lockin.calc_amps_dc(data, out=self._amps_dc)
+            calced_amps = self._amps_raw
+            if self._series_enabled:
+                self.data = self._series_averager.step(data)
+        np.copyto(self.DC, self._dc_averager.step(self._dc_raw))
         self.avged = self._amp_averager.step(calced_amps)
-        X = self.avged[0]
-        Y = self.avged[1]
-        self.X = X
-        self.Y = Y
-        self.R = np.sqrt(X*X + Y*Y)
-        self.P = np.degrees(np.arctan2(Y, X))
-
-        # Setpoint amplitudes calculated. Note that we feedback on the
-        # unaveraged results.
-        pi_outs = self._control_pi.step(calced_amps[0])
-        amps_out = np.where(self._feedback_on, pi_outs, self.vOuts)
+        nref = len(self.avged) // 2
+        X = self.Xh
+        Y = self.Yh
+        if self._fdm:
+            # Each input's own signal is at its output's frequency, which is
+            # the diagonal of the transfer matrix.
+            np.copyto(self.Xm, self.avged[:nref])
+            np.copyto(self.Ym, self.avged[nref:])
+            np.copyto(X[0], np.diagonal(self.Xm))
+            np.copyto(Y[0], np.diagonal(self.Ym))
+            np.copyto(self._pi_in, np.diagonal(calced_amps[:nref]))
+        else:
+            np.copyto(X, self.avged[:nref])
+            np.copyto(Y, self.avged[nref:])
+            np.copyto(self._pi_in, calced_amps[0])
+        self.D = self._derived.step(self.X, self.Y)
+
+        amps_out = self._amps_out
+        ident = self._identification
+        if ident is None:
+            # Setpoint amplitudes calculated. Note that we feedback on the
+            # unaveraged results.
+            pi_outs = self._control_pi.step(self._pi_in)
+            np.copyto(amps_out, self.vOuts)
+            np.copyto(amps_out, pi_outs, where=self._feedback_mask)
+        else:
+            # Feedback is held while identifying, and picks up from the
+            # same outputs afterwards.
+            np.copyto(amps_out, ident.step(self._pi_in))
+            if ident.finished:
+                self._finish_identify(ident)
+        self._settle.step(self.X, self._control_pi.errors,
+                          self._feedback_mask)
 
         # Transform to maintain current conservation.
         amps_out = self._bias_r.step(amps_out)
@@ -114,4 +484,4 @@ class FeedbackLockin(QObject):
         # Updates the output sinewaves.
         self._sines.setAmps(amps_out)
 
-        self.vOuts = np.where(self._feedback_on, amps_out, self.vOuts)
+        np.copyto(self.vOuts, amps_out, where=self._feedback_mask)
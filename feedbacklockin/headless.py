@@ -0,0 +1,53 @@
+'''
+Runs the lockin without a GUI, serving the TCP API with asyncio.
+
+Run with python -m feedbacklockin.headless -s path/to/config.ini. Like the
+GUI, the server listens on port (and host) from the [TCP] section if enabled
+is true there, and on a Unix domain socket if unix_path is set there or given
+with --unix. PySide2 is never imported.
+'''
+import argparse
+import asyncio
+
+from feedbacklockin import aserver
+from feedbacklockin import config
+from feedbacklockin import protocol
+
+
+def Main():
+    options = argparse.ArgumentParser()
+    options.add_argument('-s', '--settings', type=str,
+                         default='dev.ini', help='Location of config ini.')
+    options.add_argument('-u', '--unix', type=str, default=None,
+                         help='Also listen on this Unix domain socket.')
+    args = options.parse_args()
+
+    settings = config.IniSettings(args.settings)
+    port = None
+    if settings.value('TCP/enabled', 'false').lower() == 'true':
+        port = int(settings.value('TCP/port', protocol.PORT))
+    host = settings.value('TCP/host', 'localhost')
+    unix_path = args.unix or settings.value('TCP/unix_path', None)
+    if port is None and unix_path is None:
+        options.error('nothing to listen on: set enabled=true in [TCP], '
+                      'or give a Unix socket')
+
+    setup = config.Setup(settings)
+    server = aserver.AsyncServer(setup)
+
+    async def run():
+        await server.start(host, port, unix_path)
+        await server.serve_forever()
+
+    setup.engine.start()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        setup.engine.stop()
+
+
+if __name__ == '__main__':
+    Main()
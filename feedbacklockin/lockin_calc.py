@@ -9,29 +9,184 @@ component of the series at that frequency.
 import numpy as np
 
 
+# Periods between recomputing the running sums of a SlidingLockin.
+_RESUM_PERIODS = 100
+
+
 class LockinCalculator:
     """LockinCalculator computes the X and Y components of a signal.
 
-    points is the number of points per period of oscillation.
+    points is the number of points per period of oscillation. harmonics lists
+    the multiples of the fundamental to demodulate at. The fundamental always
+    comes first, and is added if it is missing.
+
+    Alternatively, set_cycles demodulates at an arbitrary list of reference
+    frequencies, each given as a whole number of cycles per period. Any two
+    distinct whole numbers of cycles are orthogonal over the period, which is
+    what lets every output channel run at its own frequency.
     """
-    def __init__(self, points):
-        self.set_points(points)
+    def __init__(self, points, harmonics=(1,)):
+        self._points = points
+        self.set_harmonics(harmonics)
+
+    @property
+    def harmonics(self):
+        return self._harmonics
+
+    @property
+    def cycles(self):
+        return self._cycles
+
+    @property
+    def reference(self):
+        """The stacked (2 * references) x (points) reference matrix."""
+        return self._ref
+
+    def set_harmonics(self, harmonics):
+        """(Re)set the harmonics to demodulate at."""
+        harmonics = [int(h) for h in harmonics if int(h) != 1]
+        if any(h < 1 for h in harmonics):
+            raise ValueError(f'harmonics must be positive, got {harmonics}')
+        self._harmonics = tuple([1] + sorted(set(harmonics)))
+        self._cycles = self._harmonics
+        self.set_points(self._points)
+
+    def set_cycles(self, cycles):
+        """Demodulate at the given whole numbers of cycles per period."""
+        cycles = tuple(int(c) for c in cycles)
+        if any(c < 1 for c in cycles) or len(set(cycles)) != len(cycles):
+            raise ValueError(f'cycles must be distinct and positive, got '
+                             f'{cycles}')
+        self._harmonics = (1,)
+        self._cycles = cycles
+        self.set_points(self._points)
 
     def set_points(self, points):
         """(Re)set the number of points per oscillation."""
-        sin_ref = np.sin(np.linspace(0, 2 * np.pi, points))
-        cos_ref = np.cos(np.linspace(0, 2 * np.pi, points))
+        if 2 * max(self._cycles) >= points:
+            raise ValueError(f'{max(self._cycles)} cycles per period is above '
+                             f'the Nyquist limit for {points} points')
+        self._points = points
+        # All references are stacked into one (2 * references) x (points)
+        # matrix, sines first and then cosines, so that a single matmul
+        # demodulates everything at once.
+        phase = 2 * np.pi * np.outer(self._cycles, np.arange(points)) / points
+        sin_ref = np.sin(phase)
+        cos_ref = np.cos(phase)
 
-        sin_ref /= np.sum(sin_ref ** 2)
-        cos_ref /= np.sum(cos_ref ** 2)
+        sin_ref /= np.sum(sin_ref ** 2, axis=1, keepdims=True)
+        cos_ref /= np.sum(cos_ref ** 2, axis=1, keepdims=True)
 
         self._ref = np.vstack((sin_ref, cos_ref))
+        # Plus a row that averages the period, for calc_amps_dc.
+        self._ref_dc = np.vstack((self._ref,
+                                  np.full((1, points), 1.0 / points)))
 
-    def calc_amps(self, data):
+    def calc_amps(self, data, out=None):
         """Multiply the reference curves by the data.
 
-        The reference curves are a 2 x (points) array (X and Y), so the input
-        data must be (points) x (channels).
-        The result will then be 2 x (channels).
+        The reference curves are a (2 * references) x (points) array, so the
+        input data must be (points) x (channels). The result will then be
+        (2 * references) x (channels): the X components at every reference,
+        followed by the Y components in the same order. With harmonics, row 0
+        is X at the fundamental. If out is given, the result is written into
+        it instead of a new array.
+        """
+        return np.matmul(self._ref, data, out=out)
+
+    def calc_amps_dc(self, data, out=None):
+        """As calc_amps, with one more row at the end: the DC level of data.
+
+        It comes out of the same matmul, which is far cheaper than a second
+        pass over the data to average it.
         """
-        return np.matmul(self._ref, data)
+        return np.matmul(self._ref_dc, data, out=out)
+
+
+class SlidingLockin:
+    """SlidingLockin demodulates over a sliding window one period long.
+
+    Instead of one X/Y estimate per period, it gives a fresh one every hop
+    points, where hop must divide the period. Every reference is a whole
+    number of cycles per period, so its phase at a sample only depends on
+    where in the period the sample falls. A new chunk of hop points therefore
+    replaces the chunk at the same phase one period earlier. Updating the
+    running sums only takes the contributions of those two chunks, which
+    costs O(hop x channels) per reference rather than a full matmul. This is
+    a sliding DFT, restricted to the bins of calculator.
+
+    The running sums are recomputed from the window once per _RESUM_PERIODS
+    periods so that rounding errors cannot accumulate. The DC level of the
+    window is tracked the same way.
+    """
+    def __init__(self, calculator, channels, hop):
+        points = calculator.reference.shape[1]
+        if hop < 1 or points % hop:
+            raise ValueError(f'hop of {hop} points must divide the period of '
+                             f'{points} points')
+        self._hop = hop
+        self._nrefs = calculator.reference.shape[0]
+        # The references plus a row that averages the window to get its DC
+        # level, cut into one contiguous block per hop.
+        self._ref = np.vstack((calculator.reference,
+                               np.full((1, points), 1.0 / points)))
+        self._ref_chunks = [np.ascontiguousarray(self._ref[:, i:i + hop])
+                            for i in range(0, points, hop)]
+        # Fortran order, like the blocks the DAQ cards hand over.
+        self._window = np.zeros((points, channels), order='F')
+        self._window_chunks = [self._window[i:i + hop]
+                               for i in range(0, points, hop)]
+        self._sums = np.zeros((self._nrefs + 1, channels))
+        self._delta = np.zeros_like(self._sums)
+        self.dc = self._sums[self._nrefs]
+        self.reset()
+
+    @property
+    def hop(self):
+        return self._hop
+
+    @property
+    def window(self):
+        """The last period of data, arranged by phase rather than by time."""
+        return self._window
+
+    @property
+    def period_done(self):
+        """Whether the latest step completed a full period."""
+        return self._chunk == 0
+
+    def reset(self):
+        self._window.fill(0.0)
+        self._sums.fill(0.0)
+        self._chunk = 0
+        self._steps = 0
+
+    def step(self, data, out=None, chunk=None):
+        """Slide the window along by one (hop) x (channels) chunk.
+
+        Returns the X and Y components over the window in the same layout as
+        LockinCalculator.calc_amps, written into out if given. chunk, if
+        given, counts the chunks read since the start. If some were missed,
+        the window skips ahead to the phase of this one, and keeps what it
+        had for the missed ones from a period earlier.
+        """
+        if chunk is not None:
+            self._chunk = chunk % len(self._ref_chunks)
+        ref = self._ref_chunks[self._chunk]
+        old = self._window_chunks[self._chunk]
+        np.matmul(ref, old, out=self._delta)
+        self._sums -= self._delta
+        np.matmul(ref, data, out=self._delta)
+        self._sums += self._delta
+        np.copyto(old, data)
+
+        self._chunk = (self._chunk + 1) % len(self._ref_chunks)
+        self._steps += 1
+        if self._steps >= _RESUM_PERIODS * len(self._ref_chunks):
+            np.matmul(self._ref, self._window, out=self._sums)
+            self._steps = 0
+
+        if out is None:
+            return self._sums[:self._nrefs].copy()
+        np.copyto(out, self._sums[:self._nrefs])
+        return out
@@ -2,6 +2,7 @@ import argparse
 from functools import partial
 import math
 import sys
+import threading
 import time
 
 import numpy as np
@@ -10,10 +11,16 @@ from PySide2.QtCore import *
 from PySide2.QtWidgets import *
 import pyqtgraph as pg
 
-from feedbacklockin import fbl
+from feedbacklockin import config
+from feedbacklockin import protocol
 from feedbacklockin import server
 
 
+# Colours of each channel's locked indicator.
+_LOCKED_STYLE = 'color: limegreen'
+_UNLOCKED_STYLE = 'color: gray'
+
+
 class DoubleEdit(QDoubleSpinBox):
     """DoubleEdit is a QDoubleSpinBox with a few handy defaults."""
     def __init__(self, initial=0.0, read_only=False, clamp=(-10, 10)):
@@ -38,75 +45,135 @@ class MainWindow(QMainWindow):
         QMainWindow.__init__(self)
         self.setWindowTitle("Feedback Lockin")
 
-        self._channels = int(settings.value('DAQ/channels', 8))
-        self._freq = float(settings.value('FBL/frequency', 17.76))
-        points = int(settings.value('FBL/points', 0))
-        max_rate = int(settings.value('FBL/max_rate', 10000))
-        if points == 0:
-            self._npoints = int(max_rate / self._freq * 0.099) * 10
-        else:
-            self._npoints = points
-        self._fbl = fbl.FeedbackLockin(self._channels, self._npoints)
+        setup = config.Setup(settings)
+        self._channels = setup.channels
+        self._freq = setup.frequency
+        self._npoints = setup.points
+        self._fbl = setup.lockin
+        self._daq = setup.daq
+        self._recorder = setup.recorder
+        self._capture = setup.capture
+        self._dump_seconds = setup.dump_seconds
+        # Index into the harmonics of the lockin shown in the inputs box.
+        self._shown_harmonic = 0
+
+        # The engine runs the DAQ and the lockin on its own thread. From here
+        # on, only talk to self._fbl through self._engine.submit.
+        self._engine = setup.engine
+        self.exit.connect(self._engine.stop)
+
         self._init_layout()
         self._ki.setValue(float(settings.value('FBL/ki', 0.01)))
         self._kp.setValue(float(settings.value('FBL/kp', 0.0)))
         self._averaging.setValue(int(settings.value('FBL/averaging', 1)))
-        self._updates_since_fps = 0
+        self._last_seq = 0
+        self._seq_at_fps = 0
         self._freq_timer = QElapsedTimer()
 
         self._update_k()
 
-        if settings.value('DAQ/dummy', 'true').lower() == 'true':
-            from feedbacklockin.dummy_daq import Daq
-        else:
-            from feedbacklockin.daq import Daq
-        self._daq = Daq(self._channels, self._npoints)
-
-        ics = settings.value('DAQ/input_channels', '')
-        ocs = settings.value('DAQ/output_channels', '')
-        if isinstance(ics, list): ics = ','.join(ics)
-        if isinstance(ocs, list): ocs = ','.join(ocs)
-        self._daq.set_channels(ics, ocs)
-
-        oc = settings.value('DAQ/output_clock', '')
-        occhan = settings.value('DAQ/output_clock_channel', '')
-        icchan = settings.value('DAQ/input_clock_channel', '')
-        self._daq.set_clocks(oc, occhan, icchan)
-
-        self._daq.set_frequency(self._freq)
-        self.exit.connect(self._daq.stop)
-        self._daq.data_ready.connect(self._update)
-        self._daq.init_daq()
+        # Widgets are refreshed from the latest snapshot at the display rate,
+        # independent of how fast the engine is running.
+        self._display_timer = QTimer()
+        self._display_timer.setInterval(
+                int(1000 / float(settings.value('GUI/refresh_rate', 30))))
+        self._display_timer.timeout.connect(self._update)
 
         # Now make the TCP server if enabled.
         if settings.value('TCP/enabled', 'false').lower() == 'true':
-            port = int(settings.value('TCP/port', 0))
-            self._server = server.Server(port)
+            port = int(settings.value('TCP/port', protocol.PORT))
+            self._server = server.Server(port, self._engine)
             self.exit.connect(self._server.close)
             self._server.send_data.connect(self._send_data)
+            self._server.send_frame.connect(self._send_frame)
+            self._server.send_matrix.connect(self._send_matrix)
             self._server.set_v.connect(self._set_v)
             self._server.set_i.connect(self._set_i)
             self._server.set_ki.connect(self._set_ki)
             self._server.set_feed.connect(self._set_feed)
-            self._server.autotune.connect(self._fbl.autotune_pid)
-            self._server.reset_avg.connect(self._fbl.reset_avg)
+            self._server.set_vs.connect(self._set_vs)
+            self._server.set_is.connect(self._set_is)
+            self._server.set_feeds.connect(self._set_feeds)
+            self._server.set_gains.connect(self._set_gains)
+            self._server.set_kp.connect(self._set_kp)
+            self._server.set_kis.connect(self._set_kis)
+            self._server.set_kps.connect(self._set_kps)
+            self._server.set_slew.connect(self._set_slew)
+            self._server.set_response.connect(self._set_response)
+            self._server.identify.connect(self._identify)
+            self._server.identify_cancel.connect(self._identify_cancel)
+            self._server.reset_avg.connect(self._reset_avg)
+            self._server.start_recording.connect(self._start_recording)
+            self._server.stop_recording.connect(self._stop_recording)
+            self._server.dump_capture.connect(self._dump_capture)
+            self._server.define_derived.connect(self._define_derived)
+            self._server.remove_derived.connect(self._remove_derived)
 
     def start(self):
-        self._daq.start()
+        self._engine.start()
         self._freq_timer.start()
+        self._display_timer.start()
 
     def _send_data(self, conn):
         """Send FBL data to the supplied connection."""
-        conn.write(np.concatenate((
-            self._fbl.vOuts,
-            self._fbl.vIns,
-            self._fbl.X,
-            self._fbl.P,
-            self._fbl.DC)).tobytes('F'))
+        conn.write(protocol.pack_legacy(self._engine.snapshot()))
+
+    def _send_frame(self, conn, mask):
+        """Send the fields in mask as one framed reply (see protocol.py)."""
+        conn.write(protocol.pack_frame(self._engine.snapshot(), mask))
+
+    def _send_matrix(self, conn):
+        """Send the demodulated matrix as one (inputs, refs, 2) block."""
+        conn.write(protocol.pack_matrix(self._engine.snapshot()))
+
+    def _identify(self, amplitude, target_frames, decouple):
+        self._engine.submit(self._fbl.identify, amplitude, target_frames,
+                            decouple)
+
+    def _identify_cancel(self):
+        self._engine.submit(self._fbl.cancel_identify)
+
+    def _reset_avg(self):
+        self._engine.submit(self._fbl.reset_avg)
+
+    def _define_derived(self, name, quantity):
+        self._engine.submit(self._fbl.define_derived, name, quantity)
+
+    def _remove_derived(self, name):
+        self._engine.submit(self._fbl.remove_derived, name)
+
+    def _start_recording(self, path=''):
+        self._recorder.start(path)
+        self._record.setChecked(True)
+
+    def _stop_recording(self):
+        self._recorder.stop()
+        self._record.setChecked(False)
+
+    def _set_recording(self, _):
+        if self._record.isChecked():
+            self._recorder.start()
+        else:
+            self._recorder.stop()
+
+    def _dump_capture(self, seconds=None, path=''):
+        if self._capture is None:
+            print('Raw capture is not enabled')
+            return
+        if seconds is None:
+            seconds = self._dump_seconds
+        if not path:
+            path = time.strftime('dump-%Y%m%d-%H%M%S.ring')
+        # Copying out can take a while for long dumps, so keep it off both
+        # the GUI and the engine threads.
+        def dump():
+            n = self._capture.dump(path, seconds)
+            print(f'Dumped {n} frames to {path}')
+        threading.Thread(target=dump, daemon=True).start()
 
     def _set_v(self, chan, v):
         self._setpt_outs[chan].setValue(v)
-        self._fbl.update_setpoint(v, chan)
+        self._engine.submit(self._fbl.update_setpoint, v, chan)
 
     def _set_i(self, chan, v):
         self._amp_outs[chan].setValue(v)
@@ -116,30 +183,102 @@ class MainWindow(QMainWindow):
         self._ki.setValue(v)
         self._update_k()
 
+    def _set_kp(self, v):
+        self._kp.setValue(v)
+        self._update_k()
+
+    def _set_kis(self, vs):
+        # The gain boxes only show a gain shared by every channel.
+        if self._check_vector(vs):
+            self._engine.submit(self._fbl.update_ki, vs)
+
+    def _set_kps(self, vs):
+        if self._check_vector(vs):
+            self._engine.submit(self._fbl.update_kp, vs)
+
+    def _set_slew(self, v):
+        self._engine.submit(self._fbl.update_slew, v)
+
     def _set_feed(self, chan, feed):
         self._fb_enabled[chan].setChecked(feed)
         self._set_feedback(chan, None)
 
+    def _set_vs(self, vs):
+        if not self._check_vector(vs):
+            return
+        for chan, v in enumerate(vs):
+            if not np.isnan(v):
+                self._setpt_outs[chan].setValue(v)
+        # One submission, so all setpoints change in the same frame.
+        self._engine.submit(self._fbl.update_setpoints, vs)
+
+    def _set_is(self, vs):
+        if not self._check_vector(vs):
+            return
+        for chan, v in enumerate(vs):
+            if not np.isnan(v) and not self._fb_enabled[chan].isChecked():
+                self._amp_outs[chan].setValue(v)
+        self._engine.submit(self._fbl.update_all_amps, vs)
+
+    def _set_feeds(self, mask):
+        if not self._check_vector(mask):
+            return
+        for chan, enabled in enumerate(mask):
+            # Keep the checkboxes from submitting one change per channel.
+            self._fb_enabled[chan].blockSignals(True)
+            self._fb_enabled[chan].setChecked(bool(enabled))
+            self._fb_enabled[chan].blockSignals(False)
+            self._amp_outs[chan].setEnabled(not enabled)
+        self._engine.submit(self._fbl.set_feedback_mask, mask)
+
+    def _set_gains(self, ki, kp):
+        if isinstance(ki, float):
+            self._ki.setValue(ki)
+            self._kp.setValue(kp)
+            self._update_k()
+        else:
+            # Per-channel gains, both set in the same frame.
+            self._engine.submit(self._fbl.update_k, ki, kp)
+
+    def _set_response(self, response):
+        if response is not None and len(response) != self._channels**2:
+            print(f'Need {self._channels**2} values, got {len(response)}')
+            return
+        self._engine.submit(self._fbl.set_response, response)
+
+    def _check_vector(self, vs):
+        if len(vs) != self._channels:
+            print(f'Need {self._channels} values, got {len(vs)}')
+            return False
+        return True
+
     def _update(self):
-        """Perform one iteration of feedback."""
-        self._daq.set_output(self._fbl.sine_out())
-        data = self._daq.get_input()
-        self._fbl.read_in(data)
+        """Show the latest frame published by the engine."""
+        snap = self._engine.snapshot()
+        if snap.seq != self._last_seq:
+            self._last_seq = snap.seq
+            X = snap.Xh[self._shown_harmonic]
+            P = snap.Ph[self._shown_harmonic]
+            for i in range(self._channels):
+                self._v_ins[i].setValue(X[i])
+                self._p_ins[i].setValue(P[i])
+                if snap.data is not None and self._plot_enabled[i].isChecked():
+                    self._plot_items[i].setData(snap.data[:, i])
+                if self._fb_enabled[i].isChecked():
+                    self._amp_outs[i].setValue(snap.vOuts[i])
+                if snap.locked[i] != self._locked_shown[i]:
+                    self._locked_shown[i] = snap.locked[i]
+                    self._locked[i].setStyleSheet(
+                            _LOCKED_STYLE if snap.locked[i] else _UNLOCKED_STYLE)
+                    self._locked[i].setToolTip(
+                            'Locked' if snap.locked[i] else 'Unlocked')
 
-        for i in range(self._channels):
-            self._v_ins[i].setValue(self._fbl.X[i])
-            self._p_ins[i].setValue(self._fbl.P[i])
-            if self._plot_enabled[i].isChecked():
-                self._plot_items[i].setData(self._fbl.data[:, i])
-            if self._fb_enabled[i].isChecked():
-                self._amp_outs[i].setValue(self._fbl.vOuts[i])
-
-        self._updates_since_fps += 1
         elapsed = self._freq_timer.elapsed()
         if elapsed > 1000:
             self._freq_timer.restart()
-            self._freq_meas_spinbox.setValue(1000.0 / elapsed * self._updates_since_fps)
-            self._updates_since_fps = 0
+            self._freq_meas_spinbox.setValue(
+                    1000.0 / elapsed * (snap.seq - self._seq_at_fps))
+            self._seq_at_fps = snap.seq
 
     def _zero_all(self):
         for i in range(self._channels):
@@ -148,34 +287,47 @@ class MainWindow(QMainWindow):
             self._set_i(i, 0.0)
 
     def _update_setpoint(self, channel):
-        self._fbl.update_setpoint(self._setpt_outs[channel].value(), channel)
+        self._engine.submit(self._fbl.update_setpoint,
+                self._setpt_outs[channel].value(), channel)
 
     def _update_amps(self, channel):
         if not self._fb_enabled[channel].isChecked():
-            self._fbl.update_amps(self._amp_outs[channel].value(), channel)
+            self._engine.submit(self._fbl.update_amps,
+                    self._amp_outs[channel].value(), channel)
 
     def _update_k(self):
-        self._fbl.update_k(self._ki.value(), self._kp.value())
+        self._engine.submit(self._fbl.update_k,
+                self._ki.value(), self._kp.value())
 
     def _update_averaging(self):
-        self._fbl.update_averaging(self._averaging.value())
+        self._engine.submit(self._fbl.update_averaging, self._averaging.value())
+
+    def _set_averaging_type(self, avg_type):
+        self._engine.submit(self._fbl.set_averaging_type, avg_type)
 
     def _set_plot_enabled(self, channel, _):
         if self._plot_enabled[channel].isChecked():
             self._pw.getPlotItem().addItem(self._plot_items[channel])
         else:
             self._pw.getPlotItem().removeItem(self._plot_items[channel])
+        self._engine.set_publish_series(
+                any(pe.isChecked() for pe in self._plot_enabled))
 
     def _set_feedback(self, channel, _):
         enabled = self._fb_enabled[channel].isChecked()
-        self._fbl.set_feedback_enabled(channel, enabled)
+        self._engine.submit(self._fbl.set_feedback_enabled, channel, enabled)
         self._amp_outs[channel].setEnabled(not enabled)
 
+    def _set_shown_harmonic(self, index):
+        self._shown_harmonic = max(index, 0)
+        # Force a refresh even if no new frame has arrived.
+        self._last_seq = -1
+
     def _set_ref(self, text):
         if text == 'None':
-            self._fbl.set_reference(None)
+            self._engine.submit(self._fbl.set_reference, None)
         else:
-            self._fbl.set_reference(int(text))
+            self._engine.submit(self._fbl.set_reference, int(text))
 
     def _init_layout(self):
         """Make the GUI and hook up the appropriate signals/slots."""
@@ -233,6 +385,8 @@ class MainWindow(QMainWindow):
         self._amp_outs = []
         self._setpt_outs = []
         self._fb_enabled = []
+        self._locked = []
+        self._locked_shown = [None] * self._channels
         for i in range(math.ceil(self._channels / 8)):
             out_layout.addWidget(QLabel('Channel'), i*3, 0)
             out_layout.addWidget(QLabel('Amplitude'), i*3 + 1, 0)
@@ -253,6 +407,10 @@ class MainWindow(QMainWindow):
                 fb_enabled.stateChanged.connect(partial(self._set_feedback, chan))
                 self._fb_enabled.append(fb_enabled)
                 fb_layout.addWidget(fb_enabled)
+                # Green once the channel has settled (see settle.py).
+                locked = QLabel('\u25cf')
+                self._locked.append(locked)
+                fb_layout.addWidget(locked)
                 out_layout.addLayout(fb_layout, i*3 + 2, j + 1)
         zero_button = QPushButton("Reset all")
         zero_button.setSizePolicy(QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Expanding))
@@ -276,7 +434,7 @@ class MainWindow(QMainWindow):
         settings_layout.addWidget(QLabel('Averaging'), 0, 2)
         self._avg_type = QComboBox()
         self._avg_type.addItems(['None', 'Sliding Window', 'Exponential'])
-        self._avg_type.currentIndexChanged.connect(self._fbl.set_averaging_type)
+        self._avg_type.currentIndexChanged.connect(self._set_averaging_type)
         settings_layout.addWidget(self._avg_type, 0, 3)
 
         settings_layout.addWidget(QLabel('Amount'), 1, 2)
@@ -297,6 +455,12 @@ class MainWindow(QMainWindow):
         self._freq_spinbox.setValue(self._freq)
         settings_layout.addWidget(self._freq_spinbox, 0, 5)
 
+        self._harmonic_in = QComboBox()
+        self._harmonic_in.addItems([f'{h}f' for h in self._fbl.harmonics])
+        self._harmonic_in.currentIndexChanged.connect(self._set_shown_harmonic)
+        settings_layout.addWidget(QLabel('Harmonic'), 0, 6)
+        settings_layout.addWidget(self._harmonic_in, 0, 7)
+
         status_box = QGroupBox('Status')
         status_box.setSizePolicy(QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed))
         status_layout = QGridLayout()
@@ -314,6 +478,15 @@ class MainWindow(QMainWindow):
         self._samples_spinbox.setButtonSymbols(QAbstractSpinBox.NoButtons)
         status_layout.addWidget(self._samples_spinbox, 1, 1)
 
+        self._record = QCheckBox('Record')
+        self._record.stateChanged.connect(self._set_recording)
+        status_layout.addWidget(self._record, 2, 0, 1, 2)
+
+        dump_button = QPushButton(f'Dump last {self._dump_seconds:g} s')
+        dump_button.setEnabled(self._capture is not None)
+        dump_button.clicked.connect(lambda: self._dump_capture())
+        status_layout.addWidget(dump_button, 3, 0, 1, 2)
+
         bottom_half.addWidget(out_box)
         botright = QVBoxLayout()
         botright.addWidget(settings_box)
@@ -1,4 +1,8 @@
-import collections
+import numpy as np
+
+
+# Steps between recomputing the running sum of a SlidingWindowAverager.
+_RESUM_STEPS = 1000
 
 
 class NoneAverager:
@@ -14,6 +18,9 @@ class NoneAverager:
     def step(self, data):
         return data
 
+    def steps(self, stack):
+        return stack
+
 
 class ExponentialAverager:
     """Perform an exponential moving average over a series of input data.
@@ -26,11 +33,13 @@ class ExponentialAverager:
     including numpy arrays, for which all inputs must have the shape.
     """
     def __init__(self, averaging=1):
+        self._old_data = None
         self.set_averaging(averaging)
         self.reset()
 
     def reset(self):
-        self._old_data = None
+        # Keep any buffer around, the next step just overwrites it.
+        self._primed = False
 
     def set_averaging(self, averaging):
         """Set the averaging decay constant in units of function calls."""
@@ -38,12 +47,44 @@ class ExponentialAverager:
         self._old_mult = 1 - self._new_mult
 
     def step(self, data):
-        """Perform one averaging step and return the result."""
-        if self._old_data is None:
-            self._old_data = data
-        self._old_data = self._new_mult * data + self._old_mult * self._old_data
+        """Perform one averaging step and return the result.
+
+        For numpy arrays the average is kept in a buffer that is updated in
+        place, so the returned array is overwritten by the next step.
+        """
+        if not isinstance(data, np.ndarray):
+            if not self._primed:
+                self._old_data = data
+                self._primed = True
+            self._old_data = (self._new_mult * data
+                              + self._old_mult * self._old_data)
+            return self._old_data
+        if (not isinstance(self._old_data, np.ndarray)
+                or self._old_data.shape != data.shape):
+            # empty_like keeps the memory layout of the input, which keeps
+            # the in-place updates below from needing scratch buffers.
+            self._old_data = np.empty_like(data, dtype=np.float64)
+            self._primed = False
+        if not self._primed:
+            np.copyto(self._old_data, data)
+            self._primed = True
+        # new*d + old*o, rearranged as new*((old/new)*o + d) so that it can
+        # be done in place. old/new is just (a - 1).
+        self._old_data *= self._old_mult / self._new_mult
+        self._old_data += data
+        self._old_data *= self._new_mult
         return self._old_data
 
+    def steps(self, stack):
+        """Steps through every entry along the first axis of stack.
+
+        Returns a new array with the average after each step.
+        """
+        out = np.empty_like(stack, dtype=np.float64)
+        for i in range(len(stack)):
+            out[i] = self.step(stack[i])
+        return out
+
 
 class SlidingWindowAverager:
     """Perform a sliding window average over input data.
@@ -52,19 +93,123 @@ class SlidingWindowAverager:
     internal queue of data will be no larger than this size, however when first
     populating the window, it may be smaller. The output is the average of the
     elements in the window.
+
+    The window is a preallocated ring of arrays together with their running
+    sum, so each step costs the same no matter how long the window is. The sum
+    is recomputed from scratch every so often to keep rounding errors from
+    piling up.
     """
     def __init__(self, averaging=1):
-        self._window = collections.deque()
+        self._ring = None
+        self._sum = None
+        self._out = None
+        self._count = 0
+        self._head = 0
+        self._since_resum = 0
         self.set_averaging(averaging)
 
     def reset(self):
-        self._window.clear()
+        self._count = 0
+        self._head = 0
+        self._since_resum = 0
+        if self._sum is not None:
+            self._sum.fill(0.0)
 
     def set_averaging(self, averaging):
-        self._avg = averaging
+        """Set the window size, keeping the newest entries that still fit."""
+        self._avg = max(int(averaging), 1)
+        if self._ring is None or len(self._ring) == self._avg:
+            return
+        old = self._ring
+        keep = min(self._count, self._avg)
+        newest = self._ordered()[self._count - keep:]
+        self._ring = _ring_like(self._sum, self._avg)
+        for i in range(keep):
+            np.copyto(self._ring[i], old[newest[i]])
+        self._count = keep
+        self._head = keep % self._avg
+        self._resum()
 
     def step(self, data):
-        self._window.append(data)
-        while len(self._window) > self._avg:
-            self._window.popleft()
-        return sum(self._window) / len(self._window)
+        """Add data to the window and return the average.
+
+        The returned array is overwritten by the next step.
+        """
+        if self._sum is None or self._sum.shape != np.shape(data):
+            self._allocate(data)
+        slot = self._ring[self._head]
+        if self._count == len(self._ring):
+            # Drop the oldest entry, which is about to be overwritten.
+            self._sum -= slot
+        else:
+            self._count += 1
+        np.copyto(slot, data)
+        self._sum += slot
+        self._head = (self._head + 1) % len(self._ring)
+
+        self._since_resum += 1
+        if self._since_resum >= _RESUM_STEPS:
+            self._resum()
+
+        np.multiply(self._sum, 1.0 / self._count, out=self._out)
+        return self._out
+
+    def steps(self, stack):
+        """Steps through every entry along the first axis of stack.
+
+        Returns a new array with the average after each step, computed for
+        the whole stack at once from a cumulative sum.
+        """
+        stack = np.asarray(stack)
+        if len(stack) == 0:
+            return np.empty_like(stack, dtype=np.float64)
+        if self._sum is None or self._sum.shape != stack.shape[1:]:
+            self._allocate(stack[0])
+        # The entries already in the window, oldest first, followed by the
+        # new ones. Output i averages the avg entries ending at prior + i.
+        prior = self._ring[self._ordered()]
+        csum = np.zeros((len(prior) + len(stack) + 1,) + stack.shape[1:])
+        np.cumsum(np.concatenate((prior, stack)), axis=0, out=csum[1:])
+        ends = np.arange(len(prior) + 1, len(csum))
+        starts = np.maximum(ends - self._avg, 0)
+        counts = (ends - starts).reshape((-1,) + (1,) * (stack.ndim - 1))
+        out = (csum[ends] - csum[starts]) / counts
+
+        # Leave the window as if each entry had been stepped in turn.
+        for data in stack[-len(self._ring):]:
+            slot = self._ring[self._head]
+            np.copyto(slot, data)
+            self._head = (self._head + 1) % len(self._ring)
+        self._count = min(self._count + len(stack), len(self._ring))
+        self._resum()
+        return out
+
+    def _ordered(self):
+        # Ring indices of the entries in the window, oldest first.
+        start = self._head if self._count == len(self._ring) else 0
+        return (start + np.arange(self._count)) % len(self._ring)
+
+    def _allocate(self, data):
+        data = np.asarray(data)
+        self._ring = _ring_like(data, self._avg)
+        self._sum = np.zeros_like(data, dtype=np.float64)
+        self._out = np.zeros_like(data, dtype=np.float64)
+        self._count = 0
+        self._head = 0
+        self._since_resum = 0
+
+    def _resum(self):
+        np.add.reduce(self._ring[:self._count], axis=0, out=self._sum)
+        self._since_resum = 0
+
+
+def _ring_like(data, length):
+    """Allocates a (length,) + data.shape array of float64.
+
+    Each entry has the same memory layout as data, so that copying a new block
+    into the ring and adding it to the running sum are plain strided loops.
+    """
+    if data.flags.f_contiguous and not data.flags.c_contiguous:
+        ring = np.empty((length,) + data.shape[::-1])
+        return ring.transpose((0,) + tuple(range(data.ndim, 0, -1)))
+    return np.empty((length,) + data.shape)
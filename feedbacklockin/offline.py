@@ -0,0 +1,162 @@
+'''
+Re-demodulates raw captures (see capture.py) after the fact.
+
+A capture holds the raw input blocks exactly as the lockin saw them, so they
+can be demodulated again with settings other than the ones used live: other
+frequencies or harmonics, a window function, or different averaging. The
+blocks are read from the memory-mapped file a chunk of periods at a time, and
+every chunk is demodulated with one batched matmul over (periods) x (points)
+x (channels), so captures far larger than memory can be processed quickly.
+'''
+import collections
+
+import numpy as np
+
+from feedbacklockin.capture import RawCapture
+from feedbacklockin.lockin_calc import LockinCalculator
+from feedbacklockin.moving_averager import (NoneAverager,
+        ExponentialAverager, SlidingWindowAverager)
+
+
+# Results of demodulate, one row per period. X, Y, R and P are
+# (periods) x (references) x (channels), and DC is (periods) x (channels).
+# seq and timestamp are those of the last block in each period.
+Demodulated = collections.namedtuple('Demodulated', [
+    'seq', 'timestamp', 'X', 'Y', 'R', 'P', 'DC'])
+
+_WINDOWS = {
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+    'bartlett': np.bartlett,
+}
+
+_AVERAGERS = [NoneAverager, SlidingWindowAverager, ExponentialAverager]
+
+
+def windowed_reference(calculator, window):
+    """Returns the reference matrix of calculator tapered by window.
+
+    Each row is rescaled so that a unit amplitude sine at its frequency still
+    demodulates to exactly 1.
+    """
+    ref = calculator.reference
+    # ref rows are r / sum(r**2) for the raw sines and cosines r, so this
+    # gives r * w / sum(r**2 * w).
+    tapered = ref * window
+    tapered /= (np.sum(ref * ref * window, axis=1, keepdims=True)
+                / np.sum(ref * ref, axis=1, keepdims=True))
+    return tapered
+
+
+def demodulate(path, points=None, harmonics=(1,), cycles=None, window=None,
+               averaging=1, avg_type=0, chunk_periods=256, window_periods=4):
+    """Demodulates the capture at path, period by period.
+
+    points is the number of samples per period and defaults to the length of
+    one captured block. It must be a whole number of blocks. harmonics and
+    cycles select the references as in LockinCalculator, as whole numbers of
+    cycles per period. window is None for a rectangular window, the name of
+    a numpy window function ('hann', 'hamming', 'blackman' or 'bartlett'),
+    or an array of window_periods * points weights. averaging and avg_type
+    are as in FeedbackLockin, and average the results over periods.
+    chunk_periods sets how many periods are held in memory at once.
+
+    Over a single period, neighbouring references (and DC) are only one bin
+    apart, so a tapered window would leak them into each other. A window
+    therefore spans the last window_periods periods, which puts them that
+    many bins apart, and there is one result per period from the
+    window_periods-th on.
+
+    A gap in the block numbers splits the capture into runs that are
+    demodulated separately, so no result spans a gap. The averaging carries
+    on across them.
+
+    Returns a Demodulated tuple.
+    """
+    capture = RawCapture.open(path)
+    rows = capture.inputs.shape[1]
+    channels = capture.inputs.shape[2]
+    if points is None:
+        points = rows
+    if points % rows:
+        raise ValueError(f'{points} points per period is not a whole number '
+                         f'of {rows} point blocks')
+    blocks = points // rows
+
+    calculator = LockinCalculator(points, harmonics)
+    if cycles is not None:
+        calculator.set_cycles(cycles)
+    nref = len(calculator.cycles)
+    if window is None:
+        span = 1
+        refs = [calculator.reference]
+    else:
+        span = max(int(window_periods), 1)
+        spanned = LockinCalculator(span * points)
+        spanned.set_cycles([c * span for c in calculator.cycles])
+        if isinstance(window, str):
+            # Periodic rather than symmetric, so that the references stay
+            # orthogonal to each other and to DC.
+            window = _WINDOWS[window](span * points + 1)[:-1]
+        window = np.asarray(window, dtype=np.float64)
+        if window.shape != (span * points,):
+            raise ValueError(f'need a window of {span * points} points, got '
+                             f'{window.size}')
+        ref = windowed_reference(spanned, window)
+        # One slice per period, each applied to its own period of data.
+        refs = [np.ascontiguousarray(ref[:, k * points:(k + 1) * points])
+                for k in range(span)]
+
+    amp_averager = _AVERAGERS[avg_type]()
+    dc_averager = _AVERAGERS[avg_type]()
+    amp_averager.set_averaging(averaging)
+    dc_averager.set_averaging(averaging)
+
+    # Blocks either side of a missing one, which the engine fell behind on
+    # or a dump left out as torn, are not one continuous signal. So every run
+    # of consecutively numbered blocks is demodulated on its own.
+    slots = capture.slots()
+    seqs = capture.seqs[slots]
+    runs = []
+    for run in np.split(np.arange(len(slots)),
+                        np.flatnonzero(np.diff(seqs) != 1) + 1):
+        if not len(run) or seqs[run[0]] < 0:
+            continue
+        # Blocks are numbered from 1 starting on a period boundary, so skip
+        # ahead to the first block that starts a period.
+        run = slots[run[-(seqs[run[0]] - 1) % blocks:]]
+        # Result i covers periods i to i + span - 1 of the run.
+        count = len(run) // blocks - span + 1
+        if count > 0:
+            runs.append((run, count))
+    periods = sum(count for _, count in runs)
+    seq = np.empty(periods, dtype=np.int64)
+    timestamp = np.empty(periods)
+    amps = np.empty((periods, 2 * nref, channels))
+    dc = np.empty((periods, channels))
+    done = 0
+    for run, count in runs:
+        for first in range(0, count, chunk_periods):
+            last = min(first + chunk_periods, count)
+            n = last - first
+            idx = run[first * blocks:(last + span - 1) * blocks]
+            # Gathering the blocks copies only this chunk out of the file.
+            data = capture.inputs[idx].reshape((n + span - 1, points,
+                                                channels))
+            calced = np.matmul(refs[0], data[:n])
+            for k in range(1, span):
+                calced += np.matmul(refs[k], data[k:k + n])
+            out = slice(done + first, done + last)
+            amps[out] = amp_averager.steps(calced)
+            dc[out] = dc_averager.steps(np.mean(data[span - 1:], axis=1))
+            ends = idx[span * blocks - 1::blocks]
+            seq[out] = capture.seqs[ends]
+            timestamp[out] = capture.timestamps[ends]
+        done += count
+
+    X = amps[:, :nref]
+    Y = amps[:, nref:]
+    return Demodulated(seq=seq, timestamp=timestamp, X=X, Y=Y,
+                       R=np.hypot(X, Y), P=np.degrees(np.arctan2(Y, X)),
+                       DC=dc)
@@ -0,0 +1,243 @@
+'''
+Version 2 of the binary reply format of the TCP API.
+
+Every binary reply is one frame: a fixed little-endian header followed by a
+payload of float64s. The header carries
+
+    magic      4 bytes, b'FBL2'
+    version    uint16, currently 2
+    channels   uint16, number of lockin channels
+    mask       uint32, which fields are in the payload (see FIELDS)
+    length     uint32, payload length in bytes
+    seq        uint64, frame sequence number from the engine
+    timestamp  float64, time.monotonic() on the lockin PC when the frame was
+               published
+    harmonics  uint16, rows of the Xh, Yh and Ph fields
+    refs       uint16, rows of the Xm and Ym fields (0 without per-channel
+               frequencies)
+    dropped    uint32, for subscriptions, how many frames were dropped so
+               far because the client fell behind, otherwise 0
+
+The payload holds each field whose bit is set in the mask, in the order of
+FIELDS, each flattened in C order. Fields of one value per channel are
+(channels) long, Xh, Yh and Ph are (harmonics) x (channels), and Xm and Ym
+are (refs) x (channels). D, the derived quantities, comes last and takes up
+the rest of the payload, one value per quantity. This module does not import Qt, so clients can use
+it as well.
+
+A command that has a reply and fails gets an error line instead, b'error '
+followed by the reason and a newline. Its first four bytes can't be a magic,
+so a client expecting a frame can tell the two apart.
+
+It also holds the encoding of the original replies and the parsing shared
+by the servers.
+'''
+import re
+import struct
+
+import numpy as np
+
+
+# The TCP port the servers listen on unless [TCP] sets one.
+PORT = 10000
+
+MAGIC = b'FBL2'
+VERSION = 2
+HEADER = struct.Struct('<4sHHIIQdHHI')
+
+# Bit i of a field mask selects FIELDS[i].
+FIELDS = ('vOuts', 'vIns', 'X', 'Y', 'P', 'DC', 'Xh', 'Yh', 'Ph', 'Xm', 'Ym',
+          'D')
+_MATRIX_FIELDS = ('Xm', 'Ym')
+_HARMONIC_FIELDS = ('Xh', 'Yh', 'Ph')
+
+# Commands that always get a reply, an error line if they fail.
+REPLYING = frozenset(('sendData', 'send_data', 'get_frame', 'protocol',
+                      'send_matrix', 'identify_status', 'derived',
+                      'wait_settled'))
+ERROR = b'error '
+
+# The fields of the original send_data reply.
+DEFAULT_MASK = sum(1 << FIELDS.index(f)
+                   for f in ('vOuts', 'vIns', 'X', 'P', 'DC'))
+
+
+def parse_mask(text):
+    """Parses a field mask given as an integer or comma-separated names."""
+    if not text:
+        return DEFAULT_MASK
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    mask = 0
+    for name in text.split(','):
+        if name not in FIELDS:
+            raise ValueError(f'unknown field {name}')
+        mask |= 1 << FIELDS.index(name)
+    return mask
+
+
+def field_names(mask):
+    return [f for i, f in enumerate(FIELDS) if mask & (1 << i)]
+
+
+def pack_frame(snap, mask=DEFAULT_MASK, dropped=0):
+    """Encodes the fields of a Snapshot selected by mask as one frame.
+
+    Fields the snapshot doesn't have, such as Xm without per-channel
+    frequencies, are left out of the mask of the reply.
+    """
+    arrays = []
+    sent = 0
+    for i, name in enumerate(FIELDS):
+        if mask & (1 << i) and getattr(snap, name) is not None:
+            arrays.append(getattr(snap, name))
+            sent |= 1 << i
+    payload = b''.join(np.ascontiguousarray(a).tobytes() for a in arrays)
+    header = HEADER.pack(
+        MAGIC, VERSION, len(snap.X), sent, len(payload), snap.seq,
+        snap.timestamp, len(snap.Xh),
+        len(snap.Xm) if snap.Xm is not None else 0, dropped)
+    return header + payload
+
+
+def pack_error(message):
+    """Encodes the error line sent in place of a failed command's reply."""
+    return ERROR + ' '.join(str(message).split()).encode('utf-8') + b'\n'
+
+
+def unpack_header(data):
+    """Decodes a header into a dict, checking its magic and version."""
+    (magic, version, channels, mask, length, seq, timestamp, harmonics,
+     refs, dropped) = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError(f'bad magic {magic!r}')
+    if version != VERSION:
+        raise ValueError(f'unsupported protocol version {version}')
+    return dict(channels=channels, mask=mask, length=length, seq=seq,
+                timestamp=timestamp, harmonics=harmonics, refs=refs,
+                dropped=dropped)
+
+
+def unpack_payload(header, payload):
+    """Splits a payload into a dict of field name to numpy array.
+
+    The arrays are views into payload, with no copying.
+    """
+    channels = header['channels']
+    fields = {}
+    offset = 0
+    for name in field_names(header['mask']):
+        if name in _HARMONIC_FIELDS:
+            shape = (header['harmonics'], channels)
+        elif name in _MATRIX_FIELDS:
+            shape = (header['refs'], channels)
+        elif name == 'D':
+            shape = ((len(payload) - offset) // 8,)
+        else:
+            shape = (channels,)
+        count = int(np.prod(shape))
+        fields[name] = np.frombuffer(payload, dtype='<f8', count=count,
+                                     offset=offset).reshape(shape)
+        offset += 8 * count
+    if offset != len(payload):
+        raise ValueError(f'payload is {len(payload)} bytes, expected {offset}')
+    return fields
+
+
+def pack_legacy(snap):
+    """Encodes the original send_data reply of a Snapshot.
+
+    X and phase of any harmonics beyond the fundamental follow the original
+    five arrays, so the reply is unchanged without them.
+    """
+    extra = [a for h in range(1, len(snap.Xh))
+             for a in (snap.Xh[h], snap.Ph[h])]
+    return np.concatenate([
+        snap.vOuts,
+        snap.vIns,
+        snap.X,
+        snap.P,
+        snap.DC] + extra).tobytes('F')
+
+
+def pack_matrix(snap):
+    """Encodes the send_matrix reply, one (inputs, refs, 2) block.
+
+    The references are the per-channel frequencies if they are enabled,
+    and the harmonics otherwise. The last axis is X and Y.
+    """
+    if snap.Xm is not None:
+        X, Y = snap.Xm, snap.Ym
+    else:
+        X, Y = snap.Xh, snap.Yh
+    return np.stack((X.T, Y.T), axis=-1).tobytes('C')
+
+
+def payload_size(line):
+    """Bytes of binary payload following line, or None if there are none.
+
+    Vector commands can be sent as "COMMAND binary COUNT" followed by COUNT
+    little-endian float64s.
+    """
+    l = line.split(' ')
+    if len(l) == 3 and l[1] == 'binary' and l[2].isdigit():
+        return 8 * int(l[2])
+    return None
+
+
+def parse_vector(args, payload=None, size=None):
+    """Parses the values of a vector command into an array.
+
+    The values come either from payload or from the arguments, separated by
+    spaces or commas. If size is given, there must be exactly that many.
+    """
+    if payload is not None:
+        values = np.frombuffer(payload, dtype='<f8').astype(np.float64)
+    else:
+        values = [v for v in re.split(r'[,\s]+', ' '.join(args)) if v]
+        if not values:
+            raise ValueError('no values given')
+        values = np.array([float(v) for v in values])
+    if size is not None and len(values) != size:
+        raise ValueError(f'need {size} values, got {len(values)}')
+    return values
+
+
+def parse_gains(args, payload, channels):
+    """Parses the values of set_gains into (ki, kp).
+
+    Two values are one ki and one kp for every channel. Otherwise there must
+    be one ki per channel followed by one kp per channel, each returned as a
+    vector (NaN for no change).
+    """
+    values = parse_vector(args, payload)
+    if len(values) == 2:
+        return float(values[0]), float(values[1])
+    if len(values) != 2 * channels:
+        raise ValueError(f'need 2 or {2 * channels} values, got '
+                         f'{len(values)}')
+    return values[:channels], values[channels:]
+
+
+def parse_channel(text, channels):
+    """Parses a channel number, which must be below channels."""
+    chan = int(text)
+    if not 0 <= chan < channels:
+        raise ValueError(f'channel {chan} out of range')
+    return chan
+
+
+def parse_gain(args, channels):
+    """Parses the arguments of a gain command, GAIN or CHAN GAIN.
+
+    Returns the gain, or a vector that is NaN for every other channel.
+    """
+    if len(args) == 1:
+        return float(args[0])
+    if len(args) != 2:
+        raise ValueError('need GAIN or CHAN GAIN')
+    gains = np.full(channels, np.nan)
+    gains[parse_channel(args[0], channels)] = float(args[1])
+    return gains
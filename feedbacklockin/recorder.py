@@ -0,0 +1,180 @@
+'''
+A Recorder streams the results of every frame to disk.
+
+Each recording is a directory holding an index.json and numbered segment
+files. A segment is a flat, append-only run of fixed-size records, one per
+frame, with the fields seq, timestamp, vOuts, vIns (the setpoints), X, Y, P
+and DC. The index stores the record dtype and the list of segments, so a
+recording can be memory-mapped with load() without parsing anything else. A
+segment's frame count is just its size over the record size, so a recording
+that was cut off part way through is still readable.
+
+The engine hands snapshots to record(), which only puts them on a bounded
+queue. A background thread batches them into a preallocated buffer and
+writes each batch with a single call. A new segment is started once the
+current one is larger than rotate_bytes or older than rotate_seconds. If the
+disk cannot keep up, frames are dropped and counted rather than ever blocking
+the feedback loop.
+'''
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+# Fields recorded for every frame, taken from the engine's snapshots.
+_FIELDS = ('vOuts', 'vIns', 'X', 'Y', 'P', 'DC')
+
+
+def record_dtype(channels):
+    """The numpy dtype of one recorded frame."""
+    return np.dtype([('seq', np.int64), ('timestamp', np.float64)]
+                    + [(f, np.float64, (channels,)) for f in _FIELDS])
+
+
+def load(path):
+    """Memory-maps a recording, returning one record array per segment."""
+    with open(os.path.join(path, 'index.json')) as f:
+        index = json.load(f)
+    dtype = record_dtype(index['channels'])
+    segments = []
+    for name in index['segments']:
+        filename = os.path.join(path, name)
+        count = os.path.getsize(filename) // dtype.itemsize
+        if count:
+            segments.append(np.memmap(filename, dtype=dtype, mode='r',
+                                      shape=(count,)))
+    return segments
+
+
+class Recorder(object):
+    def __init__(self, directory, channels, rotate_bytes=1 << 30,
+                 rotate_seconds=3600.0, batch=256, max_queued=4096):
+        self._directory = directory
+        self._channels = channels
+        self._dtype = record_dtype(channels)
+        self._rotate_bytes = rotate_bytes
+        self._rotate_seconds = rotate_seconds
+        self._batch = batch
+        self._queue = queue.Queue(max_queued)
+        self._lock = threading.Lock()
+        # Held by record() around its check and put, so once stop() has
+        # cleared _recording under it no frame can land behind the sentinel
+        # and leak into the next recording. Kept apart from _lock, which
+        # stop() holds while joining the thread.
+        self._queue_lock = threading.Lock()
+        self._thread = None
+        self._recording = False
+        self._path = None
+        self.dropped = 0
+
+    @property
+    def recording(self):
+        return self._recording
+
+    @property
+    def path(self):
+        """Directory of the current (or last) recording."""
+        return self._path
+
+    def start(self, path=None):
+        """Starts a new recording in path, by default a timestamped directory.
+
+        Does nothing if already recording.
+        """
+        with self._lock:
+            if self._recording:
+                return
+            if not path:
+                path = os.path.join(self._directory,
+                                    time.strftime('%Y%m%d-%H%M%S'))
+            os.makedirs(path, exist_ok=True)
+            self._path = path
+            self.dropped = 0
+            self._thread = threading.Thread(target=self._run, args=(path,),
+                                            name='fbl-recorder')
+            self._thread.daemon = True
+            self._recording = True
+            self._thread.start()
+            print(f'Recording to {path}')
+
+    def stop(self):
+        """Stops recording, waiting for queued frames to be written."""
+        with self._lock:
+            if not self._recording:
+                return
+            with self._queue_lock:
+                self._recording = False
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self.dropped:
+                print(f'Recorder dropped {self.dropped} frames')
+
+    def record(self, snapshot):
+        """Queues one frame. Never blocks, and drops the frame if full."""
+        with self._queue_lock:
+            if not self._recording:
+                return
+            try:
+                self._queue.put_nowait(snapshot)
+            except queue.Full:
+                self.dropped += 1
+
+    def _run(self, path):
+        buf = np.zeros(self._batch, dtype=self._dtype)
+        segments = []
+        segment = None
+        done = False
+        while not done:
+            # Block for the first frame of a batch, then take whatever else
+            # is already waiting, up to a full batch.
+            count = 0
+            snap = self._queue.get()
+            while snap is not None:
+                row = buf[count]
+                row['seq'] = snap.seq
+                row['timestamp'] = snap.timestamp
+                for f in _FIELDS:
+                    row[f] = getattr(snap, f)
+                count += 1
+                if count == len(buf):
+                    break
+                try:
+                    snap = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            done = snap is None
+            if not count:
+                continue
+
+            if (segment is None
+                    or segment.tell() >= self._rotate_bytes
+                    or time.monotonic() - opened >= self._rotate_seconds):
+                if segment is not None:
+                    segment.close()
+                name = f'segment_{len(segments):05d}.bin'
+                segments.append(name)
+                segment = open(os.path.join(path, name), 'ab')
+                opened = time.monotonic()
+                self._write_index(path, segments)
+            segment.write(buf[:count].tobytes())
+            segment.flush()
+        if segment is not None:
+            segment.close()
+        self._write_index(path, segments)
+
+    def _write_index(self, path, segments):
+        index = {
+            'version': 1,
+            'channels': self._channels,
+            'fields': ['seq', 'timestamp'] + list(_FIELDS),
+            'segments': segments,
+        }
+        tmp = os.path.join(path, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, os.path.join(path, 'index.json'))
@@ -7,22 +7,152 @@ from functools import partial
 import socket
 import time
 
-from PySide2.QtCore import QObject, Signal
+from PySide2.QtCore import QObject, Qt, QTimer, Signal
 from PySide2.QtNetwork import QTcpServer, QHostAddress, QTcpSocket
 
+from feedbacklockin import derived
+from feedbacklockin import protocol
+from feedbacklockin import settle
+from feedbacklockin import sysid
+
+
+# Frames waiting for one subscriber, beyond which the oldest are dropped.
+_SUBSCRIBER_QUEUE = 64
+# Bytes the socket may have buffered before a subscriber stops pulling more
+# frames off its queue.
+_MAX_PENDING_BYTES = 1 << 20
+
+
+class _Subscriber(QObject):
+    """Pushes a Subscription's frames to one connection.
+
+    ready is emitted from the engine thread and delivered on the GUI thread,
+    which is the only one allowed to touch the socket.
+    """
+    ready = Signal()
+
+    def __init__(self, conn, engine, mask, decimation):
+        QObject.__init__(self)
+        self._conn = conn
+        self._engine = engine
+        self.ready.connect(self._flush, Qt.QueuedConnection)
+        conn.bytesWritten.connect(self._flush)
+        self._sub = engine.subscribe(mask, decimation, _SUBSCRIBER_QUEUE,
+                                     self.ready.emit)
+
+    def close(self):
+        self._engine.unsubscribe(self._sub)
+        self._conn.bytesWritten.disconnect(self._flush)
+
+    def _flush(self, *_):
+        # Leave frames queued while the client is slow, so that the queue,
+        # rather than the socket buffer, takes the backlog.
+        while self._conn.bytesToWrite() < _MAX_PENDING_BYTES:
+            snap = self._sub.pop()
+            if snap is None:
+                return
+            self._conn.write(protocol.pack_frame(snap, self._sub.mask,
+                                                 self._sub.dropped))
+
+
+class _SettleWaiter(QObject):
+    """Replies to one wait_settled once it is settled or has timed out.
+
+    Like _Subscriber, it is told about new frames from the engine thread
+    and checks them on the GUI thread. done(conn) is called once replied.
+    """
+    ready = Signal()
+
+    def __init__(self, conn, engine, chans, tol, timeout, done):
+        QObject.__init__(self)
+        self._conn = conn
+        self._engine = engine
+        self._chans = chans
+        self._tol = tol
+        self._done = done
+        # ready is queued, so _check can still run after a timeout or a
+        # disconnect has closed this waiter. Only the first reply counts.
+        self._finished = False
+        self._snap = engine.snapshot()
+        # The frame after next is the first one any change sent before this
+        # command is sure to have reached.
+        self._first = self._snap.seq + 2
+        self.ready.connect(self._check, Qt.QueuedConnection)
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(partial(self._finish, 'timeout'))
+        self._timer.start(int(timeout * 1000))
+        self._sub = engine.subscribe(0, 1, 1, self.ready.emit)
+
+    def close(self):
+        self._finished = True
+        self._timer.stop()
+        self._engine.unsubscribe(self._sub)
+
+    def _check(self):
+        if self._finished:
+            return
+        snap = self._sub.pop()
+        if snap is None:
+            return
+        self._snap = snap
+        if (snap.seq >= self._first
+                and settle.settled(snap, self._chans, self._tol)):
+            self._finish('settled')
+
+    def _finish(self, result):
+        if self._finished:
+            return
+        self.close()
+        self._conn.write(f'{result} {self._snap.seq}\n'.encode('utf-8'))
+        self._done(self._conn)
+
 
 class Server(QObject):
 
     send_data = Signal(QTcpSocket)
+    # The connection and the field mask of the reply.
+    send_frame = Signal(QTcpSocket, int)
+    send_matrix = Signal(QTcpSocket)
     set_v = Signal(int, float)
     set_i = Signal(int, float)
     set_ki = Signal(float)
+    set_kp = Signal(float)
     set_feed = Signal(int, bool)
-    autotune = Signal(float)
+    # Vector forms, with one value per channel (NaN for no change).
+    set_vs = Signal(object)
+    set_is = Signal(object)
+    set_feeds = Signal(object)
+    # Each gain is one float for every channel, or one per channel.
+    set_gains = Signal(object, object)
+    # Per-channel gains (NaN for no change), and the slew limit.
+    set_kis = Signal(object)
+    set_kps = Signal(object)
+    set_slew = Signal(float)
+    # A flattened (inputs) x (outputs) response matrix, or None.
+    set_response = Signal(object)
+    # The amplitude and target frames, None for the defaults, and decouple.
+    identify = Signal(object, object, bool)
+    identify_cancel = Signal()
     reset_avg = Signal()
+    start_recording = Signal(str)
+    stop_recording = Signal()
+    dump_capture = Signal(float, str)
+    # The name and the parsed derived.Quantity.
+    define_derived = Signal(str, object)
+    remove_derived = Signal(str)
 
-    def __init__(self, port):
+    def __init__(self, port, engine=None):
         QObject.__init__(self)
+        # Needed for subscriptions, which bypass the signals below.
+        self._engine = engine
+        self._subscribers = {}
+        # Lines of any unfinished batch, per connection.
+        self._batches = {}
+        # (command line, bytes) of a binary payload still to be read.
+        self._payloads = {}
+        # Any unanswered wait_settled, per connection.
+        self._waiters = {}
         self._server = QTcpServer()
         self._server.newConnection.connect(self._new_connection)
         self._server.acceptError.connect(self._accept_error)
@@ -36,10 +166,63 @@ class Server(QObject):
 
     def _new_connection(self):
         conn = self._server.nextPendingConnection()
+        conn.disconnected.connect(partial(self._unsubscribe, conn))
+        conn.disconnected.connect(partial(self._batches.pop, conn, None))
+        conn.disconnected.connect(partial(self._payloads.pop, conn, None))
+        conn.disconnected.connect(partial(self._cancel_wait, conn))
         conn.disconnected.connect(conn.deleteLater)
         conn.readyRead.connect(partial(self._handle, conn))
         conn.error.connect(self._conn_error)
 
+    def _subscribe(self, conn, mask, decimation):
+        if self._engine is None:
+            raise ValueError('subscriptions need an engine')
+        self._unsubscribe(conn)
+        self._subscribers[conn] = _Subscriber(conn, self._engine, mask,
+                                              decimation)
+
+    def _unsubscribe(self, conn):
+        sub = self._subscribers.pop(conn, None)
+        if sub is not None:
+            sub.close()
+
+    def _snapshot(self, command):
+        # The few commands that read the lockin's state need the engine, and
+        # read it from its latest snapshot.
+        if self._engine is None:
+            raise ValueError(f'{command} needs an engine')
+        return self._engine.snapshot()
+
+    def _channels(self, command):
+        return len(self._snapshot(command).X)
+
+    def _channel(self, l):
+        return protocol.parse_channel(l[1], self._channels(l[0]))
+
+    def _vector(self, l, payload, size=None):
+        # Checked against the channel count here, rather than only where it
+        # is used, so that a batch counts only what will be applied.
+        return protocol.parse_vector(l[1:], payload,
+                                     size or self._channels(l[0]))
+
+    def _wait_settled(self, conn, args):
+        if self._engine is None:
+            raise ValueError('waiting needs an engine')
+        chans, tol, timeout = settle.parse_wait(
+                args, len(self._engine.snapshot().X))
+        self._waiters[conn] = _SettleWaiter(conn, self._engine, chans, tol,
+                                            timeout, self._wait_done)
+
+    def _wait_done(self, conn):
+        del self._waiters[conn]
+        # Carry on with any commands that came in while waiting.
+        self._handle(conn)
+
+    def _cancel_wait(self, conn):
+        waiter = self._waiters.pop(conn, None)
+        if waiter is not None:
+            waiter.close()
+
     def _accept_error(self, err):
         print(f'Error accepting connection: {err}')
 
@@ -47,28 +230,162 @@ class Server(QObject):
         print(f'Connection error: {err}')
 
     def _handle(self, conn):
-        l = conn.readLine().data().decode('utf-8').strip().split(' ')
+        # A client may send several commands at once, so run every complete
+        # line. Qt keeps any partial line buffered until the rest arrives.
+        # While a wait_settled is unanswered, later lines stay buffered so
+        # that replies keep their order.
+        while conn not in self._waiters:
+            if conn in self._payloads:
+                # The binary payload of the previous line.
+                line, size = self._payloads[conn]
+                if conn.bytesAvailable() < size:
+                    return
+                del self._payloads[conn]
+                command = (line, conn.read(size).data())
+            elif conn.canReadLine():
+                line = conn.readLine().data().decode('utf-8').strip()
+                size = protocol.payload_size(line)
+                if size is not None:
+                    self._payloads[conn] = (line, size)
+                    continue
+                command = (line, None)
+            else:
+                return
+            batch = self._batches.get(conn)
+            if batch is not None:
+                if line == 'end':
+                    self._run_batch(conn, self._batches.pop(conn))
+                elif line:
+                    batch.append(command)
+            elif line == 'batch':
+                self._batches[conn] = []
+            elif line.startswith('wait_settled'):
+                try:
+                    self._wait_settled(conn, line.split(' ')[1:])
+                except ValueError as e:
+                    self._reject(conn, line.split(' '), e)
+            elif line:
+                self._command(conn, *command)
+
+    def _run_batch(self, conn, lines):
+        # Every change in the batch reaches the lockin between the same two
+        # frames. The client gets a single line back: how many commands
+        # were applied and how many failed.
+        if self._engine is not None:
+            self._engine.begin_batch()
+        try:
+            ok = sum(self._command(conn, *command) for command in lines)
+        finally:
+            if self._engine is not None:
+                self._engine.end_batch()
+        conn.write(f'batch {ok} {len(lines) - ok}\n'.encode('utf-8'))
+
+    def _command(self, conn, line, payload=None):
+        """Runs one command line, returning whether it was valid.
+
+        payload holds the bytes that followed the line, for commands that
+        take a binary vector.
+        """
+        l = line.split(' ')
         try:
             if l[0] == 'sendData' or l[0] == 'send_data':
                 self.send_data.emit(conn)
+            elif l[0] == 'get_frame':
+                self.send_frame.emit(conn, protocol.parse_mask(
+                        l[1] if len(l) == 2 else ''))
+            elif l[0] == 'subscribe':
+                self._subscribe(conn,
+                        protocol.parse_mask(l[1] if len(l) > 1 else ''),
+                        int(l[2]) if len(l) > 2 else 1)
+            elif l[0] == 'unsubscribe':
+                self._unsubscribe(conn)
+            elif l[0] == 'protocol':
+                conn.write(f'{protocol.VERSION}\n'.encode('utf-8'))
+            elif l[0] == 'send_matrix':
+                self.send_matrix.emit(conn)
             elif l[0] == 'setV' or l[0] == 'set_setpoint':
-                self.set_v.emit(int(l[1]), float(l[2]))
+                self.set_v.emit(self._channel(l), float(l[2]))
             elif l[0] == 'setI' or l[0] == 'set_amplitude':
-                self.set_i.emit(int(l[1]), float(l[2]))
+                self.set_i.emit(self._channel(l), float(l[2]))
             elif l[0] == 'setKi' or l[0] == 'set_ki':
-                self.set_ki.emit(float(l[1]))
+                # Only a per-channel gain needs the number of channels.
+                gain = protocol.parse_gain(
+                        l[1:], self._channels(l[0]) if len(l) == 3 else 0)
+                if isinstance(gain, float):
+                    self.set_ki.emit(gain)
+                else:
+                    self.set_kis.emit(gain)
+            elif l[0] == 'set_kp':
+                gain = protocol.parse_gain(
+                        l[1:], self._channels(l[0]) if len(l) == 3 else 0)
+                if isinstance(gain, float):
+                    self.set_kp.emit(gain)
+                else:
+                    self.set_kps.emit(gain)
+            elif l[0] == 'set_kis':
+                self.set_kis.emit(self._vector(l, payload))
+            elif l[0] == 'set_kps':
+                self.set_kps.emit(self._vector(l, payload))
+            elif l[0] == 'set_slew':
+                self.set_slew.emit(float(l[1]))
             elif l[0] == 'setFeed' or l[0] == 'set_feedback':
-                self.set_feed.emit(int(l[1]), bool(int(l[2])))
+                self.set_feed.emit(self._channel(l), bool(int(l[2])))
+            elif l[0] == 'set_setpoints':
+                self.set_vs.emit(self._vector(l, payload))
+            elif l[0] == 'set_amplitudes':
+                self.set_is.emit(self._vector(l, payload))
+            elif l[0] == 'set_feedback_mask':
+                self.set_feeds.emit(self._vector(l, payload) != 0)
+            elif l[0] == 'set_gains':
+                self.set_gains.emit(*protocol.parse_gains(
+                        l[1:], payload, self._channels(l[0])))
+            elif l[0] == 'set_response':
+                self.set_response.emit(self._vector(
+                        l, payload, self._channels(l[0])**2))
+            elif l[0] == 'clear_response':
+                self.set_response.emit(None)
+            elif l[0] == 'identify':
+                self.identify.emit(*sysid.parse_identify(l[1:]))
             elif l[0] == 'autoTune' or l[0] == 'autotune':
-                if len(l) == 2:
-                    self.autotune.emit(float(l[1]))
-                else:
-                    self.autotune.emit(1.0)
+                # Its old scale factor argument is ignored.
+                self.identify.emit(None, None, False)
+            elif l[0] == 'identify_cancel':
+                self.identify_cancel.emit()
+            elif l[0] == 'identify_status':
+                state, done, total = self._snapshot(l[0]).identify
+                conn.write(f'{state} {done} {total}\n'.encode('utf-8'))
             elif l[0] == 'reset_avg':
                 self.reset_avg.emit()
+            elif l[0] == 'start_recording':
+                self.start_recording.emit(l[1] if len(l) == 2 else '')
+            elif l[0] == 'stop_recording':
+                self.stop_recording.emit()
+            elif l[0] == 'dump_capture':
+                self.dump_capture.emit(float(l[1]),
+                                       l[2] if len(l) == 3 else '')
+            elif l[0] == 'define':
+                self.define_derived.emit(l[1], derived.parse(
+                        ' '.join(l[2:]), self._channels(l[0])))
+            elif l[0] == 'undefine':
+                self.remove_derived.emit(l[1])
+            elif l[0] == 'wait_settled':
+                raise ValueError("can't wait inside a batch")
+            elif l[0] == 'derived':
+                names = self._snapshot(l[0]).derived_names
+                conn.write((','.join(names) + '\n').encode('utf-8'))
             else:
                 raise ValueError('command not found')
         except ValueError as e:
-            print(f'Bad command {l}: {e}')
+            self._reject(conn, l, e)
+            return False
         except IndexError as e:
-            print(f'Bad command {l}: wrong number of arguments')
+            self._reject(conn, l, 'wrong number of arguments')
+            return False
+        return True
+
+    def _reject(self, conn, l, reason):
+        print(f'Bad command {l}: {reason}')
+        # A client waiting for a reply gets an error line rather than none.
+        if l[0] in protocol.REPLYING:
+            conn.write(protocol.pack_error(reason))
+
@@ -0,0 +1,78 @@
+'''
+Tracks whether each channel has settled, so clients can wait for feedback to
+converge instead of polling.
+
+Every frame, a SettleDetector takes the feedback error and X of every
+channel into rings of the last window frames. From those it keeps the RMS
+error and the drift, the change of X across the window from a least squares
+line fit. A channel is locked once both are below tol. Channels without
+feedback have no error to speak of, so only their drift counts. Until the
+rings have filled, both are inf.
+'''
+import numpy as np
+
+
+class SettleDetector(object):
+    def __init__(self, channels, window=10, tol=1e-3):
+        window = max(int(window), 2)
+        self.window = window
+        self.tol = tol
+        self._x = np.zeros((window, channels))
+        self._err = np.zeros((window, channels))
+        self._sq = np.zeros((window, channels))
+        self._head = 0
+        self._count = 0
+        # Row h holds the line fit weights for when the newest frame is in
+        # ring slot h, scaled to give the change across the whole window.
+        age = (np.arange(window)[:, None] - np.arange(window)) % window
+        t = -age.astype(np.float64)
+        t -= t.mean(axis=1, keepdims=True)
+        self._weights = t / np.sum(t * t, axis=1, keepdims=True) * (window - 1)
+        self.error = np.full(channels, np.inf)
+        self.drift = np.full(channels, np.inf)
+        self.locked = np.zeros(channels, dtype=bool)
+
+    def reset(self):
+        self._count = 0
+        self.error.fill(np.inf)
+        self.drift.fill(np.inf)
+        self.locked.fill(False)
+
+    def step(self, x, err, feedback_mask):
+        """Adds one frame's X and feedback errors."""
+        self._head = (self._head + 1) % self.window
+        np.copyto(self._x[self._head], x)
+        np.copyto(self._err[self._head], err)
+        self._count += 1
+        if self._count < self.window:
+            return
+        np.dot(self._weights[self._head], self._x, out=self.drift)
+        np.abs(self.drift, out=self.drift)
+        np.square(self._err, out=self._sq)
+        np.mean(self._sq, axis=0, out=self.error)
+        np.sqrt(self.error, out=self.error)
+        np.copyto(self.error, 0.0, where=~feedback_mask)
+        np.less(np.maximum(self.error, self.drift), self.tol, out=self.locked)
+
+
+def parse_wait(args, channels):
+    """Parses the arguments of wait_settled: CHANNELS TOL TIMEOUT.
+
+    CHANNELS is 'all' or a comma-separated list. Returns the channel
+    indices, the tolerance and the timeout in seconds.
+    """
+    if len(args) != 3:
+        raise ValueError('wait_settled takes CHANNELS TOL TIMEOUT')
+    if args[0] == 'all':
+        chans = np.arange(channels)
+    else:
+        chans = np.array([int(c) for c in args[0].split(',')], dtype=np.intp)
+        if np.any((chans < 0) | (chans >= channels)):
+            raise ValueError('channel out of range')
+    return chans, float(args[1]), float(args[2])
+
+
+def settled(snap, chans, tol):
+    """Whether the channels chans of a Snapshot have settled to within tol."""
+    return bool(np.all(snap.error[chans] < tol)
+                and np.all(snap.drift[chans] < tol))
@@ -0,0 +1,183 @@
+'''
+Publishes the latest frames in shared memory for other processes on the same
+machine, with no socket in between.
+
+The segment starts with a small header followed by a ring of slots, one frame
+each. A slot holds the frame's seq and timestamp, its vOuts, vIns (the
+setpoints), X, Y, P and DC, and optionally the raw input block. Every slot
+also has a seqlock counter. The writer makes it odd before changing the slot
+and even again once done, so a reader that sees the same even value before
+and after reading knows it got a consistent frame.
+
+SharedFramesReader maps the same segment. Reading a frame copies its slot
+out, between the two reads of the counter, so a frame that passed the check
+stays consistent however long it is kept. The copies go into a buffer the
+caller can allocate once with buffer() and pass in again, so polling needs
+no allocation per frame.
+'''
+import collections
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+_MAGIC = b'FBLSHM01'
+
+_HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('channels', np.int64),
+    ('raw_rows', np.int64),
+    ('capacity', np.int64),
+    # Frames published so far. The latest is in slot (count - 1) % capacity.
+    ('count', np.int64),
+])
+
+_FIELDS = ('vOuts', 'vIns', 'X', 'Y', 'P', 'DC')
+
+# A frame read from shared memory. The arrays are views into the buffer it
+# was copied to.
+Frame = collections.namedtuple('Frame', ('seq', 'timestamp') + _FIELDS
+                               + ('raw',))
+
+
+def _slot_dtype(channels, raw_rows):
+    fields = [('lock', np.uint64), ('seq', np.int64), ('timestamp', np.float64)]
+    fields += [(f, np.float64, (channels,)) for f in _FIELDS]
+    if raw_rows:
+        fields.append(('raw', np.float64, (raw_rows, channels)))
+    return np.dtype(fields, align=True)
+
+
+def _layout(buf):
+    header = np.ndarray((), dtype=_HEADER, buffer=buf)
+    dtype = _slot_dtype(int(header['channels']), int(header['raw_rows']))
+    slots = np.ndarray(int(header['capacity']), dtype=dtype, buffer=buf,
+                       offset=_HEADER.itemsize)
+    return header, slots
+
+
+class SharedFrames(object):
+    """The writing side, owned by the engine.
+
+    If a segment called name already exists, raises FileExistsError, since
+    readers may still be attached to it. With replace, unlinks it first, for
+    one left behind by a lockin that didn't shut down cleanly.
+    """
+    def __init__(self, name, channels, capacity=64, raw_rows=0,
+                 replace=False):
+        size = (_HEADER.itemsize
+                + capacity * _slot_dtype(channels, raw_rows).itemsize)
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                                                   size=size)
+        except FileExistsError:
+            if not replace:
+                raise FileExistsError(
+                        f'shared memory segment {name} already exists; is '
+                        'another lockin running? Set replace=true in [SHM] '
+                        'to remove it') from None
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                                                   size=size)
+        header = np.ndarray((), dtype=_HEADER, buffer=self._shm.buf)
+        header['channels'] = channels
+        header['raw_rows'] = raw_rows
+        header['capacity'] = capacity
+        header['count'] = 0
+        self._header, self._slots = _layout(self._shm.buf)
+        self._slots['lock'] = 0
+        # Set last, so readers never see a half-initialised header.
+        header['magic'] = _MAGIC
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def publish(self, snap, raw=None):
+        """Writes a Snapshot, and optionally the raw block, to the next slot."""
+        count = int(self._header['count'])
+        slot = self._slots[count % len(self._slots), ...]
+        slot['lock'] += 1
+        slot['seq'] = snap.seq
+        slot['timestamp'] = snap.timestamp
+        for f in _FIELDS:
+            slot[f] = getattr(snap, f)
+        if raw is not None and 'raw' in self._slots.dtype.names:
+            slot['raw'] = raw
+        slot['lock'] += 1
+        self._header['count'] = count + 1
+
+    def close(self):
+        del self._header, self._slots
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedFramesReader(object):
+    """Maps the frames published by a running lockin."""
+    def __init__(self, name='feedbacklockin'):
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 the resource tracker would unlink the
+            # segment when this process exits, from under the lockin.
+            from multiprocessing import resource_tracker
+            self._shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._header, self._slots = _layout(self._shm.buf)
+        if self._header['magic'] != _MAGIC:
+            raise ValueError(f'{name} does not hold lockin frames')
+        self._slots.setflags(write=False)
+
+    @property
+    def count(self):
+        """Frames published so far."""
+        return int(self._header['count'])
+
+    def buffer(self, n=1):
+        """Returns room for n frames, to pass to latest() or frames()."""
+        return np.zeros(n, dtype=self._slots.dtype)
+
+    def latest(self, out=None):
+        """Returns the newest consistent Frame, or None before the first."""
+        frames = self.frames(1, out)
+        return frames[0] if frames else None
+
+    def frames(self, n, out=None):
+        """Returns up to the last n consistent Frames, oldest first.
+
+        The frames are copied into out, from buffer(n), if given. Reusing it
+        overwrites the frames returned last time. At most capacity - 1
+        frames are returned, since the oldest slot is the next the writer
+        will overwrite.
+        """
+        count = self.count
+        first = max(count - min(n, len(self._slots) - 1), 0)
+        if out is None:
+            out = self.buffer(count - first)
+        elif len(out) < count - first:
+            raise ValueError(f'need room for {count - first} frames')
+        frames = []
+        for i in range(first, count):
+            frame = self._read(i % len(self._slots), out[len(frames), ...])
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def close(self):
+        del self._header, self._slots
+        self._shm.close()
+
+    def _read(self, index, out):
+        slot = self._slots[index, ...]
+        lock = int(slot['lock'])
+        if lock % 2:
+            return None
+        out[...] = slot
+        if int(slot['lock']) != lock:
+            return None
+        return Frame(int(out['seq']), float(out['timestamp']),
+                     *(out[f] for f in _FIELDS),
+                     out['raw'] if 'raw' in out.dtype.names else None)
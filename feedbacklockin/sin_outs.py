@@ -1,36 +1,66 @@
 '''
 A SinOutputs object emits an array of sine curves with individual amplitudes
 with a given number of points in each sine.
+
+Normally every channel runs one cycle per period. Given cycles, each channel
+instead runs its own whole number of cycles per period, so that all channels
+can be demodulated independently from a single frame.
 '''
 import numpy as np
 
 
 class SinOutputs(object):
-    def __init__(self, channels, points):
+    def __init__(self, channels, points, cycles=None):
         self._npoints = points
         self._nchannels = channels
         self._data_out = np.zeros((points, channels))
         self._amps = np.zeros(channels)
-        self._sin_ref = np.sin(2.0 * np.pi * np.arange(points) / points)
+        self._valid = np.zeros(channels, dtype=bool)
+        if cycles is None:
+            self._sin_ref = np.sin(2.0 * np.pi * np.arange(points) / points)
+            # (points x 1) and (1 x channels) views, whose matrix product is
+            # the whole output block.
+            self._sin_col = self._sin_ref[:, np.newaxis]
+            self._amps_row = self._amps[np.newaxis, :]
+        else:
+            if len(cycles) != channels:
+                raise ValueError(f'need cycles for {channels} channels, got '
+                                 f'{len(cycles)}')
+            # One column per channel at its own frequency.
+            self._sin_ref = np.sin(2.0 * np.pi
+                    * np.outer(np.arange(points), cycles) / points)
+            self._sin_col = None
 
     def setAmps(self, amps):
-        # Set the amplitudes of each sine curve.
-        dataShape = np.shape(amps)
-        if dataShape[0] == self._nchannels:
-            self._amps = amps
-            for i in range(self._nchannels):
-                if not np.isnan(amps[i]):
-                    self._data_out[:,i] = amps[i]*self._sin_ref
+        # Set the amplitudes of each sine curve. NaN amplitudes leave that
+        # channel unchanged. All curves are rebuilt with a single outer
+        # product written over the existing output buffer.
+        if len(amps) == self._nchannels:
+            np.isnan(amps, out=self._valid)
+            np.logical_not(self._valid, out=self._valid)
+            np.copyto(self._amps, amps, where=self._valid)
+            if self._sin_col is not None:
+                np.matmul(self._sin_col, self._amps_row, out=self._data_out)
+            else:
+                # einsum, unlike a broadcast multiply, scales the columns
+                # without a scratch buffer.
+                np.einsum('pc,c->pc', self._sin_ref, self._amps,
+                          out=self._data_out)
 
     def setSingleAmp(self, amp, idx):
         # Sets the amplitude of a single sine curve.
         self._amps[idx] = amp
-        self._data_out[:,idx] = amp * self._sin_ref
+        self._data_out[:,idx] = amp * self._channel_ref(idx)
 
     def shiftSingleAmp(self, deltaIn, idx):
         # Make a differential change on a single sine curve.
         self._amps[idx] += deltaIn
-        self._data_out[:,idx] = self._amps[idx] * self._sin_ref
+        self._data_out[:,idx] = self._amps[idx] * self._channel_ref(idx)
+
+    def _channel_ref(self, idx):
+        if self._sin_col is not None:
+            return self._sin_ref
+        return self._sin_ref[:, idx]
 
     def output(self):
         # Returns the series of sine curves.
@@ -0,0 +1,125 @@
+'''
+Measures how every input responds to every output while the lockin keeps
+running, to set the feedback gains from.
+
+All of the chosen outputs are perturbed at once, each with its own column of
+a Hadamard matrix as the sign pattern of its perturbation. One row of signs
+is held for settle frames, to let the inputs follow, and then the inputs are
+averaged over measure frames. Since the columns are orthogonal, and none of
+them is the all-ones column, every output's effect can be told apart from the
+others and from the unperturbed inputs. Then one least squares fit over all
+the rows gives the whole response matrix at once.
+
+It takes (settle + measure) * rows frames, where rows is the smallest power
+of two above the number of outputs, times repeats.
+'''
+import numpy as np
+
+
+def hadamard(n):
+    """Returns the n x n Sylvester Hadamard matrix. n must be a power of 2."""
+    h = np.ones((1, 1))
+    while len(h) < n:
+        h = np.block([[h, h], [h, -h]])
+    if len(h) != n:
+        raise ValueError(f'{n} is not a power of 2')
+    return h
+
+
+class Identification(object):
+    """One identification run, stepped once per frame.
+
+    base holds the amplitudes to perturb around, and chans the channels to
+    perturb by amplitude volts.
+    """
+    def __init__(self, base, chans, amplitude, settle=3, measure=2,
+                 repeats=1):
+        self.chans = np.asarray(chans, dtype=np.intp)
+        self.amplitude = float(amplitude)
+        m = len(self.chans)
+        if not m:
+            raise ValueError('no channels to identify')
+        rows = 1 << m.bit_length()
+        # Skip the all-ones first column, which can't be told apart from the
+        # unperturbed inputs.
+        self._patterns = np.tile(hadamard(rows)[:, 1:m + 1], (repeats, 1))
+        self.settle = max(int(settle), 1)
+        self._measure = max(int(measure), 1)
+        self._base = np.array(base, dtype=np.float64)
+        self._amps = self._base.copy()
+        self._sums = np.zeros((len(self._patterns), len(self._base)))
+        self._t = 0
+        self.total = len(self._patterns) * (self.settle + self._measure)
+
+    @property
+    def base(self):
+        return self._base
+
+    @property
+    def done(self):
+        """Frames measured so far."""
+        return min(self._t, self.total)
+
+    @property
+    def finished(self):
+        return self._t > self.total
+
+    def step(self, inputs):
+        """Takes this frame's inputs, and returns the next amplitudes.
+
+        The inputs are the response to the amplitudes returned by the
+        previous call. Once finished, returns the base amplitudes.
+        """
+        frames = self.settle + self._measure
+        if self._t:
+            row, phase = divmod(self._t - 1, frames)
+            if phase >= self.settle:
+                self._sums[row] += inputs
+        self._t += 1
+        if self._t > self.total:
+            return self._base
+        np.copyto(self._amps, self._base)
+        self._amps[self.chans] += (self.amplitude
+                                   * self._patterns[(self._t - 1) // frames])
+        return self._amps
+
+    def solve(self):
+        """Returns the (inputs) x (chans) response, in input per volt."""
+        means = self._sums / self._measure
+        design = np.hstack((np.ones((len(self._patterns), 1)),
+                            self.amplitude * self._patterns))
+        coeffs = np.linalg.lstsq(design, means, rcond=None)[0]
+        return coeffs[1:].T
+
+
+def parse_identify(args):
+    """Parses the arguments of an identify command, [AMPLITUDE [FRAMES]]
+    [decouple], into (amplitude, target frames, decouple). Any left out or
+    given as - are None, for the lockin's defaults.
+    """
+    decouple = 'decouple' in args
+    args = [a for a in args if a and a != 'decouple']
+    if len(args) > 2:
+        raise ValueError('too many arguments')
+    args += ['-'] * (2 - len(args))
+    amplitude = None if args[0] == '-' else float(args[0])
+    frames = None if args[1] == '-' else int(args[1])
+    if amplitude is not None and amplitude <= 0:
+        raise ValueError('amplitude must be positive')
+    if frames is not None and frames < 1:
+        raise ValueError('frames must be at least 1')
+    return amplitude, frames, decouple
+
+
+def integral_gains(response, target_frames, delay=1, settled=0.02):
+    """Returns the integral gains to settle to within settled of a step in
+    target_frames frames, for independent channels with the given response.
+
+    A change of the outputs takes delay frames to be fully seen at the
+    inputs, so the error is taken to shrink by 1 - delay * ki * response
+    every delay frames, which keeps clear of ringing.
+    """
+    delay = max(delay, 1)
+    rate = 1 - settled**(delay / max(target_frames, delay))
+    with np.errstate(divide='ignore'):
+        return rate / (delay * np.asarray(response))
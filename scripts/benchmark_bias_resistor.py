@@ -0,0 +1,85 @@
+'''
+Compares BiasResistor against the dense N x N transfer matrix it replaced.
+
+For each channel count, it checks that both give the same results, then times
+step (once per frame), and a feedback toggle: setZeroSumDisabledAxes
+followed by reverse, as in FeedbackLockin.set_feedback_mask.
+
+    python scripts/benchmark_bias_resistor.py [CHANNELS ...]
+'''
+import sys
+import timeit
+
+import numpy as np
+
+from feedbacklockin.bias_resistor import BiasResistor
+
+
+class DenseBiasResistor(object):
+    # The previous implementation: a dense matrix rebuilt with a Python loop,
+    # a matrix-vector product per step and a full inverse per reverse.
+    def __init__(self, channels):
+        self._channels = channels
+        self._amps = np.zeros(channels)
+        self._outs = np.zeros(channels)
+        self._xfer_mat = np.eye(channels)
+
+    def setZeroSumDisabledAxes(self, correctionFactor, disabledVector):
+        N = self._channels - np.sum(disabledVector)
+        if N > 1:
+            self._xfer_mat = (-np.ones((self._channels,self._channels))
+                    / (N - 1) * (1.0 - correctionFactor))
+            for i in range(self._channels):
+                if disabledVector[i]:
+                    self._xfer_mat[i,:] = 0
+                    self._xfer_mat[:,i] = 0
+                self._xfer_mat[i,i] = 1.0
+        else:
+            self._xfer_mat = np.eye(self._channels)
+
+    def step(self, amps):
+        np.copyto(self._amps, amps)
+        np.dot(self._xfer_mat, amps, out=self._outs)
+        return self._outs
+
+    def reverse(self):
+        np.dot(np.linalg.inv(self._xfer_mat), self._outs, out=self._amps)
+        return self._amps
+
+
+def _time(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main(sizes):
+    rng = np.random.default_rng(0)
+    widths = (12, 10, 14, 10)
+    print('Microseconds per call')
+    print(f'{"N":>6} {"step dense":>12} {"step":>10} '
+          f'{"toggle dense":>14} {"toggle":>10}')
+    for n in sizes:
+        disabled = (rng.random(n) < 0.25).astype(np.float64)
+        amps = rng.standard_normal(n)
+        dense = DenseBiasResistor(n)
+        fast = BiasResistor(n)
+        for br in (dense, fast):
+            br.setZeroSumDisabledAxes(0.5, disabled)
+        if not (np.allclose(dense.step(amps), fast.step(amps))
+                and np.allclose(dense.reverse(), fast.reverse())):
+            raise AssertionError(f'results differ for {n} channels')
+
+        def toggle(br):
+            br.setZeroSumDisabledAxes(0.5, disabled)
+            br.reverse()
+
+        number = max(10, 20000 // n)
+        times = [_time(lambda: dense.step(amps), number),
+                 _time(lambda: fast.step(amps), number),
+                 _time(lambda: toggle(dense), max(number // 100, 3)),
+                 _time(lambda: toggle(fast), number)]
+        print(f'{n:>6} ' + ' '.join(f'{t * 1e6:>{w}.1f}'
+                                    for t, w in zip(times, widths)))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [8, 32, 128, 256, 512, 1024])
@@ -2,7 +2,8 @@
 import time
 import numpy as np
 import socket
-import array
+import struct
+from contextlib import contextmanager
 from functools import partial
 
 import qcodes as qc
@@ -11,6 +12,13 @@ from qcodes.instrument.channel import InstrumentChannel, ChannelList
 from qcodes.instrument.channel import MultiChannelInstrumentParameter
 from qcodes.utils import validators as vals
 
+from feedbacklockin.calibration import Calibration, CalibrationSet
+
+# Header of a version 2 binary reply, see feedbacklockin/protocol.py: magic,
+# version, channels, field mask, payload bytes, frame sequence number,
+# timestamp, harmonics, references, dropped frames.
+_HEADER = struct.Struct('<4sHHIIQdHHI')
+
 class FeedbackLockin(Instrument):
     """
     Draft driver for the Feedback Lockin custom instrument (version 2)
@@ -20,14 +28,22 @@ class FeedbackLockin(Instrument):
 	# FBL.connectTCP()
 	# FBL.TCPdata.get(); # to fetch data from the TCP connection
 	# data=FBL.data; # to access stored data without calling the TCP connection
+	# with FBL.frozen(): # every get in here reads the same frame
+	#     R=Rxx.R.get(); T=OCT.Toct.get()
+
+    stored_data, the per-channel parameters and the all-channel parameters
+    (v_ins, phases, v_outs, setpoints, dcs) all read one cached frame. A new
+    frame is only fetched once the cached one is older than cache_ttl
+    seconds, so a measurement that reads many channels in one point costs a
+    single round trip.
     """
     
     
-    def __init__(self, name, TCPport, **kwargs):
+    def __init__(self, name, TCPport, cache_ttl=0.05, **kwargs):
         super().__init__(name, **kwargs)
         self.TCPport=TCPport
         self.nChannels=32 # N of FBL channels
-        self.nVars=4 # N of variables sent through TCP
+        self.nVars=5 # N of variables sent through TCP
         self.socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.add_parameter('TCPdata',
                            get_cmd=self._get_TCP_data,
@@ -35,36 +51,139 @@ class FeedbackLockin(Instrument):
         self.add_parameter('stored_data',
                            get_cmd=self._get_stored_data,
                            unit='V')
-        self.data=np.zeros([32,4])
+        self.data=np.zeros([32,5])
+        self.seq=0 # frame sequence number of data
+        self.timestamp=0.0 # when that frame was published, on the FBL PC
+        self._fetched_at=-np.inf # local time.monotonic() of the last fetch
+        self._frozen=0 # fetching is off while inside frozen()
+        self.add_parameter('cache_ttl', unit='s', initial_value=cache_ttl,
+                           get_cmd=None, set_cmd=None, vals=vals.Numbers(0))
         
         for i in range(self.nChannels):
             self.add_parameter(f'ch{i}_out', unit='V', set_cmd=partial(self._set_v_out, i))  
             self.add_parameter(f'ch{i}_in', unit='V', get_cmd=partial(self._get_single_v, i))  
+
+        # All channels at once, from a single frame.
+        for name, col, unit in (('v_outs', 0, 'V'), ('setpoints', 1, 'V'),
+                                ('v_ins', 2, 'V'), ('phases', 3, 'deg'),
+                                ('dcs', 4, 'V')):
+            self.add_parameter(name, unit=unit,
+                               get_cmd=partial(self._get_column, col),
+                               vals=vals.Arrays(shape=(self.nChannels,)))
             
     def connectTCP(self):        
         server_address = ('localhost',self.TCPport)
         self.socket.connect(server_address)
 
+    def _recv_exact(self, n):
+        # recv may return less than asked for, so keep reading until all n
+        # bytes are in.
+        buf = bytearray(n)
+        view = memoryview(buf)
+        got = 0
+        while got < n:
+            read = self.socket.recv_into(view[got:], n - got)
+            if read == 0:
+                raise ConnectionError('FBL closed the connection')
+            got += read
+        return buf
+
     def _get_TCP_data(self):
-        self.socket.sendall(b'sendData\n');
-        TCPdata = self.socket.recv(self.nVars*8*self.nChannels);
-        data=np.array(array.array('d',TCPdata))
-        data=data.reshape(self.nChannels,self.nVars, order='F')
+        # vOuts, vIns, X, phase and DC, in one frame.
+        self.socket.sendall(b'get_frame vOuts,vIns,X,P,DC\n');
+        (magic, version, channels, mask, length, seq, timestamp,
+         _, _, _) = _HEADER.unpack(self._recv_exact(_HEADER.size))
+        if magic != b'FBL2':
+            raise ValueError(f'bad reply from FBL: {magic!r}')
+        payload = self._recv_exact(length)
+        data=np.frombuffer(payload, dtype='<f8')
+        data=data.reshape(channels,self.nVars, order='F')
         self.data=data
+        self.seq=seq
+        self.timestamp=timestamp
+        self._fetched_at=time.monotonic()
         return data
+
+    def fetch(self, min_seq=None):
+        """Returns the cached frame, fetching a new one if it is stale.
+
+        If min_seq is given, keeps fetching until the frame's sequence number
+        reaches it, e.g. to wait for a few frames after changing a setpoint.
+        """
+        if (not self._frozen
+                and time.monotonic() - self._fetched_at > self.cache_ttl()):
+            self._get_TCP_data()
+        while min_seq is not None and self.seq < min_seq:
+            time.sleep(0.005)
+            self._get_TCP_data()
+        return self.data
+
+    def invalidate(self):
+        """Makes the next get fetch a new frame."""
+        self._fetched_at=-np.inf
+
+    @contextmanager
+    def frozen(self):
+        """Makes every get inside the block read the same frame."""
+        self.fetch()
+        self._frozen += 1
+        try:
+            yield self.data
+        finally:
+            self._frozen -= 1
+
+    def _get_column(self, col):
+        return np.array(self.fetch()[:,col])
     
+    def wait_settled(self, channels='all', tol=1e-3, timeout=10.0):
+        """Waits on the FBL until channels have settled to within tol.
+
+        Returns whether they settled before timeout seconds were up. Use this
+        after changing setpoints instead of polling the inputs.
+        """
+        if not isinstance(channels, str):
+            channels = ','.join(map(str, channels))
+        self.socket.sendall(f'wait_settled {channels} {tol} {timeout}\n'
+                            .encode('utf-8'))
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            line += self._recv_exact(1)
+        result, seq = line.decode('utf-8').split()
+        # Anything cached is from before the wait.
+        self.invalidate()
+        return result == 'settled'
+
+    def get_derived(self):
+        """Returns the FBL's derived quantities as a dict of name to value.
+
+        They are declared in the FBL's ini or with define over TCP, and all
+        come from the same frame.
+        """
+        self.socket.sendall(b'derived\n')
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            line += self._recv_exact(1)
+        names = [n for n in line.decode('utf-8').strip().split(',') if n]
+        self.socket.sendall(b'get_frame D\n')
+        (magic, version, channels, mask, length, seq, timestamp,
+         _, _, _) = _HEADER.unpack(self._recv_exact(_HEADER.size))
+        if magic != b'FBL2':
+            raise ValueError(f'bad reply from FBL: {magic!r}')
+        values = np.frombuffer(self._recv_exact(length), dtype='<f8')
+        return dict(zip(names, values))
+
     def reset_averaging(self):
         self.socket.sendall(b'reset_avg\n');
     
     def _get_stored_data(self):
-        data=self.data
+        data=self.fetch()
         return data
     
     def _get_single_v(self, v):
         return self.get_v_in([v])[0][0]
     
     def get_v_in(self, vs):
-        d = self.TCPdata.get()
+        d = self.fetch()
         out = []
         for v in vs:
             out.append((d[:,2][v], d[:,3][v]))
@@ -72,10 +191,12 @@ class FeedbackLockin(Instrument):
     
     def _set_v_out(self, c, v):
         self.socket.sendall(bytes(f'setI {c} {v}\n', encoding='UTF-8'))
+        # Outputs changed, so don't serve the old frame from the cache.
+        self.invalidate()
 
 class parseVin(Instrument):
     # Meta-instrument for reading an input channel
-    # from stored data without calling the TCP connection
+    # from the FBL's cached frame (see FeedbackLockin.fetch)
     # usage example:
     # in1=parseVin('in1',fbl=FBL,chO=1,ampO=1e4)
     def __init__(self,name,fbl,chO,ampO,**kwargs):
@@ -94,7 +215,7 @@ class parseVin(Instrument):
 
 class parseVout(Instrument):
     # Meta-instrument for reading an output channel
-    # from stored data without calling the TCP connection
+    # from the FBL's cached frame (see FeedbackLockin.fetch)
     # usage example:
     # out1=parseVout('out1',fbl=FBL,chO=1,ampO=1e4)
     def __init__(self,name,fbl,chO,ampO,**kwargs):
@@ -110,7 +231,7 @@ class parseVout(Instrument):
         
 class parseR_chA_chB_chI(Instrument):
     # Meta-instrument for reading 3 input channels into a resistance
-    # from stored data without calling the TCP connection
+    # from the FBL's cached frame (see FeedbackLockin.fetch)
     # usage example:
     # Rxx=getR_chA_chB_chI('Rxx',fbl=FBL,chA=0,ampA=1e4,chB=1,ampB=1e5,chI=2,ampI=1e5,R2GND=470)
     def __init__(self,name,fbl,chA,ampA,chB,ampB,chI,ampI,R2GND,**kwargs):
@@ -155,7 +276,7 @@ class parseR_chA_chB_chI(Instrument):
 
 class parseR_chA_chI(Instrument):
     # Meta-instrument for reading 2 input channels (A-B and Isrc) into a resistance
-    # from stored data without calling the TCP connection
+    # from the FBL's cached frame (see FeedbackLockin.fetch)
     # usage example:
     # Rxx=getR_chA_chI('Rxx',fbl=FBL,chA=0,ampA=1e4,chI=2,ampI=1e5,R2GND=470)
     def __init__(self,name,fbl,chA,ampA,chI,ampI,R2GND,**kwargs):
@@ -194,10 +315,11 @@ class parseT_OCT(Instrument):
     # Roct=parseR_chA_chB_chI('Roct',fbl=FBL,chA=0,ampA=1e4,chB=1,ampB=1e5,chI=2,ampI=1e5,R2GND=470)
     # calfilename = "D:/Dropbox (DGG Lab)/Cryocooler/Main/Evgeny/Lakeshore/R16C19.dat"
     # OCT=parseT_OCT('OCT',R=Roct,calfilename=calfilename)
-    def __init__(self,name,R,calfilename,**kwargs):
+    # The curve is loaded and checked once, see feedbacklockin/calibration.py.
+    def __init__(self,name,R,calfilename,method='linear',**kwargs):
         super().__init__(name, **kwargs)
         self.R=R
-        self.cal=np.loadtxt(calfilename,skiprows=2)
+        self.cal=CalibrationSet([Calibration.load(calfilename,method)])
         self.add_parameter('Toct',get_cmd=self._get_Toct,unit='K')
         self.add_parameter('Roct',get_cmd=self._get_Roct,unit='Ohms')
 
@@ -206,4 +328,31 @@ class parseT_OCT(Instrument):
         return Roct
     def _get_Toct(self):
         Roct = self.R.R.get()
-        return np.interp(Roct,np.flipud(self.cal[:,1]),np.flipud(self.cal[:,0]));
\ No newline at end of file
+        return self.cal.temperatures([Roct],self.R.fbl.seq)[0]
+
+class parseTemperatures(Instrument):
+    # Meta-instrument for converting the resistances of several thermometers
+    # into temperatures in one go. Every sensor is read from the same cached
+    # frame, and all of them are converted together once per frame.
+    # usage example:
+    # Ts=parseTemperatures('Ts',fbl=FBL,sensors={'oct':(Roct,"R16C19.dat"),
+    #                                           'mxc':(Rmxc,"RX102.dat")})
+    # Ts.oct.get(); Ts.temperatures.get()
+    def __init__(self,name,fbl,sensors,method='linear',**kwargs):
+        super().__init__(name, **kwargs)
+        self.fbl=fbl
+        self.sensors=list(sensors)
+        self.R=[R for R, _ in sensors.values()]
+        self.cal=CalibrationSet([Calibration.load(f,method)
+                                 for _, f in sensors.values()])
+        for i, sensor in enumerate(self.sensors):
+            self.add_parameter(sensor,get_cmd=partial(self._get_T,i),unit='K')
+        self.add_parameter('temperatures',get_cmd=self._get_Ts,unit='K',
+                           vals=vals.Arrays(shape=(len(self.sensors),)))
+
+    def _get_Ts(self):
+        with self.fbl.frozen():
+            Rs=[R.R.get() for R in self.R]
+            return self.cal.temperatures(Rs,self.fbl.seq)
+    def _get_T(self,i):
+        return self._get_Ts()[i]
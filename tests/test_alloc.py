@@ -0,0 +1,48 @@
+'''
+Checks that the per-frame hot path, sine_out and read_in, allocates nothing
+once warmed up.
+'''
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from feedbacklockin.fbl import FeedbackLockin
+
+
+CHANNELS = 32
+POINTS = 1700
+# Far below the size of one (points) x (channels) array, 435 kB here.
+MAX_PEAK = 4096
+
+
+@pytest.mark.parametrize('avg_type', [0, 1, 2])
+@pytest.mark.parametrize('hop', [None, 425])
+def test_hot_path_does_not_allocate(avg_type, hop):
+    fbl = FeedbackLockin(CHANNELS, POINTS, hop=hop)
+    fbl.set_averaging_type(avg_type)
+    fbl.update_averaging(5)
+    fbl.update_k(0.01, 0.1)
+    fbl.update_slew(0.01)
+    fbl.update_setpoints(np.full(CHANNELS, 0.1))
+    fbl.set_feedback_mask(np.arange(CHANNELS) % 2)
+    rng = np.random.default_rng(0)
+    # Fortran order, like the blocks the DAQ cards hand over.
+    blocks = [np.asfortranarray(rng.standard_normal((fbl.hop, CHANNELS)))
+              for _ in range(4)]
+
+    def frames(n):
+        for i in range(n):
+            fbl.sine_out()
+            fbl.read_in(blocks[i % len(blocks)])
+
+    frames(20)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        frames(50)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak - start < MAX_PEAK
@@ -0,0 +1,31 @@
+'''
+Checks that offline.demodulate never merges blocks across a gap in a capture.
+'''
+import numpy as np
+import pytest
+
+from feedbacklockin import offline
+from feedbacklockin.capture import RawCapture
+
+
+POINTS = 400
+HOP = 100
+
+
+@pytest.mark.parametrize('window', [None, 'hann'])
+def test_gaps_split_periods(tmp_path, window):
+    path = str(tmp_path / 'gaps.ring')
+    capture = RawCapture.create(path, 2, HOP, 200, 0, 200.0)
+    t = np.arange(POINTS) / POINTS
+    period = np.stack((0.2 * np.sin(2 * np.pi * t),
+                       0.1 * np.cos(2 * np.pi * t)), axis=1)
+    # Blocks the engine missed, which take their period's phase with them.
+    for block in range(120):
+        if block not in (37, 38, 71):
+            chunk = block % (POINTS // HOP)
+            capture.write(block + 1, period[chunk * HOP:(chunk + 1) * HOP])
+    result = offline.demodulate(path, points=POINTS, window=window)
+    assert len(result.seq)
+    np.testing.assert_allclose(result.R[:, 0], [[0.2, 0.1]] * len(result.seq),
+                               atol=1e-12)
+    assert np.all(result.seq % (POINTS // HOP) == 0)
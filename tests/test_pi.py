@@ -0,0 +1,31 @@
+'''
+Checks that DiscretePI limits the outputs past the bias resistor transform,
+where they actually saturate, and doesn't wind up there.
+'''
+import numpy as np
+
+from feedbacklockin.bias_resistor import BiasResistor
+from feedbacklockin.discrete_pi import DiscretePI
+
+
+CHANNELS = 4
+
+
+def test_limits_past_transform():
+    bias = BiasResistor(CHANNELS)
+    pi = DiscretePI(CHANNELS)
+    pi.set_limits(-10.0, 10.0)
+    pi.set_ki(0.5)
+    pi.set_outputs_enabled(np.ones(CHANNELS, dtype=bool))
+    pi.set_output_transform(bias)
+    # Opposite setpoints that no output can reach push the transformed
+    # outputs past the PI outputs.
+    pi.set_setpoints(np.array([100.0, -100.0, 0.0, 0.0]))
+    for _ in range(200):
+        outs = bias.step(pi.step(np.zeros(CHANNELS)))
+        assert np.all(np.abs(outs) <= 10.0 + 1e-9)
+    # Without windup, the outputs come off the limits as soon as the errors
+    # change sign.
+    pi.set_setpoints(np.array([-100.0, 100.0, 0.0, 0.0]))
+    outs = bias.step(pi.step(np.zeros(CHANNELS)))
+    assert outs[0] < 10.0 and outs[1] > -10.0
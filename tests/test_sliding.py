@@ -0,0 +1,26 @@
+'''
+Checks that SlidingLockin stays in phase when chunks are missed.
+'''
+import numpy as np
+
+from feedbacklockin.lockin_calc import LockinCalculator, SlidingLockin
+
+
+POINTS = 400
+HOP = 100
+
+
+def test_missed_chunks_keep_phase():
+    calc = LockinCalculator(POINTS)
+    sliding = SlidingLockin(calc, 1, HOP)
+    t = np.arange(POINTS) / POINTS
+    period = np.asfortranarray((0.3 * np.sin(2 * np.pi * t)
+                                + 0.1 * np.cos(2 * np.pi * t))[:, None])
+    expected = calc.calc_amps(period)
+    # Skip a chunk now and then, as the engine does when it falls behind.
+    blocks = [b for b in range(40) if b % 7 != 3]
+    for block in blocks:
+        chunk = block % (POINTS // HOP)
+        amps = sliding.step(period[chunk * HOP:(chunk + 1) * HOP],
+                            chunk=block)
+    np.testing.assert_allclose(amps, expected, atol=1e-12)
@@ -0,0 +1,103 @@
+'''
+Checks identify against the dummy DAQ, with and without hops: the response
+it measures should match the noise-free one, and the gains it sets should
+make a setpoint step converge.
+'''
+import numpy as np
+import pytest
+
+from feedbacklockin import dummy_daq
+from feedbacklockin.fbl import FeedbackLockin
+
+
+CHANNELS = 8
+POINTS = 400
+FEEDBACK = [0, 1, 2, 3]
+
+
+class _Loop(object):
+    # Steps the dummy DAQ and the lockin by hand, one frame per call, in the
+    # same order as the engine.
+    def __init__(self, hop, seed):
+        np.random.seed(seed)
+        self.daq = dummy_daq.Daq(CHANNELS, POINTS)
+        self.fbl = FeedbackLockin(CHANNELS, POINTS, hop=hop)
+        self.hops = POINTS // self.fbl.hop
+        self.daq.set_hop(self.fbl.hop)
+
+    def frames(self, n):
+        for _ in range(n):
+            self.daq._seq += 1
+            self.daq.set_output(self.fbl.sine_out())
+            self.fbl.read_in(self.daq.get_input(), self.daq.get_input_seq())
+
+
+def _quiet(monkeypatch):
+    # The dummy's noise is (randn - 0.5) * 0.2.
+    monkeypatch.setattr(dummy_daq.np.random, 'randn',
+                        lambda *shape: np.full(shape, 0.5))
+
+
+def _true_response(hop, seed, monkeypatch, step=0.01):
+    # Without feedback the outputs are the amplitudes, so move one at a time
+    # and wait well past any latency.
+    loop = _Loop(hop, seed)
+    _quiet(monkeypatch)
+    loop.fbl.set_feedback_mask(np.zeros(CHANNELS))
+    wait = 4 * loop.hops + 2
+    loop.frames(wait)
+    base = loop.fbl._pi_in.copy()
+    response = np.zeros((CHANNELS, len(FEEDBACK)))
+    for i, chan in enumerate(FEEDBACK):
+        amps = np.zeros(CHANNELS)
+        amps[chan] = step
+        loop.fbl.update_all_amps(amps)
+        loop.frames(wait)
+        response[:, i] = (loop.fbl._pi_in - base) / step
+    loop.fbl.update_all_amps(np.zeros(CHANNELS))
+    return response
+
+
+def _identified(loop, decouple=False):
+    loop.fbl.identify(0.01, 10, decouple)
+    loop.frames(loop.fbl.identify_status[2] + 1)
+    assert loop.fbl.identify_status[0] == 'done'
+    return loop.fbl.identified
+
+
+@pytest.mark.parametrize('hop', [None, 100])
+def test_identified_response(hop, monkeypatch):
+    truth = _true_response(hop, 1, monkeypatch)
+    loop = _Loop(hop, 1)
+    _quiet(monkeypatch)
+    mask = np.zeros(CHANNELS)
+    mask[FEEDBACK] = 1
+    loop.fbl.update_k(0.0, 0.0)
+    loop.fbl.set_feedback_mask(mask)
+    loop.frames(4 * loop.hops)
+    found = _identified(loop)[:, FEEDBACK]
+    assert np.abs(found - truth).max() < 0.05 * np.abs(truth).max()
+
+
+@pytest.mark.parametrize('hop', [None, 100])
+def test_step_converges(hop):
+    loop = _Loop(hop, 2)
+    mask = np.zeros(CHANNELS)
+    mask[FEEDBACK] = 1
+    loop.fbl.update_k(0.01, 0.0)
+    loop.fbl.set_feedback_mask(mask)
+    loop.frames(20 * loop.hops)
+    _identified(loop)
+    loop.frames(20 * loop.hops)
+    setpoints = loop.fbl.vIns.copy()
+    setpoints[FEEDBACK[0]] += 0.05
+    loop.fbl.update_setpoints(setpoints)
+    loop.frames(1)
+    start = np.abs(loop.fbl._control_pi.errors[FEEDBACK]).max()
+    loop.frames(40 * loop.hops)
+    errors = []
+    for _ in range(10 * loop.hops):
+        loop.frames(1)
+        errors.append(np.abs(loop.fbl._control_pi.errors[FEEDBACK]).max())
+    assert np.mean(errors) < start
+    assert max(errors) < 0.05